@@ -1,55 +1,277 @@
 import logging
-from typing import Dict, Any, List
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Any, List, Optional
 import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import anomaly_detection
+import capacity_forecasting
+from prometheus_handler import (FallbackClient, PrometheusClient, PrometheusTimeout, get_prometheus_client,
+                                parse_duration)
+from tsdb_reader import get_offline_reader
 
 logger = logging.getLogger(__name__)
 
+# Utilisation ratios (0..1) per resource; each query is evaluated for every pod/node/volume
+CAPACITY_QUERIES = {
+    "cpu": [
+        '1 - avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[5m]))',
+        'sum by (namespace, pod) (rate(container_cpu_usage_seconds_total{container!=""}[5m])) '
+        '/ sum by (namespace, pod) (kube_pod_container_resource_limits{resource="cpu"})',
+    ],
+    "memory": [
+        '1 - node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes',
+        'sum by (namespace, pod) (container_memory_working_set_bytes{container!=""}) '
+        '/ sum by (namespace, pod) (kube_pod_container_resource_limits{resource="memory"})',
+    ],
+    "disk": [
+        '1 - node_filesystem_avail_bytes{fstype!~"tmpfs|overlay|squashfs"} '
+        '/ node_filesystem_size_bytes{fstype!~"tmpfs|overlay|squashfs"}',
+        'kubelet_volume_stats_used_bytes / kubelet_volume_stats_capacity_bytes',
+    ],
+}
+CAPACITY_HISTORY_S = 7 * 86400
+CAPACITY_STEP_S = 3600
+CAPACITY_SEASON_STEPS = 24  # daily cycle at 1h resolution
+CAPACITY_HORIZON_S = 7 * 86400
+
+# Health signals: the worst value across series is mapped linearly from `good` (score 100)
+# to `bad` (score 0). `degraded_score` is used when the query times out or fails.
+HEALTH_SIGNALS = [
+    {"name": "node_cpu_pressure", "weight": 2.0, "good": 0.6, "bad": 0.95, "degraded_score": 50.0, "timeout": 1.5,
+     "query": '1 - avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[5m]))'},
+    {"name": "node_memory_pressure", "weight": 2.0, "good": 0.7, "bad": 0.95, "degraded_score": 50.0, "timeout": 1.5,
+     "query": '1 - node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes'},
+    {"name": "pod_restart_rate", "weight": 1.5, "good": 0.0, "bad": 10.0, "degraded_score": 70.0, "timeout": 1.5,
+     "query": 'sum(increase(kube_pod_container_status_restarts_total[15m]))'},
+    {"name": "container_ooms", "weight": 1.5, "good": 0.0, "bad": 3.0, "degraded_score": 70.0, "timeout": 1.5,
+     "query": 'sum(increase(container_oom_events_total[15m]))'},
+    {"name": "error_rate", "weight": 3.0, "good": 0.01, "bad": 0.1, "degraded_score": 50.0, "timeout": 1.5,
+     "query": 'sum(rate(http_requests_total{code=~"5.."}[5m])) / sum(rate(http_requests_total[5m]))'},
+]
+
 class AdvancedMonitoring:
-    def __init__(self):
+    def __init__(self, prometheus: Optional[PrometheusClient] = None,
+                 health_signals: Optional[List[Dict[str, Any]]] = None, metric_store=None, shared_cache=None):
         self.logger = logging.getLogger(__name__)
+        self.metric_store = metric_store
+        # Cross-process cache (shared_cache.SharedCache): one process's result serves all bot processes
+        self.shared_cache = shared_cache
+        self.prometheus = prometheus or self._build_prometheus_chain(metric_store)
+        self.health_signals = health_signals or HEALTH_SIGNALS
+        self.health_budget = float(os.environ.get("HEALTH_LATENCY_BUDGET", "2.0"))
+        self.health_cache_ttl = float(os.environ.get("HEALTH_CACHE_TTL", "15"))
+        self._health_cache = None
+        self._health_lock = threading.Lock()
+        self._health_executor = ThreadPoolExecutor(max_workers=len(self.health_signals),
+                                                   thread_name_prefix="health")
+        self.capacity_refresh_interval = float(os.environ.get("CAPACITY_REFRESH_INTERVAL", "300"))
+        self._capacity_cache = None
+        self._capacity_lock = threading.Lock()
 
     def get_system_health_score(self) -> Dict[str, Any]:
         """
-        Get a basic system health score without Prometheus metrics
+        Weighted health score (0-100) over the configured PromQL signals.
+
+        Signals are queried in parallel, each with its own deadline, and the whole
+        evaluation is bounded by HEALTH_LATENCY_BUDGET. A signal that misses its
+        deadline or fails contributes its degraded score instead. The result is
+        cached for HEALTH_CACHE_TTL seconds.
         """
+        if not self.prometheus:
+            return {"status": "error", "message": "Prometheus is not configured (set PROMETHEUS_URL)"}
+        cached = self._health_cache
+        if cached and time.time() < cached["expires_at"]:
+            return cached["result"]
+        with self._health_lock:
+            # Another caller may have refreshed the cache while we waited
+            cached = self._health_cache
+            if cached and time.time() < cached["expires_at"]:
+                return cached["result"]
+            # Computed by another process: served from the shared cache until it expires there
+            shared = self.shared_cache.get("health_score") if self.shared_cache else None
+            if shared is not None:
+                return shared
+            result = self._compute_health_score()
+            if self.shared_cache:
+                self.shared_cache.set("health_score", result, self.health_cache_ttl)
+            self._health_cache = {"expires_at": time.time() + self.health_cache_ttl, "result": result}
+            return result
+
+    def _evaluate_signal(self, signal: Dict[str, Any]) -> float:
+        """Runs a signal's query and returns its (worst) value, 0.0 when there is no data."""
+        result = self.prometheus.custom_query(signal["query"], timeout=signal.get("timeout", self.health_budget))
+        values = [float(series["value"][1]) for series in result]
+        values = [v for v in values if np.isfinite(v)]
+        return max(values) if values else 0.0
+
+    @staticmethod
+    def _score_signal(signal: Dict[str, Any], value: float) -> float:
+        """Maps a value linearly from `good` (100) to `bad` (0)."""
+        good, bad = signal["good"], signal["bad"]
+        fraction = (value - good) / (bad - good)
+        return float(100.0 * (1.0 - min(max(fraction, 0.0), 1.0)))
+
+    def _compute_health_score(self) -> Dict[str, Any]:
+        start = time.monotonic()
+        futures = {self._health_executor.submit(self._evaluate_signal, signal): signal
+                   for signal in self.health_signals}
+        done, not_done = wait(futures, timeout=self.health_budget)
+
+        metrics, signals, degraded = {}, {}, []
+        for future, signal in futures.items():
+            name = signal["name"]
+            if future in done and future.exception() is None:
+                value = future.result()
+                score = self._score_signal(signal, value)
+                state = "ok"
+            else:
+                value = None
+                score = float(signal.get("degraded_score", 50.0))
+                if future in not_done or isinstance(future.exception(), PrometheusTimeout):
+                    state = "timeout"
+                    future.cancel()
+                else:
+                    state = "error"
+                    logger.warning(f"Health signal '{name}' failed: {future.exception()}")
+                degraded.append(name)
+            metrics[name] = score
+            signals[name] = {"value": value, "score": score, "weight": signal["weight"], "state": state}
+
+        total_weight = sum(signal["weight"] for signal in self.health_signals) or 1.0
+        health_score = sum(metrics[s["name"]] * s["weight"] for s in self.health_signals) / total_weight
         return {
             "status": "success",
-            "health_score": 100.0,
-            "metrics": {
-                "system_health": 100.0
-            }
+            "health_score": health_score,
+            "metrics": metrics,
+            "signals": signals,
+            "degraded": degraded,
+            "duration_s": round(time.monotonic() - start, 3)
         }
 
-    def detect_anomalies(self, metric_name: str, duration: str) -> Dict[str, Any]:
+    def detect_anomalies(self, metric_name: str, duration: str, method: str = "zscore",
+                         threshold: float = 3.0, max_anomalies: int = 50) -> Dict[str, Any]:
         """
-        Placeholder for anomaly detection without Prometheus
+        Detect anomalies in every series returned by a PromQL expression.
+        All series are scored together as one matrix and ranked by severity.
         """
-        return {
-            "status": "success",
-            "anomalies": [],
-            "statistics": {
-                "mean": 0.0,
-                "std": 0.0,
-                "min": 0.0,
-                "max": 0.0
+        if not self.prometheus:
+            return {"status": "error", "message": "Prometheus is not configured (set PROMETHEUS_URL)"}
+        try:
+            if method not in anomaly_detection.METHODS:
+                return {"status": "error",
+                        "message": f"Unsupported method '{method}'. Use one of: {', '.join(anomaly_detection.METHODS)}"}
+            window_s = parse_duration(duration)
+            # 5m resolution for long windows, 1m for short ones; never fewer than ~30 points
+            step = 300 if window_s >= 6 * 3600 else 60
+            step = min(step, max(window_s / 30, 15))
+            end = time.time()
+            result = self.prometheus.custom_query_range(metric_name, end - window_s, end, step)
+            if not result:
+                return {"status": "error", "message": f"No data returned for `{metric_name}`"}
+
+            # Window comes from the data: offline fallback results may be anchored in the past
+            timestamps, labels, values = anomaly_detection.matrix_from_result(result, None, None, step)
+            scores = anomaly_detection.score_series(values, method)
+            rows, cols, severity = anomaly_detection.rank_anomalies(scores, threshold, top_k=max_anomalies)
+
+            anomalies = []
+            for row, col, sev in zip(rows.tolist(), cols.tolist(), severity.tolist()):
+                anomalies.append({
+                    "timestamp": datetime.fromtimestamp(timestamps[col]).strftime("%Y-%m-%d %H:%M:%S"),
+                    "value": float(values[row, col]),
+                    "series": self._format_labels(labels[row]),
+                    "score": float(scores[row, col]),
+                    "severity": sev
+                })
+
+            finite = values[~np.isnan(values)]
+            return {
+                "status": "success",
+                "method": method,
+                "series_count": len(labels),
+                "anomalies": anomalies,
+                "statistics": {
+                    "mean": float(finite.mean()) if finite.size else 0.0,
+                    "std": float(finite.std()) if finite.size else 0.0,
+                    "min": float(finite.min()) if finite.size else 0.0,
+                    "max": float(finite.max()) if finite.size else 0.0
+                }
             }
-        }
+        except Exception as e:
+            logger.error(f"Error detecting anomalies: {str(e)}")
+            return {"status": "error", "message": str(e)}
 
     def get_capacity_planning_insights(self) -> Dict[str, Any]:
         """
-        Placeholder for capacity planning without Prometheus
+        Forecast CPU, memory and disk utilisation for every pod and node and
+        estimate time to exhaustion. Results are cached for one refresh interval.
         """
-        return {
-            "status": "success",
-            "insights": {
-                "system": {
-                    "current_usage": 0.0,
-                    "growth_rate": 0.0,
-                    "predicted_usage": 0.0,
-                    "recommendation": "Monitoring functionality has been removed from this version."
+        if not self.prometheus:
+            return {"status": "error", "message": "Prometheus is not configured (set PROMETHEUS_URL)"}
+        with self._capacity_lock:
+            cached = self._capacity_cache
+            if cached and time.time() < cached["expires_at"]:
+                return cached["result"]
+            shared = self.shared_cache.get("capacity_insights") if self.shared_cache else None
+            if shared is not None:
+                return shared
+            result = self._compute_capacity_insights()
+            if result["status"] == "success":
+                if self.shared_cache:
+                    self.shared_cache.set("capacity_insights", result, self.capacity_refresh_interval)
+                self._capacity_cache = {"expires_at": time.time() + self.capacity_refresh_interval,
+                                        "result": result}
+            return result
+
+    def _compute_capacity_insights(self) -> Dict[str, Any]:
+        try:
+            end = time.time()
+            start = end - CAPACITY_HISTORY_S
+            insights = {}
+            for resource, queries in CAPACITY_QUERIES.items():
+                results = []
+                for query in queries:
+                    results.extend(self.prometheus.custom_query_range(query, start, end, CAPACITY_STEP_S))
+                if not results:
+                    continue
+                timestamps, labels, values = anomaly_detection.matrix_from_result(results, None, None, CAPACITY_STEP_S)
+                fc = capacity_forecasting.forecast(timestamps, values, CAPACITY_HORIZON_S,
+                                                   period=CAPACITY_SEASON_STEPS)
+
+                # Headline: the series that runs out first (or the busiest one if none do)
+                tte = fc["time_to_exhaustion_s"]
+                current = np.nan_to_num(fc["current"], nan=0.0)
+                worst = int(np.argmin(tte)) if np.isfinite(tte).any() else int(np.argmax(current))
+                growth_rate = 100.0 * (fc["predicted"][worst] - current[worst]) / max(current[worst], 1e-6)
+                at_risk = [
+                    {"series": self._format_labels(labels[i]),
+                     "current_usage": 100.0 * float(current[i]),
+                     "time_to_exhaustion": capacity_forecasting.format_time_to_exhaustion(tte[i])}
+                    for i in np.argsort(tte)[:5] if np.isfinite(tte[i])
+                ]
+                insights[resource] = {
+                    "series": self._format_labels(labels[worst]),
+                    "series_count": len(labels),
+                    "current_usage": 100.0 * float(current[worst]),
+                    "growth_rate": float(growth_rate),
+                    "predicted_usage": 100.0 * float(np.nan_to_num(fc["predicted"][worst])),
+                    "time_to_exhaustion": capacity_forecasting.format_time_to_exhaustion(tte[worst]),
+                    "at_risk": at_risk,
+                    "recommendation": self._generate_capacity_recommendation(
+                        resource, current[worst], growth_rate, float(tte[worst]))
                 }
-            }
-        }
+            if not insights:
+                return {"status": "error", "message": "No CPU, memory or disk data available in Prometheus"}
+            return {"status": "success", "insights": insights, "generated_at": datetime.now().isoformat()}
+        except Exception as e:
+            logger.error(f"Error computing capacity insights: {str(e)}")
+            return {"status": "error", "message": str(e)}
 
     def get_resource_trends(self, resource_type: str, duration: str = "24h") -> Dict:
         """Analyze resource usage trends."""
@@ -62,9 +284,11 @@ class AdvancedMonitoring:
             
             if resource_type not in queries:
                 return {"status": "error", "message": f"Unsupported resource type: {resource_type}"}
+            if not self.prometheus:
+                return {"status": "error", "message": "Prometheus is not configured (set PROMETHEUS_URL)"}
             
             end_time = datetime.now()
-            start_time = end_time - parse_datetime(duration)
+            start_time = end_time - timedelta(seconds=parse_duration(duration))
             
             result = self.prometheus.custom_query_range(
                 query=queries[resource_type],
@@ -100,8 +324,33 @@ class AdvancedMonitoring:
             logger.error(f"Error analyzing resource trends: {str(e)}")
             return {"status": "error", "message": str(e)}
     
+    @staticmethod
+    def _build_prometheus_chain(metric_store=None):
+        """
+        Live Prometheus first, then the bot's own metric store, then the on-disk
+        TSDB (PROMETHEUS_DATA_DIR) when the server is unreachable.
+        """
+        primary = get_prometheus_client()
+        fallbacks = []
+        if metric_store is not None:
+            fallbacks.append(lambda: metric_store)
+        if os.environ.get("PROMETHEUS_OFFLINE_FALLBACK", "true").lower() in ("1", "true", "yes"):
+            fallbacks.append(get_offline_reader)
+        if not fallbacks:
+            return primary
+        cooldown = float(os.environ.get("PROMETHEUS_FALLBACK_COOLDOWN", "30"))
+        return FallbackClient(primary, fallbacks, cooldown=cooldown)
+
+    @staticmethod
+    def _format_labels(metric: Dict[str, str]) -> str:
+        name = metric.get("__name__", "")
+        labels = ",".join(f'{k}="{v}"' for k, v in sorted(metric.items()) if k != "__name__")
+        return f"{name}{{{labels}}}" if labels else (name or "{}")
+
     def _query_metric(self, query: str) -> float:
         """Helper method to query a single metric."""
+        if not self.prometheus:
+            return 0.0
         try:
             result = self.prometheus.custom_query(query)
             if result and len(result) > 0:
@@ -111,11 +360,20 @@ class AdvancedMonitoring:
             logger.error(f"Error querying metric: {str(e)}")
             return 0.0
     
-    def _generate_capacity_recommendation(self, metric: str, current: float, growth_rate: float) -> str:
+    def _generate_capacity_recommendation(self, metric: str, current: float, growth_rate: float,
+                                          time_to_exhaustion: Optional[float] = None) -> str:
         """Generate capacity planning recommendations."""
+        if time_to_exhaustion is not None and np.isfinite(time_to_exhaustion):
+            eta = capacity_forecasting.format_time_to_exhaustion(time_to_exhaustion)
+            if time_to_exhaustion <= 0:
+                return f"{metric.upper()} is already at capacity. Scale up or rebalance immediately."
+            if time_to_exhaustion < 7 * 86400:
+                return f"{metric.upper()} projected to run out in {eta}. Increase capacity this week."
+            if time_to_exhaustion < 30 * 86400:
+                return f"{metric.upper()} projected to run out in {eta}. Plan a capacity increase this month."
         if growth_rate > 20:
             return f"High growth rate detected ({growth_rate:.1f}%). Consider immediate capacity increase."
         elif growth_rate > 10:
             return f"Moderate growth rate ({growth_rate:.1f}%). Plan for capacity increase in next quarter."
         else:
-            return f"Stable growth rate ({growth_rate:.1f}%). Current capacity should be sufficient." 
\ No newline at end of file
+            return f"Stable growth rate ({growth_rate:.1f}%). Current capacity should be sufficient."
@@ -0,0 +1,353 @@
+# alert_rules.py
+"""
+Evaluates Prometheus-style alerting rules (the `groups:` section of
+alertmanager.yml) inside the bot and posts firing/resolved alerts to Slack.
+
+Each rule is evaluated incrementally: a cycle only asks the metric source for
+the steps since the last evaluated one, and `for:` pending state is carried
+between cycles, so the cost of a cycle does not grow with the `for:` duration.
+Notifications are deduplicated per alert (alertname + labels), repeated only
+after `repeat_interval`, and grouped by the route's `group_by` labels into one
+Slack message per group.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import yaml
+
+from prometheus_handler import parse_duration
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVAL_INTERVAL = 30.0
+DEFAULT_REPEAT_INTERVAL = 4 * 3600.0
+# On the first cycle, look back at most this far to rebuild `for:` state
+MAX_BACKFILL_S = 3600.0
+
+_LABEL_TEMPLATE_RE = re.compile(r"\{\{\s*\$labels\.([a-zA-Z_][a-zA-Z0-9_]*)\s*\}\}")
+_VALUE_TEMPLATE_RE = re.compile(r"\{\{\s*\$value\s*\}\}")
+
+
+def render_template(template: str, labels: Dict[str, str], value: float) -> str:
+    """Expands {{ $labels.x }} and {{ $value }} the way Prometheus annotations do."""
+    text = _LABEL_TEMPLATE_RE.sub(lambda m: labels.get(m.group(1), ""), template)
+    return _VALUE_TEMPLATE_RE.sub(f"{value:g}", text)
+
+
+class AlertRule:
+    """One alerting rule and the state of the alerts it has produced."""
+
+    def __init__(self, name: str, expr: str, group: str, interval: float, for_s: float = 0.0,
+                 labels: Optional[Dict[str, str]] = None, annotations: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.expr = expr
+        self.group = group
+        self.interval = interval
+        self.for_s = for_s
+        self.labels = labels or {}
+        self.annotations = annotations or {}
+        self.last_eval_ts: Optional[float] = None
+        self.last_error: Optional[str] = None
+        # fingerprint -> alert dict (labels, value, active_since, last_seen, state)
+        self.alerts: Dict[Tuple, Dict[str, Any]] = {}
+
+
+def load_rules(path, default_interval: float = DEFAULT_EVAL_INTERVAL) -> Tuple[List[AlertRule], Dict[str, Any]]:
+    """
+    Loads alerting rules and notification settings from a Prometheus rule file or
+    an alertmanager.yml that also carries `groups:`. Recording rules are skipped.
+    Returns (rules, route) where route has group_by, repeat_interval, send_resolved
+    and channel.
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    rules = []
+    for group in config.get("groups") or []:
+        interval = parse_duration(group.get("interval", default_interval))
+        for rule in group.get("rules") or []:
+            if "alert" not in rule:
+                logger.debug(f"Skipping recording rule {rule.get('record')} in group {group.get('name')}")
+                continue
+            rules.append(AlertRule(
+                name=rule["alert"],
+                expr=str(rule["expr"]).strip(),
+                group=group.get("name", "default"),
+                interval=interval,
+                for_s=parse_duration(rule.get("for", 0)),
+                labels={k: str(v) for k, v in (rule.get("labels") or {}).items()},
+                annotations={k: str(v) for k, v in (rule.get("annotations") or {}).items()}
+            ))
+
+    route_config = config.get("route") or {}
+    receiver = next((r for r in config.get("receivers") or [] if r.get("name") == route_config.get("receiver")), {})
+    slack_config = (receiver.get("slack_configs") or [{}])[0]
+    route = {
+        "group_by": route_config.get("group_by") or ["alertname"],
+        "repeat_interval": parse_duration(route_config.get("repeat_interval", DEFAULT_REPEAT_INTERVAL)),
+        "send_resolved": slack_config.get("send_resolved", True),
+        "channel": slack_config.get("channel")
+    }
+    return rules, route
+
+
+class AlertRuleEngine:
+    """
+    Evaluates alerting rules on a schedule against any source with a
+    custom_query_range method (PrometheusClient, FallbackClient, MetricStore).
+    `notify(text)` is called once per alert group with the formatted message.
+    """
+
+    def __init__(self, source, rules: List[AlertRule], route: Optional[Dict[str, Any]] = None,
+                 notify: Optional[Callable[[str], None]] = None):
+        self.source = source
+        self.rules = rules
+        self.route = route or {"group_by": ["alertname"], "repeat_interval": DEFAULT_REPEAT_INTERVAL,
+                               "send_resolved": True, "channel": None}
+        self.notify = notify
+        self._last_notified: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_cycle: Optional[Dict[str, Any]] = None
+        self.totals = {"cycles": 0, "queries": 0, "steps": 0, "points": 0, "errors": 0, "notifications": 0}
+
+    # --- Evaluation ---
+    def _evaluate_rule(self, rule: AlertRule, now: float) -> Dict[str, int]:
+        """Evaluates the steps of `rule` since its last evaluation and updates its alerts."""
+        step = rule.interval
+        end = (now // step) * step
+        if rule.last_eval_ts is None:
+            start = end - min(max(rule.for_s, step), MAX_BACKFILL_S)
+        else:
+            start = rule.last_eval_ts + step
+        if start > end:
+            return {"queries": 0, "steps": 0, "points": 0}
+
+        result = self.source.custom_query_range(rule.expr, start, end, step)
+        points = 0
+        for series in result:
+            labels = {k: v for k, v in series["metric"].items() if k != "__name__"}
+            labels.update(rule.labels)
+            labels["alertname"] = rule.name
+            fingerprint = tuple(sorted(labels.items()))
+            alert = rule.alerts.get(fingerprint)
+            for ts, value in series["values"]:
+                ts = float(ts)
+                points += 1
+                # A missed step breaks the run: `for:` starts over
+                if alert is None or alert["last_seen"] < ts - 1.5 * step:
+                    alert = rule.alerts[fingerprint] = {"labels": labels, "active_since": ts,
+                                                        "state": "pending", "notified_state": None}
+                alert["last_seen"] = ts
+                alert["value"] = float(value)
+
+        for fingerprint, alert in list(rule.alerts.items()):
+            if alert["last_seen"] < end:
+                alert["state"] = "resolved"
+            elif end - alert["active_since"] >= rule.for_s:
+                alert["state"] = "firing"
+        rule.last_eval_ts = end
+        return {"queries": 1, "steps": int(round((end - start) / step)) + 1, "points": points}
+
+    def evaluate_once(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """Runs one evaluation cycle over all due rules and sends notifications."""
+        now = time.time() if now is None else now
+        t0 = time.perf_counter()
+        cycle = {"rules": 0, "queries": 0, "steps": 0, "points": 0, "errors": 0, "notifications": 0}
+        with self._lock:
+            for rule in self.rules:
+                if rule.last_eval_ts is not None and now < rule.last_eval_ts + rule.interval:
+                    continue
+                cycle["rules"] += 1
+                try:
+                    for key, value in self._evaluate_rule(rule, now).items():
+                        cycle[key] += value
+                    rule.last_error = None
+                except Exception as e:
+                    # Keep the current alert state; the failed steps are retried next cycle
+                    cycle["errors"] += 1
+                    rule.last_error = str(e)
+                    logger.warning(f"Alert rule {rule.name} failed to evaluate: {e}")
+            cycle["notifications"] = self._send_notifications(now)
+
+        cycle["duration_s"] = round(time.perf_counter() - t0, 4)
+        self.last_cycle = cycle
+        self.totals["cycles"] += 1
+        for key in ("queries", "steps", "points", "errors", "notifications"):
+            self.totals[key] += cycle[key]
+        if cycle["rules"]:
+            logger.info(f"Alert evaluation: {cycle['rules']} rules, {cycle['queries']} queries, "
+                        f"{cycle['steps']} steps, {cycle['points']} points in {cycle['duration_s'] * 1000:.1f} ms")
+        return cycle
+
+    # --- Notifications ---
+    def _pending_notifications(self, now: float) -> Dict[Tuple, Dict[str, Any]]:
+        """Alerts that need a message this cycle, deduplicated by fingerprint across rules."""
+        due = {}
+        repeat_interval = self.route["repeat_interval"]
+        for rule in self.rules:
+            for fingerprint, alert in list(rule.alerts.items()):
+                if alert["state"] == "resolved":
+                    del rule.alerts[fingerprint]
+                    if alert["notified_state"] == "firing" and self.route["send_resolved"]:
+                        due[fingerprint] = {**alert, "rule": rule}
+                    self._last_notified.pop(fingerprint, None)
+                elif alert["state"] == "firing":
+                    last = self._last_notified.get(fingerprint)
+                    if alert["notified_state"] != "firing" or last is None or now - last >= repeat_interval:
+                        due[fingerprint] = {**alert, "rule": rule}
+                        alert["notified_state"] = "firing"
+                        self._last_notified[fingerprint] = now
+        return due
+
+    def _send_notifications(self, now: float) -> int:
+        due = self._pending_notifications(now)
+        if not due:
+            return 0
+        groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+        for alert in due.values():
+            key = tuple((label, alert["labels"].get(label, "")) for label in self.route["group_by"])
+            groups.setdefault(key, []).append(alert)
+        for key, alerts in groups.items():
+            text = format_alert_group(key, alerts)
+            if self.notify:
+                try:
+                    self.notify(text)
+                except Exception as e:
+                    logger.error(f"Failed to send alert notification: {e}", exc_info=True)
+            else:
+                logger.warning(f"Alert notification (no notifier configured):\n{text}")
+        return len(groups)
+
+    # --- Introspection ---
+    def active_alerts(self) -> List[Dict[str, Any]]:
+        """Firing and pending alerts, firing first."""
+        with self._lock:
+            alerts = [{"rule": rule.name, "state": alert["state"], "labels": alert["labels"],
+                       "value": alert["value"], "active_since": alert["active_since"],
+                       "summary": render_template(rule.annotations.get("summary", rule.name),
+                                                  alert["labels"], alert["value"])}
+                      for rule in self.rules for alert in rule.alerts.values() if alert["state"] != "resolved"]
+        return sorted(alerts, key=lambda a: (a["state"] != "firing", a["active_since"]))
+
+    def rule_errors(self) -> Dict[str, str]:
+        return {rule.name: rule.last_error for rule in self.rules if rule.last_error}
+
+    # --- Scheduling ---
+    def _run(self):
+        tick = min((rule.interval for rule in self.rules), default=DEFAULT_EVAL_INTERVAL)
+        while not self._stop.is_set():
+            try:
+                self.evaluate_once()
+            except Exception as e:
+                logger.error(f"Alert evaluation cycle failed: {e}", exc_info=True)
+            self._stop.wait(tick - time.time() % tick)
+
+    def start(self):
+        if not self.rules or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="alert-rules", daemon=True)
+        self._thread.start()
+        logger.info(f"Alert rule engine started with {len(self.rules)} rules")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+def format_alert_group(key: Tuple, alerts: List[Dict[str, Any]]) -> str:
+    """Slack message for one group of alerts."""
+    alerts = sorted(alerts, key=lambda a: sorted(a["labels"].items()))
+    firing = [a for a in alerts if a["state"] == "firing"]
+    resolved = [a for a in alerts if a["state"] == "resolved"]
+    title = ", ".join(f"{label}={value}" for label, value in key if value) or "alerts"
+    lines = []
+    if firing:
+        lines.append(f":rotating_light: *[FIRING:{len(firing)}] {title}*")
+        for alert in firing:
+            rule = alert["rule"]
+            summary = render_template(rule.annotations.get("summary", rule.name), alert["labels"], alert["value"])
+            description = render_template(rule.annotations.get("description", ""), alert["labels"], alert["value"])
+            severity = alert["labels"].get("severity")
+            lines.append(f"• *{summary}*{f' ({severity})' if severity else ''}: {description or rule.expr}")
+    if resolved:
+        lines.append(f":white_check_mark: *[RESOLVED:{len(resolved)}] {title}*")
+        for alert in resolved:
+            rule = alert["rule"]
+            lines.append(f"• {render_template(rule.annotations.get('summary', rule.name), alert['labels'], alert['value'])}"
+                         f" ({', '.join(f'{k}={v}' for k, v in sorted(alert['labels'].items()) if k != 'alertname')})")
+    return "\n".join(lines)
+
+
+def slack_notifier(web_client, channel: str) -> Callable[[str], None]:
+    """Posts alert messages to a Slack channel with a slack_sdk WebClient."""
+    def notify(text: str):
+        web_client.chat_postMessage(channel=channel, text=text)
+    return notify
+
+
+def get_alert_engine(source, web_client=None) -> Optional[AlertRuleEngine]:
+    """
+    Builds an engine from ALERT_RULES_FILE (default: alertmanager.yml next to this
+    file). Alerts go to ALERT_SLACK_CHANNEL, falling back to the channel of the
+    route's Slack receiver. Returns None if alerting is disabled or has no rules.
+    """
+    if source is None or os.environ.get("ALERTS_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    path = Path(os.environ.get("ALERT_RULES_FILE", Path(__file__).resolve().parent / "alertmanager.yml"))
+    if not path.is_file():
+        logger.warning(f"Alert rules file not found: {path}")
+        return None
+    try:
+        interval = parse_duration(os.environ.get("ALERT_EVAL_INTERVAL", str(DEFAULT_EVAL_INTERVAL)))
+        rules, route = load_rules(path, default_interval=interval)
+    except Exception as e:
+        logger.error(f"Could not load alert rules from {path}: {e}", exc_info=True)
+        return None
+    if not rules:
+        return None
+    channel = os.environ.get("ALERT_SLACK_CHANNEL") or route["channel"]
+    notify = slack_notifier(web_client, channel) if web_client and channel else None
+    return AlertRuleEngine(source, rules, route, notify)
+
+
+# Simulation: python alert_rules.py [n_pods]
+if __name__ == "__main__":
+    import sys
+
+    from metric_store import MetricStore
+
+    logging.basicConfig(level=logging.INFO)
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rules, route = load_rules(Path(__file__).resolve().parent / "alertmanager.yml")
+    for rule in rules:
+        rule.interval = 15.0
+    store = MetricStore()
+    messages = []
+    engine = AlertRuleEngine(store, rules, route, notify=messages.append)
+
+    # 20 minutes of restarts sampled every 15s; 5% of pods crash-loop after minute 5
+    start = time.time() - 20 * 60
+    crashing = set(range(0, n_pods, 20))
+    for i in range(80):
+        now = start + i * 15
+        store.add_many([("kube_pod_container_status_restarts_total",
+                         {"namespace": "default", "pod": f"pod-{p}", "container": "app"},
+                         max(0, i - 20) // 2 if p in crashing else 0) for p in range(n_pods)], now)
+        if i == 60:
+            # Half of the crash-looping pods are replaced (restart count back to 0) at minute 15
+            crashing = set(sorted(crashing)[:len(crashing) // 2])
+        engine.evaluate_once(now + 1)
+
+    firing = [a for a in engine.active_alerts() if a["state"] == "firing"]
+    logger.info(f"{len(firing)} firing, {len(messages)} Slack messages, totals={engine.totals}")
+    logger.info(f"Last cycle: {engine.last_cycle}")
+    if messages:
+        logger.info("First message:\n" + messages[0][:400])
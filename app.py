@@ -20,17 +20,34 @@ import docker_handler
 from docker.errors import DockerException
 import requests
 
+import re
 import threading
 import time
+from datetime import datetime
 from slack_sdk import WebClient
+from slack_sdk.webhook import WebhookClient
 
 # Import new modules
 from ai_operations import AIOpsAssistant
 from advanced_monitoring import AdvancedMonitoring
+from metric_store import MetricSampler, get_metric_store
+from alert_rules import get_alert_engine
 
 # Import the WebsiteHandler
 from website_handler import WebsiteHandler
 
+import incident_snapshot
+import blue_green
+import log_pipeline
+import log_grep
+import bot_metrics
+from bot_profiler import get_profiler
+from log_shipper import get_log_shipper
+from idempotency_store import bolt_middleware, get_idempotency_store
+from job_queue import JobCancelled, JobFailed, JobWorker, format_job_line, format_job_status, get_job_queue
+from shared_cache import get_shared_cache
+import bot_cluster
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -40,9 +57,21 @@ app = App(
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
 )
 
-# Initialize AI and Monitoring
+# Ack and drop Slack retries and deliveries another bot process has already claimed
+idempotency_store = get_idempotency_store()
+if idempotency_store:
+    app.middleware(bolt_middleware(idempotency_store))
+
+# Record latency, errors, in-flight requests and payload sizes for every command
+# handler and backend call (served on METRICS_PORT)
+bot_metrics.instrument_bolt_app(app)
+bot_metrics.instrument_module(jenkins_handler, "jenkins")
+bot_metrics.instrument_module(k8s_handler, "k8s")
+bot_metrics.instrument_module(docker_handler, "docker")
+bot_metrics.instrument_class(AIOpsAssistant, "ai")
+
+# Initialize AI
 ai_assistant = AIOpsAssistant()
-advanced_monitor = AdvancedMonitoring()
 
 # Initialize Jenkins client
 jenkins_client = None
@@ -74,6 +103,62 @@ except Exception as e:
 # Initialize WebsiteHandler
 website_handler = WebsiteHandler(docker_client)
 
+# Initialize Monitoring. The built-in metric store samples Docker/K8s so the
+# monitoring commands have data even without Prometheus.
+metric_store = get_metric_store()
+metric_sampler = None
+if metric_store and (docker_client or k8s_core_v1_api):
+    metric_sampler = MetricSampler(metric_store, docker_client, k8s_core_v1_api,
+                                   interval=float(os.environ.get("METRIC_SAMPLE_INTERVAL", "15")))
+advanced_monitor = AdvancedMonitoring(metric_store=metric_store, shared_cache=get_shared_cache())
+
+# Initialize alert rule evaluation (rules from alertmanager.yml, alerts posted with the bot token)
+alert_engine = get_alert_engine(advanced_monitor.prometheus, app.client)
+
+# Long-running commands are queued and run by the job workers of whichever bot
+# process is free (see job_queue.py and bot_cluster.py)
+job_queue = get_job_queue()
+
+def job_responder(job):
+    """respond() for a queued command, usable from any bot process: posts to the command's response_url."""
+    webhook = WebhookClient(job.payload["response_url"])
+    return lambda text: webhook.send(text=text)
+
+def submit_job(kind, payload, command, respond, status=None, summary=None, max_attempts=1):
+    """
+    Queues a long-running command, or runs it right away when the job queue is
+    disabled. `max_attempts` above 1 retries failed attempts (for idempotent
+    work such as pulls and deploys).
+    """
+    if not job_queue:
+        if status:
+            respond(status)
+        try:
+            JOB_HANDLERS[kind](payload, respond, lambda message: None)
+        except Exception as e:
+            logger.error(f"Error in {kind}: {str(e)}", exc_info=True)
+            respond(f"❌ {kind} failed: {str(e)}")
+        return
+    job_id = job_queue.enqueue(kind, {**payload, "response_url": command["response_url"],
+                                      "user_id": command.get("user_id")},
+                               summary=summary, max_attempts=max_attempts)
+    logger.info(f"Queued {kind} as job #{job_id}")
+    respond(f"{status or ':inbox_tray: Queued'} (job #{job_id}, `/job-status {job_id}` for progress)")
+
+def run_job(job, context):
+    """Job worker entry point: runs the command's handler and tells the user how the job ended."""
+    respond = job_responder(job)
+    try:
+        return JOB_HANDLERS[job.kind](job.payload, respond, context.progress)
+    except JobCancelled:
+        respond(f":no_entry_sign: Job #{job.id} `{job.summary}` was cancelled")
+        raise
+    except Exception as e:
+        # JobFailed is final; other errors are retried while attempts remain
+        if isinstance(e, JobFailed) or context.last_attempt:
+            respond(f"❌ Job #{job.id} `{job.summary}` failed after {job.attempts} attempt(s): {str(e)}")
+        raise
+
 # === Event Handlers (like app_mention) and Command Handlers remain THE SAME ===
 # Your @app.event("app_mention") and all @app.command(...) handlers
 # do not need to change for Socket Mode.
@@ -89,11 +174,14 @@ def handle_app_mention_events(body, say, logger):
         # Define command categories and their commands
         commands = {
             "🤖 AI-Powered Commands": [
-                "/ai-analyze-logs <source> - Analyze logs from Jenkins, K8s, or Docker",
+                "/ai-analyze-logs <source> - Analyze logs from Jenkins, K8s, Docker, or all (merged by time)",
                 "/ai-optimize - Get AI-powered system optimization suggestions",
                 "/system-health - Get comprehensive system health score",
-                "/detect-anomalies <metric> [duration] - Detect anomalies in metrics",
-                "/capacity-planning - Get capacity planning insights"
+                "/detect-anomalies <metric> [duration] [zscore|mad|ewma] - Detect anomalies in metrics",
+                "/capacity-planning - Get capacity planning insights",
+                "/incident-report [namespace] - Collect an incident snapshot and generate an AI report",
+                "/logs-grep <regex> [--source s] [--since 30m] - Search pod, container and build logs",
+                "/alerts - Show firing and pending alerts from the local rule engine"
             ],
             "🔄 CI/CD Commands": [
                 "/jenkins-trigger <job_name> [params] - Trigger Jenkins jobs",
@@ -104,7 +192,19 @@ def handle_app_mention_events(body, say, logger):
             "🐳 Docker Commands": [
                 "/docker-ps - List running Docker containers",
                 "/docker-logs <container_name> - Get container logs",
-                "/docker-deploy <image_name> - Deploy container using Docker"
+                "/docker-deploy <image_name> - Deploy container using Docker",
+                "/docker-gc [dry-run] [target=20GB] - Free image storage down to a target, keeping recent and base images (queued)"
+            ],
+            "🧵 Jobs": [
+                "/jobs - List queued, running and recent jobs",
+                "/job-status <job_id> - Show a job's progress and outcome",
+                "/job-cancel <job_id> - Cancel a queued or running job",
+                "/deploy-website [name] [replicas=N|auto] - Build and deploy the website (queued)",
+                "/scale-website [name] <replicas|auto> - Change the website's replica count without downtime (queued)",
+                "/build-website - Build the website image (queued)",
+                "/test-website [image] - Smoke-test a website image on its own port (queued)",
+                "/website-loadtest [name] [open rps=N | closed users=N] [duration=S] - Load test a deployed website (queued)",
+                "/pipeline [name] [deploy] [force] - Lint, test and build the website concurrently, skipping unchanged stages (queued)"
             ],
             "☸️ Kubernetes Commands": [
                 "/k8s-pods [namespace] - List Kubernetes pods",
@@ -295,26 +395,42 @@ def handle_ai_analyze_logs(ack, body, command, respond, logger):
     # Get logs from the specified source
     source = command.get('text', '').strip()
     if not source:
-        respond("Please specify the log source (e.g., 'jenkins', 'k8s', 'docker')")
+        respond("Please specify the log source (e.g., 'jenkins', 'k8s', 'docker', 'all')")
         return
-    
+    if source not in ("jenkins", "k8s", "docker", "all"):
+        respond(f"Unsupported log source: {source}")
+        return
+    submit_job("ai-analyze-logs", {"source": source}, command, respond,
+               status=f":robot_face: Analyzing {source} logs...")
+
+def run_ai_analyze_logs(payload, respond, progress):
+    source = payload["source"]
     try:
         logs = ""
+        # Only the newest lines that fit the prompt budget are kept (and held in memory)
+        max_chars = int(os.environ.get("AI_LOG_CHARS", 16000))
         if source == "jenkins":
-            success, logs = jenkins_handler.get_recent_logs(jenkins_client)
+            success, logs = jenkins_handler.get_recent_logs(jenkins_client, max_chars=max_chars)
         elif source == "k8s":
-            success, logs = k8s_handler.get_recent_logs(k8s_core_v1_api)
+            success, logs = k8s_handler.get_recent_logs(k8s_core_v1_api, max_chars=max_chars, merged=True)
         elif source == "docker":
-            success, logs = docker_handler.get_recent_logs(docker_client)
+            success, logs = docker_handler.get_recent_logs(docker_client, max_chars=max_chars, merged=True)
         else:
-            respond(f"Unsupported log source: {source}")
-            return
+            # Pods and containers interleaved by time; Jenkins consoles have no line timestamps
+            streams = []
+            if k8s_core_v1_api:
+                streams += k8s_handler.get_log_streams(k8s_core_v1_api)
+            if docker_client:
+                streams += docker_handler.get_log_streams(docker_client)
+            count, logs = log_pipeline.collect_streams(streams, max_chars, merged=True)
+            success = count > 0
         
         if not success:
             respond(f"Failed to fetch logs from {source}")
             return
         
         # Analyze logs using AI
+        progress(f"Analyzing {len(logs):,} characters of logs")
         result = ai_assistant.analyze_logs(logs)
         if result["status"] == "success":
             respond(f"🤖 *AI Analysis of {source} logs:*\n{result['analysis']}")
@@ -340,6 +456,8 @@ def handle_system_health(ack, body, command, respond, logger):
             response += "*Detailed Metrics:*\n"
             for metric, value in metrics.items():
                 response += f"• {metric.replace('_', ' ').title()}: {value:.1f}\n"
+            if health_data.get("degraded"):
+                response += f"\n:hourglass: Scored in degraded mode (query timed out or failed): {', '.join(health_data['degraded'])}\n"
             
             respond(response)
         else:
@@ -355,19 +473,20 @@ def handle_detect_anomalies(ack, body, command, respond, logger):
     
     args = command.get('text', '').strip().split()
     if len(args) < 1:
-        respond("Usage: /detect-anomalies <metric_name> [duration]")
+        respond("Usage: /detect-anomalies <metric_name> [duration] [zscore|mad|ewma]")
         return
     
     metric_name = args[0]
     duration = args[1] if len(args) > 1 else "1h"
+    method = args[2] if len(args) > 2 else "zscore"
     
     try:
-        result = advanced_monitor.detect_anomalies(metric_name, duration)
+        result = advanced_monitor.detect_anomalies(metric_name, duration, method)
         if result["status"] == "success":
             anomalies = result["anomalies"]
             stats = result["statistics"]
             
-            response = f"🔍 *Anomaly Detection for {metric_name}*\n\n"
+            response = f"🔍 *Anomaly Detection for {metric_name}* ({result['series_count']} series, method: {result['method']})\n\n"
             response += f"*Statistics:*\n"
             response += f"• Mean: {stats['mean']:.2f}\n"
             response += f"• Std Dev: {stats['std']:.2f}\n"
@@ -377,7 +496,7 @@ def handle_detect_anomalies(ack, body, command, respond, logger):
             if anomalies:
                 response += f"*Detected Anomalies:*\n"
                 for anomaly in anomalies[:5]:  # Show top 5 anomalies
-                    response += f"• Time: {anomaly['timestamp']}, Value: {anomaly['value']:.2f}\n"
+                    response += f"• Time: {anomaly['timestamp']}, Value: {anomaly['value']:.2f}, Score: {anomaly['score']:.1f} — `{anomaly['series']}`\n"
                 if len(anomalies) > 5:
                     response += f"... and {len(anomalies) - 5} more anomalies"
             else:
@@ -401,11 +520,15 @@ def handle_capacity_planning(ack, body, command, respond, logger):
             response = "📊 *Capacity Planning Insights*\n\n"
             
             for resource, data in insights["insights"].items():
-                response += f"*{resource.upper()}*\n"
-                response += f"• Current Usage: {data['current_usage']:.2f}\n"
-                response += f"• Growth Rate: {data['growth_rate']:.1f}%\n"
-                response += f"• Predicted Usage: {data['predicted_usage']:.2f}\n"
-                response += f"• Recommendation: {data['recommendation']}\n\n"
+                response += f"*{resource.upper()}* ({data['series_count']} series, most at risk: `{data['series']}`)\n"
+                response += f"• Current Usage: {data['current_usage']:.2f}%\n"
+                response += f"• Growth Rate (7d): {data['growth_rate']:.1f}%\n"
+                response += f"• Predicted Usage (7d): {data['predicted_usage']:.2f}%\n"
+                response += f"• Time to Exhaustion: {data['time_to_exhaustion']}\n"
+                response += f"• Recommendation: {data['recommendation']}\n"
+                for series in data["at_risk"][1:]:
+                    response += f"    ◦ `{series['series']}`: {series['current_usage']:.1f}% now, full in {series['time_to_exhaustion']}\n"
+                response += "\n"
             
             respond(response)
         else:
@@ -436,6 +559,115 @@ def handle_ai_optimize(ack, body, command, respond, logger):
         logger.error(f"Error in AI optimization: {str(e)}")
         respond(f"❌ An error occurred: {str(e)}")
 
+@app.command("/incident-report")
+def handle_incident_report(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /incident-report command: {command}")
+    
+    namespace = command.get('text', '').strip() or "default"
+    submit_job("incident-report", {"namespace": namespace}, command, respond,
+               status=f":mag: Collecting incident data for `{namespace}` from Kubernetes, Docker and Jenkins...")
+
+def run_incident_report(payload, respond, progress):
+    namespace = payload["namespace"]
+    try:
+        progress("Collecting incident snapshot")
+        snapshot = incident_snapshot.collect_incident_snapshot(
+            namespace,
+            jenkins_client=jenkins_client,
+            core_v1_api=k8s_core_v1_api,
+            docker_client=docker_client
+        )
+        if not snapshot["sources"]:
+            respond(f"❌ Could not collect any incident data: {snapshot['errors']}")
+            return
+        
+        progress("Generating AI report")
+        result = ai_assistant.generate_incident_report(snapshot)
+        summary = incident_snapshot.format_snapshot_summary(snapshot)
+        if result["status"] == "success":
+            respond(f"📝 *Incident Report*\n{summary}\n\n{result['report']}")
+        else:
+            respond(f"❌ Error generating incident report: {result['report']}")
+    except Exception as e:
+        logger.error(f"Error in incident report: {str(e)}")
+        respond(f"❌ An error occurred: {str(e)}")
+
+@app.command("/alerts")
+def handle_alerts(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /alerts command: {command}")
+    
+    if not alert_engine:
+        respond("Alert rule evaluation is not enabled (check ALERT_RULES_FILE and the metric source).")
+        return
+    
+    try:
+        alerts = alert_engine.active_alerts()
+        response = f"*:bell: Alerts* ({len(alert_engine.rules)} rules)\n"
+        if not alerts:
+            response += "No firing or pending alerts.\n"
+        for alert in alerts[:20]:
+            icon = ":rotating_light:" if alert["state"] == "firing" else ":hourglass:"
+            since = datetime.fromtimestamp(alert["active_since"]).strftime("%Y-%m-%d %H:%M:%S")
+            response += f"{icon} *{alert['summary']}* ({alert['state']} since {since}, value {alert['value']:g})\n"
+        if len(alerts) > 20:
+            response += f"... and {len(alerts) - 20} more\n"
+        for rule, error in alert_engine.rule_errors().items():
+            response += f":warning: Rule `{rule}` failed to evaluate: {error}\n"
+        cycle = alert_engine.last_cycle
+        if cycle:
+            response += (f"\n_Last cycle: {cycle['rules']} rules, {cycle['queries']} queries, "
+                         f"{cycle['points']} points in {cycle['duration_s'] * 1000:.0f} ms_")
+        respond(response)
+    except Exception as e:
+        logger.error(f"Error listing alerts: {str(e)}")
+        respond(f"❌ An error occurred: {str(e)}")
+
+@app.command("/logs-grep")
+def handle_logs_grep(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /logs-grep command: {command}")
+
+    try:
+        options = log_grep.parse_grep_args(command.get('text', ''))
+    except ValueError as e:
+        respond(f"{e}\nUsage: /logs-grep <regex> [--source k8s|docker|jenkins] [--since 30m] "
+                f"[--namespace ns] [--max N] [--context N] [-i]")
+        return
+
+    since = time.time() - options["since"] if options["since"] else None
+    # With --since the time window bounds the read; otherwise only the tail of each log is searched
+    max_lines = None if since else log_grep.DEFAULT_TAIL_LINES
+    available = {}
+    if k8s_core_v1_api:
+        available["k8s"] = lambda: k8s_handler.get_log_streams(
+            k8s_core_v1_api, options["namespace"], max_lines, since)
+    if docker_client:
+        available["docker"] = lambda: docker_handler.get_log_streams(docker_client, max_lines=max_lines, since=since)
+    if jenkins_client:
+        available["jenkins"] = lambda: jenkins_handler.get_log_streams(
+            jenkins_client, max_lines=max_lines, since=since)
+    wanted = options["sources"] or list(available)
+    unknown = [name for name in wanted if name not in ("k8s", "docker", "jenkins")]
+    if unknown:
+        respond(f"Unknown source(s): {', '.join(unknown)}. Use k8s, docker or jenkins.")
+        return
+    sources = {name: available[name] for name in wanted if name in available}
+    if not sources:
+        respond(f"No client is available for {', '.join(wanted)}.")
+        return
+
+    try:
+        result = log_grep.grep_logs(sources, options["pattern"], options["ignore_case"],
+                                    options["max_matches"], options["context"])
+        respond(log_grep.format_grep_result(result))
+    except re.error as e:
+        respond(f"❌ Invalid regex `{options['pattern']}`: {e}")
+    except Exception as e:
+        logger.error(f"Error in logs-grep: {str(e)}")
+        respond(f"❌ An error occurred: {str(e)}")
+
 # Add a help command handler
 @app.command("/help")
 def handle_help_command(ack, body, command, respond, logger):
@@ -453,10 +685,38 @@ def handle_help_command(ack, body, command, respond, logger):
             "examples": [
                 "/ai-analyze-logs jenkins",
                 "/ai-analyze-logs k8s",
-                "/ai-analyze-logs docker"
+                "/ai-analyze-logs docker",
+                "/ai-analyze-logs all"
             ],
             "notes": "The AI will analyze logs for error patterns, performance issues, and security concerns."
         },
+        "incident-report": {
+            "description": "Collect failing pods, warning events, unhealthy containers, failed builds and logs, then generate an AI incident report",
+            "usage": "/incident-report [namespace]",
+            "examples": [
+                "/incident-report",
+                "/incident-report production"
+            ],
+            "notes": "Sources are collected in parallel under one deadline; slow sources are reported as timed out and the report uses the partial data."
+        },
+        "logs-grep": {
+            "description": "Search pod, container and Jenkins build logs for a regex, all sources at once",
+            "usage": "/logs-grep <regex> [--source k8s|docker|jenkins] [--since 30m] [--namespace ns] [--max N] [--context N] [-i]",
+            "examples": [
+                "/logs-grep OutOfMemory",
+                "/logs-grep \"connection (refused|reset)\" --source k8s,docker --since 1h",
+                "/logs-grep -i timeout --max 5 --context 5"
+            ],
+            "notes": "Logs are streamed concurrently and matched line by line; the search stops once --max matches (default 20) are found. Without --since, the last 5000 lines of each log are searched."
+        },
+        "alerts": {
+            "description": "Show firing and pending alerts evaluated by the bot from the rules in alertmanager.yml",
+            "usage": "/alerts",
+            "examples": [
+                "/alerts"
+            ],
+            "notes": "Rules are evaluated every ALERT_EVAL_INTERVAL seconds (default 30). Firing and resolved alerts are posted to ALERT_SLACK_CHANNEL or the channel of the Slack receiver."
+        },
         "jenkins-trigger": {
             "description": "Trigger a Jenkins job with optional parameters",
             "usage": "/jenkins-trigger <job_name> [param1=value1 param2=value2 ...]",
@@ -492,6 +752,30 @@ def handle_help_command(ack, body, command, respond, logger):
             ],
             "notes": "This will deploy the specified Docker image."
         },
+        "jobs": {
+            "description": "List queued and running jobs, then the most recently finished ones",
+            "usage": "/jobs",
+            "examples": [
+                "/jobs"
+            ],
+            "notes": "/docker-deploy, /deploy-website, /scale-website, /build-website, /test-website, /website-loadtest, /pipeline, /docker-gc, /ai-analyze-logs and /incident-report run as jobs, so they survive a bot restart and report progress."
+        },
+        "job-status": {
+            "description": "Show a job's state, attempts, last error and latest progress steps",
+            "usage": "/job-status <job_id>",
+            "examples": [
+                "/job-status 42"
+            ],
+            "notes": "The job ID is in the reply to the command that queued it. Failed deploy attempts are retried with backoff."
+        },
+        "job-cancel": {
+            "description": "Cancel a queued or running job",
+            "usage": "/job-cancel <job_id>",
+            "examples": [
+                "/job-cancel 42"
+            ],
+            "notes": "Queued jobs are cancelled at once; running ones stop at their next progress step."
+        },
         "k8s-pods": {
             "description": "List pods in a Kubernetes namespace",
             "usage": "/k8s-pods [namespace]",
@@ -536,36 +820,61 @@ def handle_docker_deploy_command(ack, body, command, respond, logger):
         respond("Sorry, Docker connection failed. Check logs.")
         return
     
+    # Pull, replace and run are safe to repeat, so transient Docker errors are retried
+    submit_job("docker-deploy", {"image": image_name}, command, respond,
+               status=f":whale: Deploying {image_name}...", summary=f"docker-deploy {image_name}", max_attempts=3)
+
+def run_docker_deploy(payload, respond, progress):
+    image_name = payload["image"]
+    # Pull the image if it doesn't exist locally; the running container keeps serving meanwhile
     try:
-        # Pull the image if it doesn't exist locally
-        try:
-            docker_client.images.get(image_name)
-        except docker.errors.ImageNotFound:
-            logger.info(f"Image {image_name} not found locally, pulling...")
-            docker_client.images.pull(image_name)
-        
-        # Stop and remove existing container if it exists
-        container_name = f"{image_name}-container"
+        docker_client.images.get(image_name)
+    except docker.errors.ImageNotFound:
+        logger.info(f"Image {image_name} not found locally, pulling...")
+        progress(f"Pulling {image_name}")
         try:
-            existing_container = docker_client.containers.get(container_name)
-            logger.info(f"Stopping and removing existing container: {container_name}")
-            existing_container.stop()
-            existing_container.remove()
-        except docker.errors.NotFound:
-            pass  # Container doesn't exist, which is fine
-        
-        # Run the container
-        container = docker_client.containers.run(
-            image_name,
-            detach=True,
-            ports={'80/tcp': 80},  # Map container port 80 to host port 80
-            name=container_name
-        )
-        
-        respond(f"✅ Successfully deployed {image_name} container. Container ID: {container.id}")
-    except Exception as e:
-        logger.error(f"Error deploying Docker container: {str(e)}")
-        respond(f"❌ Error deploying container: {str(e)}")
+            docker_handler.pull_image(docker_client, image_name, progress)
+        except docker.errors.NotFound as e:
+            raise JobFailed(f"Image {image_name} not found: {e}")
+    
+    # Start the new container, switch port 80 to it once it answers, then retire the old one.
+    # The app is named after the repository, so a new tag replaces the running version.
+    repository = docker.utils.parse_repository_tag(image_name)[0]
+    result = blue_green.deploy(docker_client, repository, image_name, public_port=80, progress=progress)
+    if not result["success"]:
+        raise JobFailed(blue_green.format_deploy_result(result))
+    respond(f"✅ Successfully deployed {image_name}: {blue_green.format_deploy_result(result)}")
+    return result["container"]
+
+@app.command("/docker-gc")
+def handle_docker_gc(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /docker-gc command: {command}")
+    if not docker_client:
+        respond("Sorry, Docker connection failed. Check logs.")
+        return
+    # /docker-gc [dry-run] [target=SIZE]
+    payload = {"dry_run": False, "target": None}
+    try:
+        for token in command.get('text', '').split():
+            if token == "dry-run":
+                payload["dry_run"] = True
+            elif token.startswith("target="):
+                payload["target"] = docker_handler.parse_size(token.split("=", 1)[1])
+            else:
+                raise ValueError(token)
+    except ValueError:
+        respond("Usage: `/docker-gc [dry-run] [target=20GB]`")
+        return
+    submit_job("docker-gc", payload, command, respond, status=":wastebasket: Collecting unused images...",
+               summary="docker-gc" + (" dry-run" if payload["dry_run"] else ""))
+
+def run_docker_gc(payload, respond, progress):
+    report = docker_handler.collect_images(docker_client, target=payload["target"], dry_run=payload["dry_run"],
+                                           progress=progress)
+    message = docker_handler.format_gc_report(report)
+    respond(f"{'🧪' if report['dry_run'] else '✅'} {message}")
+    return message
 
 @app.command("/jenkins-deploy")
 def handle_jenkins_deploy_command(ack, body, command, respond, logger):
@@ -597,21 +906,216 @@ def handle_deploy_website(ack, body, command, respond, logger):
     ack()
     logger.info(f"Received /deploy-website command: {command}")
     
+    # /deploy-website [name] [replicas=N|auto]; the name defaults to "my-website"
+    website_name, replicas = "my-website", None
+    for token in command.get('text', '').split():
+        if token.startswith("replicas="):
+            replicas = token.split("=", 1)[1]
+            if not (replicas.isdigit() or replicas == "auto"):
+                respond("Usage: `/deploy-website [name] [replicas=N|auto]`")
+                return
+        else:
+            website_name = token
+    submit_job("deploy-website", {"website": website_name, "replicas": replicas}, command, respond,
+               status=f":globe_with_meridians: Deploying website {website_name}...",
+               summary=f"deploy-website {website_name}", max_attempts=2)
+
+def run_deploy_website(payload, respond, progress):
+    success, message = website_handler.deploy_website(payload["website"], progress=progress,
+                                                      replicas=payload.get("replicas"))
+    if not success:
+        raise JobFailed(message.lstrip("❌ "))
+    respond(message)
+    return message
+
+@app.command("/scale-website")
+def handle_scale_website(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /scale-website command: {command}")
+    args = command.get('text', '').split()
+    if not args or not (args[-1].isdigit() or args[-1] == "auto") or len(args) > 2:
+        respond("Usage: `/scale-website [name] <replicas|auto>`")
+        return
+    website_name = args[0] if len(args) == 2 else "my-website"
+    submit_job("scale-website", {"website": website_name, "replicas": args[-1]}, command, respond,
+               status=f":left_right_arrow: Scaling {website_name} to {args[-1]} replicas...",
+               summary=f"scale-website {website_name} {args[-1]}")
+
+def run_scale_website(payload, respond, progress):
+    success, message = website_handler.scale_website(payload["website"], payload["replicas"], progress=progress)
+    if not success:
+        raise JobFailed(message.lstrip("❌ "))
+    respond(message)
+    return message
+
+@app.command("/build-website")
+def handle_build_website(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /build-website command: {command}")
+    submit_job("build-website", {}, command, respond, status=":hammer: Building the website image...",
+               summary="build-website", max_attempts=2)
+
+def run_build_website(payload, respond, progress):
+    success, message = website_handler.build_website(progress=progress)
+    if not success:
+        raise JobFailed(message)
+    respond(f"✅ {message}")
+    return message
+
+@app.command("/test-website")
+def handle_test_website(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /test-website command: {command}")
+    image = command.get('text', '').strip() or "chatops-website:latest"
+    submit_job("test-website", {"image": image}, command, respond,
+               status=f":test_tube: Testing {image}...", summary=f"test-website {image}")
+
+def run_test_website(payload, respond, progress):
+    success, message = website_handler.test_website(payload["image"], progress=progress)
+    if not success:
+        raise JobFailed(message)
+    respond(f"✅ Website tests of {payload['image']} {message}")
+    return message
+
+WEBSITE_LOADTEST_USAGE = ("Usage: `/website-loadtest [name] [closed users=10 | open rps=100] [duration=10] "
+                          "[connections=N] [no-keepalive]`")
+
+@app.command("/website-loadtest")
+def handle_website_loadtest(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /website-loadtest command: {command}")
+    payload = {"website": "my-website", "options": {}}
+    options = payload["options"]
     try:
-        # Get website name from command text, default to "my-website" if not provided
-        website_name = command.get('text', '').strip() or "my-website"
-        
-        # Deploy the website
-        success, message = website_handler.deploy_website(website_name)
-        
-        if success:
-            respond(message)
+        for token in command.get('text', '').split():
+            key, _, value = token.partition("=")
+            if token in ("open", "closed"):
+                options["mode"] = token
+            elif token == "no-keepalive":
+                options["keep_alive"] = False
+            elif key == "rps":
+                options["rps"] = float(value)
+            elif key in ("users", "concurrency"):
+                options["concurrency"] = int(value)
+            elif key == "duration":
+                options["duration"] = float(value.rstrip("s"))
+            elif key == "connections":
+                options["connections"] = int(value)
+            elif not value:
+                payload["website"] = token
+            else:
+                raise ValueError(token)
+    except ValueError:
+        respond(WEBSITE_LOADTEST_USAGE)
+        return
+    if options.get("mode") == "open" and not options.get("rps"):
+        respond("Open-loop tests need a rate, e.g. `open rps=100`.\n" + WEBSITE_LOADTEST_USAGE)
+        return
+    submit_job("website-loadtest", payload, command, respond,
+               status=f":chart_with_upwards_trend: Load testing {payload['website']}...",
+               summary=f"website-loadtest {payload['website']}")
+
+def run_website_loadtest(payload, respond, progress):
+    success, message = website_handler.load_test(payload["website"], progress=progress, **payload["options"])
+    if not success:
+        raise JobFailed(message.lstrip("❌ "))
+    respond(message)
+    return message
+
+@app.command("/pipeline")
+def handle_pipeline(ack, body, command, respond, logger):
+    ack()
+    logger.info(f"Received /pipeline command: {command}")
+    # /pipeline [name] [deploy] [force] [replicas=N|auto]
+    payload = {"website": "my-website", "deploy": False, "force": False, "replicas": None}
+    for token in command.get('text', '').split():
+        if token in ("deploy", "force"):
+            payload[token] = True
+        elif token.startswith("replicas="):
+            payload["replicas"] = token.split("=", 1)[1]
+            if not (payload["replicas"].isdigit() or payload["replicas"] == "auto"):
+                respond("Usage: `/pipeline [name] [deploy] [force] [replicas=N|auto]`")
+                return
         else:
-            respond(f"❌ {message}")
-            
-    except Exception as e:
-        logger.error(f"Error in deploy-website command: {str(e)}", exc_info=True)
-        respond(f"❌ An error occurred while deploying the website: {str(e)}")
+            payload["website"] = token
+    submit_job("pipeline", payload, command, respond,
+               status=f":building_construction: Running the {payload['website']} pipeline...",
+               summary=f"pipeline {payload['website']}" + (" deploy" if payload["deploy"] else ""))
+
+def run_pipeline(payload, respond, progress):
+    success, message = website_handler.run_pipeline(payload["website"], deploy=payload["deploy"],
+                                                    replicas=payload["replicas"], force=payload["force"],
+                                                    progress=progress)
+    if not success:
+        raise JobFailed(message.lstrip("❌ "))
+    respond(message)
+    return message
+
+@app.command("/job-status")
+def handle_job_status(ack, body, command, respond, logger):
+    ack()
+    text = command.get('text', '').strip().lstrip('#')
+    if not job_queue:
+        respond("The job queue is disabled (JOB_QUEUE_ENABLED=false).")
+        return
+    if not text.isdigit():
+        respond("Usage: `/job-status <job_id>` (see `/jobs` for recent jobs)")
+        return
+    job = job_queue.get(int(text))
+    if not job:
+        respond(f"No job #{text}.")
+        return
+    respond(format_job_status(job, job_queue.events(job.id)))
+
+@app.command("/jobs")
+def handle_jobs(ack, body, command, respond, logger):
+    ack()
+    if not job_queue:
+        respond("The job queue is disabled (JOB_QUEUE_ENABLED=false).")
+        return
+    jobs = job_queue.list_jobs(limit=15)
+    if not jobs:
+        respond("No jobs yet.")
+        return
+    counts = job_queue.counts()
+    header = (f"*Jobs:* {counts.get('running', 0)} running, {counts.get('queued', 0)} queued "
+              "(`/job-status <id>` for details, `/job-cancel <id>` to cancel)")
+    respond(header + "\n" + "\n".join(format_job_line(job) for job in jobs))
+
+@app.command("/job-cancel")
+def handle_job_cancel(ack, body, command, respond, logger):
+    ack()
+    text = command.get('text', '').strip().lstrip('#')
+    if not job_queue:
+        respond("The job queue is disabled (JOB_QUEUE_ENABLED=false).")
+        return
+    if not text.isdigit():
+        respond("Usage: `/job-cancel <job_id>`")
+        return
+    state = job_queue.cancel(int(text), by=command.get("user_name") or command.get("user_id", ""))
+    if state is None:
+        respond(f"No job #{text}.")
+    elif state == "cancelled":
+        respond(f":no_entry_sign: Job #{text} cancelled before it started.")
+    elif state == "cancelling":
+        respond(f":hourglass: Job #{text} is running; it stops at its next step.")
+    else:
+        respond(f"Job #{text} already {state}.")
+
+# Job kinds the job workers run: handler(payload, respond, progress). progress(message)
+# records a step for /job-status and raises JobCancelled once the job is cancelled.
+JOB_HANDLERS = {
+    "ai-analyze-logs": run_ai_analyze_logs,
+    "incident-report": run_incident_report,
+    "docker-deploy": run_docker_deploy,
+    "deploy-website": run_deploy_website,
+    "scale-website": run_scale_website,
+    "build-website": run_build_website,
+    "test-website": run_test_website,
+    "website-loadtest": run_website_loadtest,
+    "pipeline": run_pipeline,
+    "docker-gc": run_docker_gc,
+}
 
 # === Main Execution Block for Socket Mode ===
 if __name__ == "__main__":
@@ -623,6 +1127,27 @@ if __name__ == "__main__":
     if not docker_client:
          print("\nWARNING: Docker client not initialized. Docker commands will fail.\n")
 
+    bot_metrics.start_metrics_server()
+    if metric_sampler:
+        metric_sampler.start()
+    # Alerts are evaluated and posted once per host, by the leader of a bot_cluster
+    if alert_engine and bot_cluster.is_leader():
+        alert_engine.start()
+    # Images are collected once per host too
+    image_gc = docker_handler.get_image_gc(docker_client)
+    if image_gc and bot_cluster.is_leader():
+        image_gc.start()
+    profiler = get_profiler()
+    if profiler:
+        profiler.start()
+    log_shipper = get_log_shipper()
+    if log_shipper:
+        log_shipper.start()
+    if job_queue:
+        job_worker = JobWorker(job_queue, {kind: run_job for kind in JOB_HANDLERS},
+                               threads=int(os.environ.get("JOB_WORKER_THREADS", "2")))
+        job_worker.start()
+
     # Start Socket Mode handler
     # Ensure SLACK_APP_TOKEN (xapp-...) is in your .env file
     app_token = os.environ.get("SLACK_APP_TOKEN")
@@ -0,0 +1,447 @@
+# asset_pipeline.py
+"""
+Static asset optimization for the website image.
+
+Turns the website source directory into a ready-to-build nginx context:
+
+- images are downscaled to ASSET_MAX_IMAGE_WIDTH, recompressed, and given a
+  WebP variant that pages offer through <picture>
+- CSS, JS and other text assets get gzip (and, when the `brotli` package is
+  installed, brotli) variants for nginx's *_static modules
+- everything except HTML is renamed to `<name>.<content hash>.<ext>` and
+  references in HTML and CSS are rewritten, so those files can be cached for
+  a year while pages are revalidated on every load
+- the site is written to html/, with a matching nginx.conf and a Dockerfile
+  that copies both beside it
+
+Every output is stored under BUILD_CACHE_DIR/assets keyed by the hash of its
+input and settings, so a rebuild only re-encodes files that changed. Each
+run reports the page weight (the page plus everything it references) before
+and after.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import shutil
+import time
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import build_context
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_VERSION = 1
+HASH_LENGTH = 10
+# Subdirectory of the build context holding the web root; nginx.conf and the
+# Dockerfile sit beside it so they are never served
+SITE_ROOT = "html"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+HTML_EXTENSIONS = {".html", ".htm"}
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".mjs", ".svg", ".json", ".txt", ".xml", ".map", ".ico"}
+# Not worth a compressed variant
+MIN_COMPRESS_SIZE = 256
+
+ATTR_RE = re.compile(r"""(\b(?:src|href|poster)\s*=\s*)(["'])([^"']*)\2""", re.IGNORECASE)
+CSS_URL_RE = re.compile(r"""url\(\s*(["']?)([^"')]+)\1\s*\)""")
+IMG_RE = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+IMG_SRC_RE = re.compile(r"""(\bsrc\s*=\s*)(["'])([^"']*)\2""", re.IGNORECASE)
+
+NGINX_CONF = """server {{
+    listen 80;
+    server_name localhost;
+    root /usr/share/nginx/html;
+    index index.html;
+
+    # Serve the precompressed variants written next to each asset
+    gzip_static on;
+    gzip_vary on;
+{brotli}
+    # Content-hashed names never change content
+    location ~* "\\.[0-9a-f]{{{hash_length}}}\\.[a-z0-9]+$" {{
+        add_header Cache-Control "public, max-age=31536000, immutable";
+        try_files $uri =404;
+    }}
+
+    location / {{
+        try_files $uri $uri/ /index.html;
+        add_header Cache-Control "no-cache";
+    }}
+}}
+"""
+
+DOCKERFILE = """FROM {image}
+COPY nginx.conf /etc/nginx/conf.d/default.conf
+COPY {site_root}/ /usr/share/nginx/html/
+EXPOSE 80
+CMD ["nginx", "-g", "daemon off;"]
+"""
+
+
+def enabled() -> bool:
+    return os.environ.get("ASSET_PIPELINE_ENABLED", "true").lower() not in ("0", "false", "no")
+
+
+def _settings() -> Dict[str, Any]:
+    return {
+        "max_width": int(os.environ.get("ASSET_MAX_IMAGE_WIDTH", "400")),
+        "jpeg_quality": int(os.environ.get("ASSET_JPEG_QUALITY", "82")),
+        "webp_quality": int(os.environ.get("ASSET_WEBP_QUALITY", "80")),
+        # brotli_static needs an nginx built with ngx_brotli (see WEBSITE_NGINX_IMAGE)
+        "serve_brotli": brotli is not None and
+                        os.environ.get("WEBSITE_NGINX_BROTLI", "false").lower() in ("1", "true", "yes"),
+        "nginx_image": os.environ.get("WEBSITE_NGINX_IMAGE", "nginx:alpine"),
+    }
+
+
+def _cache_root() -> str:
+    return os.path.join(os.environ.get("BUILD_CACHE_DIR", ".build_cache"), "assets")
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hashed_name(rel: str, data: bytes, ext: Optional[str] = None) -> str:
+    stem, original_ext = posixpath.splitext(rel)
+    return f"{stem}.{_digest(data)[:HASH_LENGTH]}{ext or original_ext}"
+
+
+class _Cache:
+    """Encoded outputs stored by input key, one directory per key."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key: str, build: Callable[[], Dict[str, bytes]]) -> Dict[str, str]:
+        """Paths of the cached outputs for `key`, running `build()` (variant -> bytes) on a miss."""
+        directory = os.path.join(_cache_root(), key[:2], key)
+        if os.path.isdir(directory):
+            self.hits += 1
+            return {name: os.path.join(directory, name) for name in os.listdir(directory)}
+        self.misses += 1
+        outputs = build()
+        tmp = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for name, data in outputs.items():
+            with open(os.path.join(tmp, name), "wb") as f:
+                f.write(data)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            # Another process stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+        return {name: os.path.join(directory, name) for name in outputs}
+
+
+def _encode_image(data: bytes, ext: str, settings: Dict[str, Any]) -> Dict[str, bytes]:
+    if Image is None:
+        return {"image": data}
+    with Image.open(BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.width > settings["max_width"]:
+            height = round(image.height * settings["max_width"] / image.width)
+            image = image.resize((settings["max_width"], height), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        buffer = BytesIO()
+        if ext in (".jpg", ".jpeg"):
+            image.convert("RGB").save(buffer, "JPEG", quality=settings["jpeg_quality"],
+                                      optimize=True, progressive=True)
+        else:
+            image.save(buffer, "PNG", optimize=True)
+        fallback = buffer.getvalue()
+        buffer = BytesIO()
+        image.save(buffer, "WEBP", quality=settings["webp_quality"], method=6)
+        webp = buffer.getvalue()
+    # Never ship something larger than the source
+    outputs = {"image": fallback if len(fallback) < len(data) else data}
+    if len(webp) < len(outputs["image"]):
+        outputs["image.webp"] = webp
+    return outputs
+
+
+def _compress(data: bytes) -> Dict[str, bytes]:
+    outputs = {"data": data}
+    if len(data) < MIN_COMPRESS_SIZE:
+        return outputs
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        outputs["data.gz"] = gz
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            outputs["data.br"] = br
+    return outputs
+
+
+def _resolve(base: str, url: str) -> Optional[Tuple[str, str, bool]]:
+    """(context path, query/fragment suffix, root-relative) of a local reference in `base`, else None."""
+    if not url or url.startswith(("#", "//", "data:")) or re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*:", url):
+        return None
+    path, suffix = re.match(r"^([^?#]*)(.*)$", url).groups()
+    if not path:
+        return None
+    if path.startswith("/"):
+        return posixpath.normpath(path.lstrip("/")), suffix, True
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), path)), suffix, False
+
+
+def _url(base: str, target: str, suffix: str, rooted: bool) -> str:
+    if rooted:
+        return "/" + target + suffix
+    return posixpath.relpath(target, posixpath.dirname(base) or ".") + suffix
+
+
+def _rewrite(base: str, text: str, names: Dict[str, str], pattern: "re.Pattern", group: int) -> Tuple[str, List[str]]:
+    """Replaces references matched by `pattern` with hashed names; also returns the paths referenced."""
+    referenced = []
+
+    def replace(match):
+        resolved = _resolve(base, match.group(group))
+        if resolved is None or resolved[0] not in names:
+            return match.group(0)
+        referenced.append(resolved[0])
+        start, end = match.span(group)
+        value = _url(base, names[resolved[0]], resolved[1], resolved[2])
+        return match.group(0)[:start - match.start()] + value + match.group(0)[end - match.start():]
+
+    return pattern.sub(replace, text), referenced
+
+
+def _rewrite_html(base: str, text: str, names: Dict[str, str], webp: Dict[str, str]) -> Tuple[str, List[str]]:
+    def picture(match):
+        tag = match.group(0)
+        src = IMG_SRC_RE.search(tag)
+        resolved = _resolve(base, src.group(3)) if src else None
+        if resolved is None or resolved[0] not in webp:
+            return tag
+        # Already inside a <picture>: leave the author's sources alone
+        before = text[:match.start()].lower()
+        if before.rfind("<picture") > before.rfind("</picture"):
+            return tag
+        return (f'<picture><source srcset="{_url(base, webp[resolved[0]], resolved[1], resolved[2])}" '
+                f'type="image/webp">{tag}</picture>')
+
+    text = IMG_RE.sub(picture, text)
+    return _rewrite(base, text, names, ATTR_RE, 3)
+
+
+def _install(paths: Dict[str, str], variant: str, out: str, rel: str, compressed: bool = False):
+    """Copies a cached output (and its .gz/.br siblings) to `rel` under `out`, keeping mtimes."""
+    target = os.path.join(out, *rel.split("/"))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(paths[variant], target)
+    if compressed:
+        for ext in (".gz", ".br"):
+            if variant + ext in paths:
+                shutil.copy2(paths[variant + ext], target + ext)
+
+
+def _served_size(paths: Dict[str, str], variant: str, settings: Dict[str, Any]) -> int:
+    """Bytes a browser that accepts WebP and gzip (and br, if nginx serves it) downloads."""
+    choices = [variant, variant + ".gz"] + ([variant + ".br"] if settings["serve_brotli"] else [])
+    return min(os.path.getsize(paths[name]) for name in choices if name in paths)
+
+
+def run(source: str, out: str, progress: Optional[Callable[[str], None]] = None,
+        excludes: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    Optimizes the site at `source` into the build context `out` (replaced
+    atomically), the site itself under `out`/SITE_ROOT. Source files are the
+    ones build_context would send, minus the source's own Dockerfile and
+    .dockerignore. Returns the report.
+    """
+    progress = progress or (lambda message: None)
+    t0 = time.monotonic()
+    settings = _settings()
+    cache = _Cache()
+    entries, _ = build_context.walk_context(source, excludes=excludes)
+    files = {entry.rel: entry for entry in entries
+             if entry.rel not in ("Dockerfile", ".dockerignore") and not entry.rel.endswith((".gz", ".br"))}
+    staging = f"{out.rstrip(os.sep)}.{os.getpid()}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    site = os.path.join(staging, SITE_ROOT)
+    os.makedirs(site)
+
+    names: Dict[str, str] = {}      # source path -> output path
+    webp: Dict[str, str] = {}       # source image -> WebP output path
+    served: Dict[str, int] = {}     # source path -> bytes served
+    refs: Dict[str, List[str]] = {}
+    settings_key = f"{PIPELINE_VERSION}|{settings['max_width']}|{settings['jpeg_quality']}|{settings['webp_quality']}"
+
+    def read(rel):
+        with open(files[rel].full, "rb") as f:
+            return f.read()
+
+    def ext_of(rel):
+        return posixpath.splitext(rel)[1].lower()
+
+    images = [rel for rel in files if ext_of(rel) in IMAGE_EXTENSIONS and not os.path.islink(files[rel].full)]
+    if images:
+        progress(f"Optimizing {len(images)} images")
+    for rel in images:
+        data = read(rel)
+        ext = ext_of(rel)
+        try:
+            paths = cache.get_or_build(_digest(f"image|{settings_key}|{ext}|".encode() + data),
+                                       lambda: _encode_image(data, ext, settings))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not optimize {rel}, shipping it unchanged: {e}")
+            paths = cache.get_or_build(_digest(b"raw|" + data), lambda: {"image": data})
+        with open(paths["image"], "rb") as f:
+            names[rel] = _hashed_name(rel, f.read())
+        _install(paths, "image", site, names[rel])
+        served[rel] = os.path.getsize(paths["image"])
+        if "image.webp" in paths:
+            with open(paths["image.webp"], "rb") as f:
+                webp[rel] = _hashed_name(rel, f.read(), ".webp")
+            _install(paths, "image.webp", site, webp[rel])
+            served[rel] = min(served[rel], os.path.getsize(paths["image.webp"]))
+
+    # Stylesheets point at images (and each other), so they are hashed after what they reference
+    others = sorted((rel for rel in files if rel not in names and ext_of(rel) not in HTML_EXTENSIONS),
+                    key=lambda rel: ext_of(rel) == ".css")
+    for rel in others:
+        data = read(rel)
+        if ext_of(rel) == ".css":
+            text, refs[rel] = _rewrite(rel, data.decode("utf-8", "surrogateescape"), names, CSS_URL_RE, 2)
+            data = text.encode("utf-8", "surrogateescape")
+        compress = ext_of(rel) in COMPRESSIBLE_EXTENSIONS
+        paths = cache.get_or_build(_digest(f"text|{PIPELINE_VERSION}|{compress}|".encode() + data),
+                                   (lambda: _compress(data)) if compress else (lambda: {"data": data}))
+        names[rel] = _hashed_name(rel, data)
+        _install(paths, "data", site, names[rel], compressed=True)
+        served[rel] = _served_size(paths, "data", settings)
+
+    pages = []
+    for rel in sorted(rel for rel in files if ext_of(rel) in HTML_EXTENSIONS):
+        text, refs[rel] = _rewrite_html(rel, read(rel).decode("utf-8", "surrogateescape"), names, webp)
+        data = text.encode("utf-8", "surrogateescape")
+        paths = cache.get_or_build(_digest(f"text|{PIPELINE_VERSION}|True|".encode() + data), lambda: _compress(data))
+        _install(paths, "data", site, rel, compressed=True)
+        served[rel] = _served_size(paths, "data", settings)
+        pages.append(rel)
+
+    brotli_line = "    brotli_static on;\n" if settings["serve_brotli"] else ""
+    for name, content in (("nginx.conf", NGINX_CONF.format(brotli=brotli_line, hash_length=HASH_LENGTH)),
+                          ("Dockerfile", DOCKERFILE.format(image=settings["nginx_image"], site_root=SITE_ROOT))):
+        with open(os.path.join(staging, name), "w") as f:
+            f.write(content)
+
+    shutil.rmtree(out, ignore_errors=True)
+    os.rename(staging, out)
+
+    def weight(rel, sizes, seen):
+        if rel in seen or rel not in sizes:
+            return 0
+        seen.add(rel)
+        return sizes[rel] + sum(weight(ref, sizes, seen) for ref in refs.get(rel, []))
+
+    original = {rel: entry.st.st_size for rel, entry in files.items()}
+    page_weights = [{"page": rel, "before": weight(rel, original, set()), "after": weight(rel, served, set())}
+                    for rel in pages]
+    report = {"files": len(files), "encoded": cache.misses, "cached": cache.hits, "webp": len(webp),
+              "brotli": settings["serve_brotli"], "seconds": round(time.monotonic() - t0, 2),
+              "pages": page_weights, "before": sum(original.values()), "after": sum(served.values())}
+    logger.info(f"Asset pipeline for {source}: {format_asset_report(report)}")
+    return report
+
+
+def format_asset_report(report: Dict[str, Any]) -> str:
+    size = build_context.format_size
+    lines = [f"{report['files']} assets in {report['seconds']:.2f}s ({report['encoded']} encoded, "
+             f"{report['cached']} from cache, {report['webp']} WebP variants)"]
+    for page in report["pages"]:
+        saved = 1 - page["after"] / page["before"] if page["before"] else 0
+        lines.append(f"page weight of {page['page']}: {size(page['before'])} -> {size(page['after'])} "
+                     f"({saved:.0%} smaller)")
+    return "; ".join(lines)
+
+
+if __name__ == "__main__":
+    import shlex
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+    failures = []
+
+    def check(condition: bool, message: str):
+        logger.info(f"{'ok  ' if condition else 'FAIL'} {message}")
+        if not condition:
+            failures.append(message)
+
+    def copy_sources(dockerfile: str) -> List[str]:
+        """Context paths the Dockerfile's COPY/ADD instructions read (COPY --from excluded)."""
+        sources = []
+        for line in dockerfile.splitlines():
+            words = shlex.split(line)
+            if len(words) < 3 or words[0].upper() not in ("COPY", "ADD"):
+                continue
+            if any(word.startswith("--from=") for word in words):
+                continue
+            sources += [word for word in words[1:-1] if not word.startswith("--")]
+        return sources
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["BUILD_CACHE_DIR"] = os.path.join(tmp, "cache")
+        source, out = os.path.join(tmp, "website"), os.path.join(tmp, "website", "build", "site")
+        os.makedirs(os.path.join(source, "css"))
+        with open(os.path.join(source, "index.html"), "w") as f:
+            f.write('<html><head><link rel="stylesheet" href="css/site.css"></head>'
+                    '<body><img src="logo.png" alt="logo"><a href="about.html">About</a></body></html>')
+        with open(os.path.join(source, "about.html"), "w") as f:
+            f.write('<html><body><a href="index.html">Home</a></body></html>')
+        with open(os.path.join(source, "css", "site.css"), "w") as f:
+            f.write("body { background: url(../logo.png); }\n" * 20)
+        # A source .dockerignore and Dockerfile must not leak into the generated context
+        with open(os.path.join(source, "Dockerfile"), "w") as f:
+            f.write("FROM scratch\n")
+        with open(os.path.join(source, ".dockerignore"), "w") as f:
+            f.write("build\n")
+        if Image is not None:
+            Image.new("RGB", (800, 600), (200, 30, 30)).save(os.path.join(source, "logo.png"))
+        else:
+            with open(os.path.join(source, "logo.png"), "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n")
+
+        report = run(source, out, excludes=("build",))
+        entries, _ = build_context.walk_context(out)
+        sent = {entry.rel for entry in entries}
+        with open(os.path.join(out, "Dockerfile")) as f:
+            sources = copy_sources(f.read())
+        check(sources == ["nginx.conf", f"{SITE_ROOT}/"], f"Dockerfile copies {sources}")
+        for src in sources:
+            prefix = src.rstrip("/")
+            check(any(rel == prefix or rel.startswith(prefix + "/") for rel in sent),
+                  f"COPY source {src} is in the build context")
+        site = sorted(rel[len(SITE_ROOT) + 1:] for rel in sent if rel.startswith(SITE_ROOT + "/"))
+        check("index.html" in site and "about.html" in site, "pages are in the web root")
+        check(not {"nginx.conf", "Dockerfile", ".dockerignore"} & set(site), "build files are not served")
+        with open(os.path.join(out, SITE_ROOT, "index.html")) as f:
+            refs = [ref for ref in ATTR_RE.findall(f.read()) if not ref[2].startswith(("http:", "https:"))]
+        check(all(posixpath.normpath(ref[2]) in site for ref in refs), "rewritten references resolve in the web root")
+        check(report["files"] == 4 and report["pages"], f"report covers the site: {format_asset_report(report)}")
+
+        again = run(source, out, excludes=("build",))
+        check(again["encoded"] == 0, f"unchanged rebuild is served from the cache ({again['cached']} cached)")
+
+    if failures:
+        logger.error(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    logger.info("All checks passed")
@@ -0,0 +1,520 @@
+# blue_green.py
+"""
+Zero-downtime container replacement for /docker-deploy and /deploy-website.
+
+Each app is served by a small nginx router container (`<app>-proxy`) that owns
+the public port and proxies to one of two app containers, `<app>-blue` or
+`<app>-green`, on a private Docker network. A deploy starts the new image
+under the idle color, waits until it answers HTTP, points the router at it
+with a graceful `nginx -s reload` (open connections finish on the old
+workers) and only then retires the old color. If the new container does not
+become ready, or the router cannot serve through it, the router keeps (or
+goes back to) the old color and the new container is removed.
+
+A color can be several replicas (`<app>-<color>`, `<app>-<color>-2`, ...):
+the router balances them over keep-alive upstream connections, takes a
+failing replica out for a few seconds and retries idempotent requests on
+another one. `scale()` changes the replica count of the running version
+in place: new replicas join the upstream only once they answer, and
+removed ones leave it (graceful reload) before they are stopped.
+
+A prober polls the public URL for the whole deploy, so each deploy reports
+the downtime it actually caused. The previous stop-then-start behaviour is
+kept as the "recreate" strategy and measured the same way.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import docker
+import requests
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("bluegreen", "recreate")
+ROUTER_IMAGE = os.environ.get("DEPLOY_ROUTER_IMAGE", "nginx:alpine")
+ROUTER_CONF = "/etc/nginx/conf.d/default.conf"
+READY_TIMEOUT = float(os.environ.get("DEPLOY_READY_TIMEOUT", "60"))
+READY_PATH = os.environ.get("DEPLOY_READY_PATH", "/")
+# Time the old color keeps running after the switch, for requests still in flight
+DRAIN_SECONDS = float(os.environ.get("DEPLOY_DRAIN_SECONDS", "5"))
+# Host the bot reaches published ports on, for the downtime prober
+PROBE_HOST = os.environ.get("DEPLOY_PROBE_HOST", "localhost")
+PROBE_INTERVAL = 0.1
+
+_NAME_UNSAFE_RE = re.compile(r"[^a-zA-Z0-9_.-]+")
+
+# Requests on an upstream that errors are retried on another replica, and
+# the replica is skipped for fail_timeout after max_fails failures
+_ROUTER_TEMPLATE = """upstream app {{
+{servers}
+    keepalive {keepalive};
+}}
+server {{
+    listen 80;
+    location / {{
+        proxy_pass http://app;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header Host $host;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_connect_timeout 2s;
+        proxy_next_upstream error timeout http_502 http_503 http_504;
+        proxy_next_upstream_tries 3;
+    }}
+}}
+"""
+_ROUTER_SERVER = "    server {backend}:{port} max_fails=2 fail_timeout=5s;"
+# The config is written from $CONF on first start only; later switches rewrite the file in place
+_ROUTER_COMMAND = ["sh", "-c", f'[ -f {ROUTER_CONF}.managed ] || {{ printf "%s" "$CONF" > {ROUTER_CONF} '
+                               f'&& touch {ROUTER_CONF}.managed; }}; exec nginx -g "daemon off;"']
+_BACKEND_RE = re.compile(r"^\s*server ([\w.-]+):\d+\b", re.MULTILINE)
+MAX_REPLICAS = int(os.environ.get("DEPLOY_MAX_REPLICAS", "16"))
+
+
+def app_name(image_or_name: str) -> str:
+    """A container-name-safe app name ("nginx:1.27" -> "nginx-1.27")."""
+    return _NAME_UNSAFE_RE.sub("-", image_or_name).strip("-.") or "app"
+
+
+class DowntimeProbe:
+    """
+    Polls `url` every PROBE_INTERVAL seconds on a daemon thread. Any response
+    below 500 counts as up; errors, timeouts and 5xx count as down.
+    """
+
+    def __init__(self, url: str, interval: float = PROBE_INTERVAL, timeout: float = 1.0):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.samples: List[tuple] = []  # (monotonic time, up)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="deploy-probe", daemon=True)
+        self._session = requests.Session()
+
+    def _run(self):
+        while not self._stop.is_set():
+            t = time.monotonic()
+            try:
+                up = self._session.get(self.url, timeout=self.timeout).status_code < 500
+            except requests.RequestException:
+                up = False
+            self.samples.append((t, up))
+            self._stop.wait(max(self.interval - (time.monotonic() - t), 0))
+
+    def start(self) -> "DowntimeProbe":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, Any]:
+        """
+        Stops probing. The downtime of an outage is the time from the last good
+        probe before it to the first good probe after it.
+        """
+        self._stop.set()
+        self._thread.join(self.timeout + self.interval + 1)
+        self._session.close()
+        samples = self.samples
+        report = {"url": self.url, "probes": len(samples), "failed": sum(1 for _, up in samples if not up),
+                  "was_up": bool(samples) and samples[0][1], "downtime_s": 0.0, "longest_outage_s": 0.0}
+        last_up = None
+        down_since = None
+        for t, up in samples:
+            if up:
+                if down_since is not None and last_up is not None:
+                    outage = t - last_up
+                    report["downtime_s"] += outage
+                    report["longest_outage_s"] = max(report["longest_outage_s"], outage)
+                down_since = None
+                last_up = t
+            elif down_since is None:
+                down_since = t
+        if down_since is not None and last_up is not None:
+            # Still down when the deploy finished
+            outage = samples[-1][0] - last_up
+            report["downtime_s"] += outage
+            report["longest_outage_s"] = max(report["longest_outage_s"], outage)
+            report["down_at_end"] = True
+        return report
+
+
+def format_downtime(report: Optional[Dict[str, Any]]) -> str:
+    if not report or not report["probes"]:
+        return "downtime not measured"
+    if not report["was_up"] and report["failed"] == report["probes"]:
+        return f"downtime not measured ({report['url']} did not answer during the deploy)"
+    if not report["was_up"]:
+        return f"service was not up before the deploy; {report['failed']}/{report['probes']} probes failed"
+    return (f"measured downtime {report['downtime_s'] * 1000:.0f} ms "
+            f"({report['failed']}/{report['probes']} probes failed, longest outage "
+            f"{report['longest_outage_s'] * 1000:.0f} ms)")
+
+
+# --- Router ---
+def _router_config(backends: List[str], port: int) -> str:
+    servers = "\n".join(_ROUTER_SERVER.format(backend=backend, port=port) for backend in backends)
+    return _ROUTER_TEMPLATE.format(servers=servers, keepalive=16 * len(backends))
+
+
+def _replica_names(name: str, color: str, replicas: int) -> List[str]:
+    return [f"{name}-{color}" + (f"-{i}" if i > 1 else "") for i in range(1, replicas + 1)]
+
+
+def _color(name: str, backend: str) -> Optional[str]:
+    match = re.fullmatch(rf"{re.escape(name)}-(blue|green)(?:-\d+)?", backend)
+    return match.group(1) if match else None
+
+
+def _get(client, name: str):
+    try:
+        return client.containers.get(name)
+    except docker.errors.NotFound:
+        return None
+
+
+def _ensure_network(client, name: str):
+    networks = client.networks.list(names=[name])
+    return networks[0] if networks else client.networks.create(name, driver="bridge",
+                                                                labels={"chatops.app": name})
+
+
+def _router_backends(router) -> List[str]:
+    """The containers the router currently sends traffic to."""
+    result = router.exec_run(["cat", ROUTER_CONF])
+    return _BACKEND_RE.findall(result.output.decode(errors="replace")) if result.exit_code == 0 else []
+
+
+def _switch_router(router, backends: List[str], port: int):
+    """Rewrites the router's upstream and reloads nginx gracefully; raises if nginx rejects it."""
+    script = (f'cp {ROUTER_CONF} {ROUTER_CONF}.prev && printf "%s" "$CONF" > {ROUTER_CONF} && '
+              f'{{ nginx -t && nginx -s reload || {{ cp {ROUTER_CONF}.prev {ROUTER_CONF}; exit 1; }}; }}')
+    result = router.exec_run(["sh", "-c", script], environment={"CONF": _router_config(backends, port)})
+    if result.exit_code != 0:
+        raise RuntimeError(f"Router reload failed: {result.output.decode(errors='replace').strip()}")
+
+
+def wait_ready(client, network: str, url: str, timeout: float = READY_TIMEOUT,
+               container=None, progress: Optional[Callable[[str], None]] = None) -> bool:
+    """
+    Readiness probe: polls `url` from a throwaway container on `network` (so it
+    works wherever the Docker daemon runs) until it answers or `timeout` passes.
+    Gives up early if `container` exits.
+    """
+    attempts = max(int(timeout), 1)
+    script = (f'for i in $(seq {attempts}); do wget -q -T 2 -O /dev/null "$URL" && exit 0; sleep 1; done; '
+              f'exit 1')
+    probe = client.containers.run(ROUTER_IMAGE, ["sh", "-c", script], environment={"URL": url},
+                                  network=network, detach=True, labels={"chatops.role": "probe"})
+    try:
+        started = time.monotonic()
+        while time.monotonic() - started < timeout + 15:
+            try:
+                status = probe.wait(timeout=2)
+                return status.get("StatusCode") == 0
+            except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
+                pass  # wait() timed out; the probe is still polling
+            if container is not None:
+                container.reload()
+                if container.status in ("exited", "dead"):
+                    return False
+            if progress and time.monotonic() - started > 10:
+                # Also gives a cancelled job its chance to stop
+                progress(f"Still waiting for {url} to answer ({time.monotonic() - started:.0f}s)")
+        return False
+    finally:
+        probe.remove(force=True)
+
+
+# --- Strategies ---
+def deploy(client, name: str, image: str, public_port: int, container_port: int = 80,
+           strategy: Optional[str] = None, progress: Optional[Callable[[str], None]] = None,
+           run_options: Optional[Dict[str, Any]] = None, replicas: int = 1) -> Dict[str, Any]:
+    """
+    Replaces the running `name` app with `replicas` containers of `image`,
+    serving on `public_port`. strategy is "bluegreen" (default,
+    DEPLOY_STRATEGY) or "recreate" (one replica only). Returns {"success",
+    "message", "strategy", "container", "replicas", "downtime", "steps"},
+    where steps are the seconds each phase took.
+    """
+    strategy = strategy or os.environ.get("DEPLOY_STRATEGY", "bluegreen")
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown deploy strategy '{strategy}' (use {' or '.join(STRATEGIES)})")
+    if not 1 <= replicas <= MAX_REPLICAS:
+        raise ValueError(f"replicas must be between 1 and {MAX_REPLICAS}")
+    if strategy == "recreate" and replicas > 1:
+        raise ValueError("Several replicas need the bluegreen strategy (they sit behind its router)")
+    progress = progress or (lambda message: None)
+    name = app_name(name)
+    probe = DowntimeProbe(f"http://{PROBE_HOST}:{public_port}{READY_PATH}").start()
+    result = {"success": False, "strategy": strategy, "container": None, "replicas": [], "steps": {}}
+    try:
+        if strategy == "recreate":
+            _recreate(client, name, image, public_port, container_port, progress, run_options or {}, result)
+        else:
+            _blue_green(client, name, image, public_port, container_port, replicas, progress,
+                        run_options or {}, result)
+    finally:
+        result["downtime"] = probe.stop()
+    logger.info(f"Deploy of {image} as {name} ({strategy}): {result['message']}; "
+                f"{format_downtime(result['downtime'])}")
+    return result
+
+
+def _timed(result: Dict[str, Any], step: str, started: float):
+    result["steps"][step] = round(time.monotonic() - started, 2)
+
+
+def _recreate(client, name, image, public_port, container_port, progress, run_options, result):
+    """The old behaviour: stop and remove the container, then start the new one on the public port."""
+    t0 = time.monotonic()
+    # Also takes down a blue/green setup of the same app (router and every replica)
+    old_names = [f"{name}-container", f"{name}-proxy", f"{name}-blue", f"{name}-green"]
+    old_names += [container.name for container in
+                  client.containers.list(all=True, filters={"label": f"chatops.app={name}"})
+                  if container.name not in old_names]
+    for old_name in old_names:
+        old = _get(client, old_name)
+        if old is not None:
+            progress(f"Stopping {old.name}")
+            old.stop()
+            old.remove()
+    progress(f"Starting {name}-container")
+    container = client.containers.run(image, detach=True, name=f"{name}-container",
+                                      ports={f"{container_port}/tcp": public_port}, **run_options)
+    container.reload()
+    _timed(result, "replace", t0)
+    result["container"] = container.name
+    result["replicas"] = [container.name]
+    result["success"] = container.status == "running"
+    result["message"] = (f"{container.name} is running" if result["success"]
+                         else f"{container.name} failed to start (status {container.status})")
+
+
+def _start_replicas(client, name, names, color, image, network, container_port, progress, run_options):
+    """
+    Starts containers `names` of `image` on `network` and waits until each
+    answers. Returns (containers, None), or removes them all and returns
+    ([], reason) if one does not become ready.
+    """
+    started = []
+    for replica in names:
+        progress(f"Starting {replica}")
+        started.append(client.containers.run(image, detach=True, name=replica, network=network,
+                                             labels={"chatops.app": name, "chatops.color": color},
+                                             **run_options))
+    for container, replica in zip(started, names):
+        progress(f"Waiting for {replica} to become ready")
+        if not wait_ready(client, network, f"http://{replica}:{container_port}{READY_PATH}",
+                          container=container, progress=progress):
+            logs = container.logs(tail=20).decode(errors="replace").strip()
+            for other in started:
+                other.remove(force=True)
+            return [], f"{replica} did not become ready (timeout {READY_TIMEOUT:.0f}s). Last log lines:\n{logs}"
+    return started, None
+
+
+def _retire(client, names: List[str], progress):
+    """Stops containers that no longer get traffic, once their in-flight requests had time to finish."""
+    old = [container for container in (_get(client, replica) for replica in names) if container is not None]
+    if old:
+        progress(f"Draining {', '.join(container.name for container in old)} for {DRAIN_SECONDS:.0f}s")
+        time.sleep(DRAIN_SECONDS)
+    for container in old:
+        container.stop(timeout=10)
+        container.remove()
+
+
+def _blue_green(client, name, image, public_port, container_port, replicas, progress, run_options, result):
+    network = f"chatops-{name}"
+    _ensure_network(client, network)
+    router = _get(client, f"{name}-proxy")
+    active = _router_backends(router) if router is not None else []
+    color = "green" if active and _color(name, active[0]) == "blue" else "blue"
+    new_names = _replica_names(name, color, replicas)
+    described = new_names[0] + (f" and {replicas - 1} more replica{'s' if replicas > 2 else ''}"
+                                if replicas > 1 else "")
+
+    # 1. Start the new color next to the old one; it gets no host port
+    t0 = time.monotonic()
+    # Leftovers of this color from a failed or larger earlier deploy
+    for stale in client.containers.list(all=True, filters={"label": [f"chatops.app={name}",
+                                                                     f"chatops.color={color}"]}):
+        if stale.name not in active:
+            stale.remove(force=True)
+    for replica in new_names:
+        stale = _get(client, replica)
+        if stale is not None and replica not in active:
+            stale.remove(force=True)
+
+    # 2. Readiness: every new replica must answer HTTP before any gets traffic
+    new, failure = _start_replicas(client, name, new_names, color, image, network, container_port,
+                                   progress, run_options)
+    _timed(result, "start+ready", t0)
+    if failure:
+        result["message"] = f"{failure}\n{', '.join(active) or 'The old version'} keeps serving."
+        return
+
+    # 3. Switch traffic
+    t0 = time.monotonic()
+    legacy = _get(client, f"{name}-container")
+    try:
+        if router is None:
+            # First blue/green deploy: the router takes the public port over from the legacy
+            # container, which is the one short outage this migration costs
+            progress(f"Moving port {public_port} to the {name}-proxy router")
+            if legacy is not None:
+                legacy.stop(timeout=5)
+            router = client.containers.run(ROUTER_IMAGE, _ROUTER_COMMAND, detach=True, name=f"{name}-proxy",
+                                           network=network, ports={"80/tcp": public_port},
+                                           environment={"CONF": _router_config(new_names, container_port)},
+                                           labels={"chatops.app": name, "chatops.role": "router"},
+                                           restart_policy={"Name": "always"})
+        else:
+            progress(f"Switching {name}-proxy from {', '.join(active) or 'nothing'} to {', '.join(new_names)}")
+            _switch_router(router, new_names, container_port)
+        if not wait_ready(client, network, f"http://{name}-proxy:80{READY_PATH}", timeout=10):
+            raise RuntimeError(f"{name}-proxy does not serve through {new_names[0]}")
+    except Exception as e:
+        # Roll back: traffic stays on (or returns to) the old version
+        progress(f"Rolling back: {e}")
+        logger.error(f"Switch to {described} failed, rolling back: {e}")
+        try:
+            if active and router is not None:
+                _switch_router(router, active, container_port)
+            elif router is not None:
+                router.remove(force=True)
+            if legacy is not None:
+                legacy.start()
+        finally:
+            for container in new:
+                container.remove(force=True)
+        _timed(result, "switch", t0)
+        result["message"] = f"switch to {described} failed and was rolled back: {e}"
+        return
+    _timed(result, "switch", t0)
+
+    # 4. Retire the old color once in-flight requests have drained
+    t0 = time.monotonic()
+    _retire(client, active, progress)
+    if legacy is not None:
+        legacy.remove()  # stopped when the router took its port
+    _timed(result, "retire", t0)
+    result["container"] = new_names[0]
+    result["replicas"] = new_names
+    result["success"] = True
+    result["message"] = f"{described} {'are' if replicas > 1 else 'is'} serving on port {public_port}" + (
+        f" (was {', '.join(active)})" if active else "")
+
+
+def scale(client, name: str, replicas: int, container_port: int = 80,
+          progress: Optional[Callable[[str], None]] = None,
+          run_options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Rolling change of the running version of `name` to `replicas` containers.
+    New replicas are added to the router only once they answer; removed ones
+    are taken out of it (graceful reload) and drained before they stop, so no
+    request is dropped. Returns the same shape as deploy().
+    """
+    if not 1 <= replicas <= MAX_REPLICAS:
+        raise ValueError(f"replicas must be between 1 and {MAX_REPLICAS}")
+    progress = progress or (lambda message: None)
+    name = app_name(name)
+    result = {"success": False, "strategy": "rolling scale", "container": None, "replicas": [], "steps": {},
+              "downtime": None}
+    router = _get(client, f"{name}-proxy")
+    active = _router_backends(router) if router is not None else []
+    color = _color(name, active[0]) if active else None
+    current = _get(client, active[0]) if color else None
+    if current is None:
+        result["message"] = f"{name} is not running behind a {name}-proxy router; deploy it first"
+        return result
+    router.reload()
+    bindings = [binding for bindings in (router.ports or {}).values() for binding in (bindings or [])]
+    probe = (DowntimeProbe(f"http://{PROBE_HOST}:{bindings[0]['HostPort']}{READY_PATH}").start()
+             if bindings else None)
+    network = f"chatops-{name}"
+    try:
+        t0 = time.monotonic()
+        if replicas > len(active):
+            # The same image the running replicas were started from, not whatever the tag points at now
+            adding = [replica for replica in _replica_names(name, color, MAX_REPLICAS)
+                      if replica not in active][:replicas - len(active)]
+            for replica in adding:
+                stale = _get(client, replica)
+                if stale is not None:
+                    stale.remove(force=True)
+            new, failure = _start_replicas(client, name, adding, color, current.image.id, network,
+                                           container_port, progress, run_options or {})
+            _timed(result, "start+ready", t0)
+            if failure:
+                result["message"] = f"{failure}\nStill serving with {len(active)} replicas."
+                return result
+            t0 = time.monotonic()
+            progress(f"Adding {', '.join(adding)} to {name}-proxy")
+            try:
+                _switch_router(router, active + adding, container_port)
+            except Exception as e:
+                for container in new:
+                    container.remove(force=True)
+                result["message"] = f"could not add {', '.join(adding)} to {name}-proxy: {e}"
+                return result
+            _timed(result, "switch", t0)
+            result["replicas"] = active + adding
+        elif replicas < len(active):
+            keep, removing = active[:replicas], active[replicas:]
+            progress(f"Removing {', '.join(removing)} from {name}-proxy")
+            try:
+                _switch_router(router, keep, container_port)
+            except Exception as e:
+                result["message"] = f"could not remove {', '.join(removing)} from {name}-proxy: {e}"
+                return result
+            _timed(result, "switch", t0)
+            t0 = time.monotonic()
+            _retire(client, removing, progress)
+            _timed(result, "retire", t0)
+            result["replicas"] = keep
+        else:
+            result["replicas"] = active
+        result["container"] = result["replicas"][0]
+        result["success"] = True
+        result["message"] = (f"{name} runs {replicas} replica{'s' if replicas > 1 else ''} "
+                             f"({', '.join(result['replicas'])}; was {len(active)})")
+    finally:
+        if probe is not None:
+            result["downtime"] = probe.stop()
+    logger.info(f"Scale of {name} to {replicas}: {result['message']}; {format_downtime(result['downtime'])}")
+    return result
+
+
+def describe(client, name: str) -> Optional[Dict[str, Any]]:
+    """
+    What currently serves app `name`: {"app", "container" (the first replica),
+    "image", "image_id", "public_port", "strategy", "replicas"}, or None if it
+    is not deployed.
+    """
+    name = app_name(name)
+    router = _get(client, f"{name}-proxy")
+    if router is not None:
+        front, backends, strategy = router, _router_backends(router), "bluegreen"
+        serving = _get(client, backends[0]) if backends else None
+    else:
+        front = serving = _get(client, f"{name}-container")
+        backends, strategy = [f"{name}-container"], "recreate"
+    if serving is None:
+        return None
+    front.reload()
+    bindings = [binding for bindings in (front.ports or {}).values() for binding in (bindings or [])]
+    image = serving.image
+    return {"app": name, "container": serving.name,
+            "image": (image.tags[0] if image.tags else image.short_id) if image is not None else None,
+            "image_id": image.id if image is not None else None, "strategy": strategy,
+            "replicas": len(backends),
+            "public_port": int(bindings[0]["HostPort"]) if bindings else None}
+
+
+def format_deploy_result(result: Dict[str, Any]) -> str:
+    steps = ", ".join(f"{step} {seconds:.1f}s" for step, seconds in result["steps"].items())
+    return f"{result['message']}\n• Strategy: {result['strategy']} ({steps})\n• {format_downtime(result['downtime'])}"
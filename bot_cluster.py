@@ -0,0 +1,215 @@
+# bot_cluster.py
+"""
+Runs the bot as several processes on one host.
+
+One Python process handles every command under one GIL, over one Socket Mode
+connection. `python bot_cluster.py --processes N` starts N copies of app.py
+instead, each with its own Socket Mode connection (Slack spreads deliveries
+over up to 10 connections per app) and its own job worker threads, and
+restarts any that exit. The processes share the state files under
+BOT_STATE_DIR:
+
+- idempotency.db: a delivery Slack sends to two connections runs once
+- jobs.db: long-running commands are queued and run by whichever process is free
+- cache.db: health and capacity results computed by one process serve all
+
+Work that must happen once per host (alert rule evaluation) runs only in the
+leader, process 0. Each process serves its metrics on METRICS_PORT + index.
+
+`python bot_cluster.py --load-test` measures command throughput through the
+queue with 1, 2 and 4 processes.
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Slack allows at most 10 simultaneous Socket Mode connections per app
+MAX_PROCESSES = 10
+MAX_RESTART_DELAY = 60.0
+
+
+def process_index() -> int:
+    return int(os.environ.get("BOT_PROCESS_INDEX", "0"))
+
+
+def is_leader() -> bool:
+    """True in process 0 of a cluster, and in a bot started on its own."""
+    return process_index() == 0
+
+
+class BotCluster:
+    """Supervises `processes` copies of `command` (default: this interpreter running app.py)."""
+
+    def __init__(self, processes: int, command: Optional[List[str]] = None):
+        if processes > MAX_PROCESSES:
+            logger.warning(f"Slack allows {MAX_PROCESSES} Socket Mode connections per app; "
+                           f"starting {MAX_PROCESSES} processes instead of {processes}")
+            processes = MAX_PROCESSES
+        self.processes = processes
+        self.command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")]
+        self._children: List[Optional[subprocess.Popen]] = [None] * processes
+        self._restart_at = [0.0] * processes
+        self._restart_delay = [1.0] * processes
+        self._started_at = [0.0] * processes
+        self._stopping = False
+
+    def _environment(self, index: int) -> dict:
+        env = dict(os.environ, BOT_PROCESS_INDEX=str(index), BOT_PROCESS_COUNT=str(self.processes))
+        metrics_port = os.environ.get("METRICS_PORT", "9102").strip().lower()
+        if metrics_port not in ("", "0", "off", "false"):
+            env["METRICS_PORT"] = str(int(metrics_port) + index)
+        return env
+
+    def _spawn(self, index: int):
+        self._children[index] = subprocess.Popen(self.command, env=self._environment(index))
+        self._started_at[index] = time.monotonic()
+        logger.info(f"Started bot process {index} (pid {self._children[index].pid})")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for index in range(self.processes):
+            self._spawn(index)
+        while not self._stopping:
+            now = time.monotonic()
+            for index, child in enumerate(self._children):
+                if child is not None and child.poll() is not None:
+                    # Back off on processes that crash right after starting (bad token, config error)
+                    if now - self._started_at[index] > MAX_RESTART_DELAY:
+                        self._restart_delay[index] = 1.0
+                    logger.error(f"Bot process {index} exited with {child.returncode}; "
+                                 f"restarting in {self._restart_delay[index]:.0f}s")
+                    self._children[index] = None
+                    self._restart_at[index] = now + self._restart_delay[index]
+                    self._restart_delay[index] = min(self._restart_delay[index] * 2, MAX_RESTART_DELAY)
+                elif child is None and now >= self._restart_at[index]:
+                    self._spawn(index)
+            time.sleep(0.5)
+        self._shutdown()
+
+    def _handle_signal(self, signum, frame):
+        self._stopping = True
+
+    def _shutdown(self, timeout: float = 10.0):
+        children = [child for child in self._children if child is not None and child.poll() is None]
+        for child in children:
+            child.terminate()
+        deadline = time.monotonic() + timeout
+        for child in children:
+            try:
+                child.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                child.kill()
+        logger.info(f"Stopped {len(children)} bot processes")
+
+
+# --- Load test ---
+def _synthetic_command(job, context) -> str:
+    """
+    Stands in for a log-heavy command (e.g. /ai-analyze-logs before the AI call):
+    parse, merge and render a few thousand log lines. Pure Python, so it holds the GIL.
+    """
+    from log_pipeline import collect, iter_lines, merge_by_time, parse_records
+
+    lines, containers = job.payload["lines"], 4
+    start_ns = time.time_ns()
+    streams = []
+    for c in range(containers):
+        raw = (f"2024-01-01T00:00:{(i * containers + c) % 60:02d}.{i:06d}Z level=info container=web-{c} "
+               f"path=/api/items/{i} status=200\n" for i in range(lines // containers))
+        streams.append(parse_records("docker", f"web-{c}", iter_lines(raw), start_ns))
+    count, _ = collect(merge_by_time(*streams), max_chars=16_000, grouped=False)
+    return str(count)
+
+
+def _load_test_worker(queue_path: str, threads: int, stop_path: str):
+    from job_queue import JobQueue, JobWorker
+
+    logging.getLogger("job_queue").setLevel(logging.WARNING)
+    worker = JobWorker(JobQueue(queue_path), {"synthetic": _synthetic_command}, threads=threads)
+    worker.start()
+    while not os.path.exists(stop_path):
+        time.sleep(0.05)
+    worker.stop()
+
+
+def load_test(process_counts: List[int], commands: int, lines: int, threads: int):
+    """
+    Simulates Slack deliveries (dedupe claim, enqueue, ack) of `commands` commands,
+    10% of them redelivered, against 1..N worker processes, and reports commands/s
+    and enqueue-to-finish latency.
+    """
+    import multiprocessing
+    import statistics
+    import tempfile
+
+    from idempotency_store import IdempotencyStore
+    from job_queue import JobQueue
+
+    def run(processes: int, threads_per_process: int):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue_path, stop_path = os.path.join(tmp, "jobs.db"), os.path.join(tmp, "stop")
+            queue = JobQueue(queue_path)
+            dedupe = IdempotencyStore(os.path.join(tmp, "idempotency.db"))
+            workers = [multiprocessing.Process(target=_load_test_worker,
+                                               args=(queue_path, threads_per_process, stop_path))
+                       for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+            time.sleep(0.5)  # let the workers import and open the queue
+            t0 = time.perf_counter()
+            queued = 0
+            for i in range(commands + commands // 10):
+                trigger_id = f"trigger:{i % commands}"  # the last 10% are Slack retries of earlier commands
+                if dedupe.claim(trigger_id):
+                    queue.enqueue("synthetic", {"lines": lines})
+                    queued += 1
+            while queue.counts().get("succeeded", 0) < queued:
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - t0
+            latencies = [row[0] for row in queue._db.execute(
+                "SELECT finished_at - created_at FROM jobs WHERE state = 'succeeded'")]
+            open(stop_path, "w").close()
+            for worker in workers:
+                worker.join()
+            return queued, elapsed, latencies
+
+    logger.info(f"{commands} commands (+{commands // 10} redeliveries), {lines:,} log lines each, "
+                f"{os.cpu_count()} CPUs")
+    baseline = None
+    # Last: one process given as many threads as the largest run, to show what the GIL allows
+    cases = [(n, threads) for n in process_counts] + [(1, threads * max(process_counts))]
+    for processes, threads_per_process in cases:
+        queued, elapsed, latencies = run(processes, threads_per_process)
+        rate = queued / elapsed
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        if processes == 1 and threads_per_process == threads:
+            baseline = rate
+        scaling = f", {rate / baseline:.2f}x one process" if baseline else ""
+        logger.info(f"{processes} process(es) x {threads_per_process} threads: {queued} ran in {elapsed:.2f}s, "
+                    f"{rate:.1f} commands/s{scaling}; latency p50 {statistics.median(latencies):.2f}s "
+                    f"p95 {p95:.2f}s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Run several ChatOps bot processes on this host.")
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("BOT_PROCESSES", os.cpu_count() or 1)))
+    parser.add_argument("--load-test", action="store_true", help="measure throughput instead of starting the bot")
+    parser.add_argument("--load-test-processes", default="1,2,4")
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=20_000, help="log lines processed per synthetic command")
+    parser.add_argument("--threads", type=int, default=2, help="job worker threads per process")
+    args = parser.parse_args()
+    if args.load_test:
+        load_test([int(n) for n in args.load_test_processes.split(",")], args.commands, args.lines, args.threads)
+    else:
+        BotCluster(args.processes).run()
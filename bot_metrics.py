@@ -0,0 +1,392 @@
+# bot_metrics.py
+"""
+Self-telemetry for the bot, exposed in the Prometheus text format on
+METRICS_PORT (default 9102) under /metrics.
+
+Records latency histograms, error counters, in-flight gauges and payload sizes
+for every Slack command handler and every call into the Jenkins, Kubernetes,
+Docker and AI backends. The registry is a small in-house implementation so the
+bot does not need another dependency.
+"""
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self, key, value) -> List[str]:
+        return [f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, plus +Inf, sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key, value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(line for metric in metrics for line in metric.collect()) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_DURATION = REGISTRY.register(Histogram(
+    "chatops_command_duration_seconds", "Time spent in Slack command handlers.", ["command"]))
+COMMAND_ERRORS = REGISTRY.register(Counter(
+    "chatops_command_errors", "Slack command handlers that raised an exception.", ["command"]))
+COMMANDS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "chatops_commands_in_flight", "Slack command handlers currently running.", ["command"]))
+COMMAND_RESPONSE_BYTES = REGISTRY.register(Histogram(
+    "chatops_command_response_bytes", "Size of messages sent back to Slack by command handlers.",
+    ["command"], buckets=SIZE_BUCKETS))
+
+BACKEND_DURATION = REGISTRY.register(Histogram(
+    "chatops_backend_call_duration_seconds", "Latency of calls into Jenkins, Kubernetes, Docker and AI backends.",
+    ["backend", "operation"]))
+BACKEND_ERRORS = REGISTRY.register(Counter(
+    "chatops_backend_call_errors", "Backend calls that raised (kind=exception) or reported failure (kind=failure).",
+    ["backend", "operation", "kind"]))
+BACKEND_IN_FLIGHT = REGISTRY.register(Gauge(
+    "chatops_backend_calls_in_flight", "Backend calls currently running.", ["backend"]))
+BACKEND_RESPONSE_BYTES = REGISTRY.register(Histogram(
+    "chatops_backend_response_bytes", "Approximate size of data returned by backend calls.",
+    ["backend", "operation"], buckets=SIZE_BUCKETS))
+
+
+def payload_size(data) -> Optional[int]:
+    """Approximate size in bytes of a returned payload, or None if it can't be sized cheaply."""
+    if isinstance(data, bytes):
+        return len(data)
+    if isinstance(data, str):
+        return len(data.encode("utf-8", errors="replace"))
+    if isinstance(data, (dict, list, tuple)):
+        try:
+            return len(json.dumps(data, default=str))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def _failed(result) -> bool:
+    """Handlers report failure as (False, message); AI calls as {"status": "error"}."""
+    if isinstance(result, tuple) and len(result) == 2 and result[0] is False:
+        return True
+    return isinstance(result, dict) and result.get("status") == "error"
+
+
+def _result_payload(result):
+    # (success, data) tuples: size the data, not the flag
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], bool):
+        return result[1]
+    return result
+
+
+def instrument_backend(func: Callable, backend: str, operation: Optional[str] = None) -> Callable:
+    """Wraps a backend call with latency, error, in-flight and payload-size metrics."""
+    if getattr(func, "_chatops_instrumented", False):
+        return func
+    operation = operation or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        BACKEND_IN_FLIGHT.inc(backend=backend)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            BACKEND_ERRORS.inc(backend=backend, operation=operation, kind="exception")
+            raise
+        finally:
+            BACKEND_DURATION.observe(time.perf_counter() - start, backend=backend, operation=operation)
+            BACKEND_IN_FLIGHT.dec(backend=backend)
+        if _failed(result):
+            BACKEND_ERRORS.inc(backend=backend, operation=operation, kind="failure")
+        size = payload_size(_result_payload(result))
+        if size is not None:
+            BACKEND_RESPONSE_BYTES.observe(size, backend=backend, operation=operation)
+        return result
+
+    wrapper._chatops_instrumented = True
+    return wrapper
+
+
+def instrument_module(module, backend: str) -> List[str]:
+    """Instruments every public function defined in `module`, in place. Returns their names."""
+    names = []
+    for name, obj in list(vars(module).items()):
+        if name.startswith("_") or not inspect.isfunction(obj) or obj.__module__ != module.__name__:
+            continue
+        setattr(module, name, instrument_backend(obj, backend, name))
+        names.append(name)
+    return names
+
+
+def instrument_class(cls, backend: str) -> List[str]:
+    """Instruments every public method defined on `cls`, in place. Returns their names."""
+    names = []
+    for name, obj in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(obj):
+            continue
+        setattr(cls, name, instrument_backend(obj, backend, name))
+        names.append(name)
+    return names
+
+
+def _measured_reply(reply: Callable, command: str) -> Callable:
+    """Wraps respond/say so the size of every message sent back is recorded."""
+    @functools.wraps(reply)
+    def wrapper(*args, **kwargs):
+        text = kwargs.get("text", args[0] if args else None)
+        size = payload_size(text if text is not None else kwargs.get("blocks"))
+        if size is not None:
+            COMMAND_RESPONSE_BYTES.observe(size, command=command)
+        return reply(*args, **kwargs)
+    return wrapper
+
+
+# thread ident -> command currently handled on that thread (read by the profiler)
+_ACTIVE_COMMANDS: Dict[int, str] = {}
+
+
+def active_commands() -> Dict[int, str]:
+    """Snapshot of which Slack command each handler thread is running."""
+    return dict(_ACTIVE_COMMANDS)
+
+
+def instrument_command(command: str) -> Callable:
+    """
+    Decorator for Bolt listeners. Bolt passes arguments by parameter name and
+    looks through functools.wraps, so the wrapped handler keeps its signature.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for reply in ("respond", "say"):
+                if callable(kwargs.get(reply)):
+                    kwargs[reply] = _measured_reply(kwargs[reply], command)
+            COMMANDS_IN_FLIGHT.inc(command=command)
+            thread_id = threading.get_ident()
+            previous = _ACTIVE_COMMANDS.get(thread_id)
+            _ACTIVE_COMMANDS[thread_id] = command
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                COMMAND_ERRORS.inc(command=command)
+                raise
+            finally:
+                COMMAND_DURATION.observe(time.perf_counter() - start, command=command)
+                COMMANDS_IN_FLIGHT.dec(command=command)
+                if previous is None:
+                    _ACTIVE_COMMANDS.pop(thread_id, None)
+                else:
+                    _ACTIVE_COMMANDS[thread_id] = previous
+        return wrapper
+    return decorator
+
+
+def instrument_bolt_app(app):
+    """Makes every handler registered afterwards with @app.command(...) instrumented."""
+    register = app.command
+
+    def command(name, *args, **kwargs):
+        bolt_decorator = register(name, *args, **kwargs)
+
+        def decorator(func):
+            bolt_decorator(instrument_command(str(name))(func))
+            # Return the undecorated function, as Bolt's own decorator does
+            return func
+        return decorator
+
+    app.command = command
+    return app
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: Optional[int] = None, addr: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    """
+    Serves /metrics on a daemon thread. The port defaults to METRICS_PORT (9102);
+    setting METRICS_PORT to 0 or "off" disables the endpoint.
+    """
+    if port is None:
+        setting = os.environ.get("METRICS_PORT", "9102").strip().lower()
+        if setting in ("", "0", "off", "false"):
+            return None
+        port = int(setting)
+    try:
+        server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving bot metrics on http://{addr}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Demo and overhead check: python bot_metrics.py
+if __name__ == "__main__":
+    import urllib.request
+
+    logging.basicConfig(level=logging.INFO)
+
+    def get_pods(namespace="default"):
+        return True, "pod-a Running\npod-b CrashLoopBackOff"
+
+    instrumented = instrument_backend(get_pods, "k8s")
+    n = 100_000
+    t0 = time.perf_counter()
+    for _ in range(n):
+        get_pods()
+    bare = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        instrumented()
+    wrapped = time.perf_counter() - t0
+    logger.info(f"Instrumentation overhead: {(wrapped - bare) / n * 1e6:.2f} us per call")
+
+    @instrument_command("/k8s-pods")
+    def handle(ack, respond, command):
+        ack()
+        respond(instrumented(command.get("text") or "default")[1])
+
+    handle(ack=lambda: None, respond=lambda text: None, command={"text": "prod"})
+    server = start_metrics_server(port=0, addr="127.0.0.1")
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+        text = response.read().decode()
+    logger.info("\n" + "\n".join(line for line in text.splitlines()
+                                 if "command" in line and not line.startswith("#"))[:1500])
+    server.shutdown()
@@ -0,0 +1,315 @@
+# bot_profiler.py
+"""
+Optional continuous profiler for the bot, compatible with Pyroscope (e.g. the
+grafana-pyroscope-app in monitoring-stack).
+
+A daemon thread samples the Python stacks of all other threads with
+sys._current_frames() at PROFILER_SAMPLE_HZ and aggregates them into folded
+stacks, labelled with the Slack command the thread is handling (see
+bot_metrics.active_commands) and the thread's role. Every upload interval the
+profiles are pushed to the Pyroscope /ingest endpoint; if that fails (or no
+server is configured) they are written as .folded files to PROFILER_DUMP_DIR,
+which flamegraph.pl and speedscope can open directly.
+
+On Linux, threads that are not on-CPU (state other than R in /proc) are skipped
+by default, so the profile shows where CPU goes rather than where threads wait.
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import requests
+
+import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_HZ = 20
+DEFAULT_UPLOAD_INTERVAL = 10.0
+MAX_STACK_DEPTH = 128
+MAX_DUMP_FILES = 1000
+
+_THREAD_SUFFIX_RE = re.compile(r"[-_]?\d+(_\d+)?$")
+_LABEL_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_./-]+")
+_PROC_TASK = Path("/proc/self/task")
+
+
+def _thread_role(name: str) -> str:
+    """'ThreadPoolExecutor-0_3' -> 'ThreadPoolExecutor', 'Thread-1 (serve_forever)' -> 'Thread'."""
+    name = name.split(" (", 1)[0]
+    return _LABEL_UNSAFE_RE.sub("_", _THREAD_SUFFIX_RE.sub("", name) or name)
+
+
+class _ThreadStates:
+    """Reads thread run states from /proc, keeping one open fd per thread (open() dominates the cost)."""
+
+    def __init__(self):
+        self._fds: Dict[int, int] = {}
+
+    def on_cpu(self, native_id: int) -> bool:
+        """True if the OS thread is currently running (or runnable)."""
+        fd = self._fds.get(native_id)
+        try:
+            if fd is None:
+                fd = self._fds[native_id] = os.open(_PROC_TASK / str(native_id) / "stat", os.O_RDONLY)
+            stat = os.pread(fd, 256, 0)
+        except OSError:
+            return True
+        # Field 3, after the parenthesised command name (which may itself contain spaces)
+        end = stat.rfind(b")")
+        return end < 0 or stat[end + 2:end + 3] == b"R"
+
+    def prune(self, live_ids):
+        for native_id in set(self._fds) - set(live_ids):
+            os.close(self._fds.pop(native_id))
+
+
+class BotProfiler:
+    def __init__(self, app_name: str = "chatops-bot", server: Optional[str] = None,
+                 sample_hz: float = DEFAULT_SAMPLE_HZ, upload_interval: float = DEFAULT_UPLOAD_INTERVAL,
+                 dump_dir: Optional[str] = None, auth_token: Optional[str] = None,
+                 cpu_only: bool = True, static_labels: Optional[Dict[str, str]] = None):
+        self.app_name = app_name
+        self.server = server.rstrip("/") if server else None
+        self.sample_hz = sample_hz
+        self.upload_interval = upload_interval
+        self.dump_dir = Path(dump_dir) if dump_dir else None
+        self.cpu_only = cpu_only and _PROC_TASK.is_dir()
+        self.static_labels = static_labels or {}
+        self.session = requests.Session()
+        if auth_token:
+            self.session.headers["Authorization"] = f"Bearer {auth_token}"
+        self._thread_states = _ThreadStates()
+        self._frame_names: Dict[object, str] = {}
+        self._profiles: Counter = Counter()
+        self._profiles_lock = threading.Lock()
+        self._window_start = time.time()
+        self._stop = threading.Event()
+        self._threads = []
+        self.stats = {"samples": 0, "stacks": 0, "sampling_s": 0.0, "uploads": 0, "upload_errors": 0, "dumps": 0}
+        self._started_at = None
+        self._run_s = 0.0
+
+    # --- Sampling ---
+    def _frame_name(self, code) -> str:
+        name = self._frame_names.get(code)
+        if name is None:
+            filename = code.co_filename
+            # Keep paths short: package-relative for site-packages, basename otherwise
+            short = filename.split("site-packages/")[-1] if "site-packages/" in filename else os.path.basename(filename)
+            name = self._frame_names[code] = f"{code.co_name} ({short}:{code.co_firstlineno})"
+        return name
+
+    def sample_once(self):
+        """Takes one sample of every other thread's stack."""
+        t0 = time.thread_time()
+        own = threading.get_ident()
+        threads = {t.ident: t for t in threading.enumerate()}
+        commands = bot_metrics.active_commands()
+        collected = []
+        for thread_id, frame in sys._current_frames().items():
+            thread = threads.get(thread_id)
+            if thread_id == own or thread is None or thread.name.startswith("profiler-"):
+                continue
+            if self.cpu_only and thread.native_id is not None and not self._thread_states.on_cpu(thread.native_id):
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                names.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            labels = (("command", _LABEL_UNSAFE_RE.sub("_", commands.get(thread_id, "none"))),
+                      ("thread", _thread_role(thread.name)))
+            collected.append((labels, ";".join(reversed(names))))
+        del frame
+        if self.cpu_only and self.stats["samples"] % 1000 == 0:
+            self._thread_states.prune(t.native_id for t in threads.values())
+        with self._profiles_lock:
+            for key in collected:
+                self._profiles[key] += 1
+        self.stats["samples"] += 1
+        self.stats["stacks"] += len(collected)
+        # Thread CPU time: wall time would mostly be waiting for the GIL, which isn't overhead
+        self.stats["sampling_s"] += time.thread_time() - t0
+
+    def _sample_loop(self):
+        interval = 1.0 / self.sample_hz
+        next_tick = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.sample_once()
+            except Exception as e:
+                logger.warning(f"Profiler sample failed: {e}")
+            next_tick += interval
+            delay = next_tick - time.perf_counter()
+            if delay < 0:
+                # Fell behind (e.g. the process was suspended); don't try to catch up
+                next_tick = time.perf_counter()
+                delay = 0
+            self._stop.wait(delay)
+
+    # --- Export ---
+    def _ingest_name(self, labels: Tuple[Tuple[str, str], ...]) -> str:
+        all_labels = {**self.static_labels, **dict(labels)}
+        return f"{self.app_name}{{{','.join(f'{k}={v}' for k, v in sorted(all_labels.items()))}}}"
+
+    def flush(self) -> Dict[str, int]:
+        """Pushes (or dumps) everything sampled since the last flush."""
+        with self._profiles_lock:
+            profiles, self._profiles = self._profiles, Counter()
+            start, self._window_start = self._window_start, time.time()
+        until = time.time()
+        by_labels: Dict[Tuple, list] = {}
+        for (labels, stack), count in profiles.items():
+            by_labels.setdefault(labels, []).append(f"{stack} {count}")
+        result = {"uploaded": 0, "dumped": 0}
+        for labels, lines in by_labels.items():
+            body = "\n".join(lines) + "\n"
+            name = self._ingest_name(labels)
+            if self.server and self._push(name, body, start, until):
+                result["uploaded"] += 1
+            elif self.dump_dir:
+                self._dump(name, body, start, until)
+                result["dumped"] += 1
+        return result
+
+    def _push(self, name: str, body: str, start: float, until: float) -> bool:
+        params = {"name": name, "from": int(start), "until": int(until), "format": "folded",
+                  "sampleRate": int(self.sample_hz), "spyName": "pyspy", "units": "samples",
+                  "aggregationType": "sum"}
+        try:
+            response = self.session.post(f"{self.server}/ingest", params=params, data=body.encode(), timeout=5)
+            if response.status_code < 300:
+                self.stats["uploads"] += 1
+                return True
+            logger.warning(f"Pyroscope ingest returned HTTP {response.status_code}: {response.text[:200]}")
+        except requests.RequestException as e:
+            logger.warning(f"Could not push profile to {self.server}: {e}")
+        self.stats["upload_errors"] += 1
+        return False
+
+    def _dump(self, name: str, body: str, start: float, until: float):
+        try:
+            self.dump_dir.mkdir(parents=True, exist_ok=True)
+            safe = re.sub(r"[^A-Za-z0-9_.=-]+", "_", name).strip("_")
+            (self.dump_dir / f"{int(start)}-{int(until)}-{safe}.folded").write_text(body)
+            self.stats["dumps"] += 1
+            dumps = sorted(self.dump_dir.glob("*.folded"))
+            for old in dumps[:max(len(dumps) - MAX_DUMP_FILES, 0)]:
+                old.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Could not write profile dump to {self.dump_dir}: {e}")
+
+    def _upload_loop(self):
+        while not self._stop.wait(self.upload_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Profile upload failed: {e}", exc_info=True)
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._started_at = time.perf_counter()
+        self._threads = [threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True),
+                         threading.Thread(target=self._upload_loop, name="profiler-uploader", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        target = self.server or self.dump_dir
+        logger.info(f"Profiler sampling at {self.sample_hz:g} Hz, exporting to {target}")
+
+    def stop(self, flush: bool = True):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        if self._started_at is not None:
+            self._run_s += time.perf_counter() - self._started_at
+            self._started_at = None
+        if flush:
+            self.flush()
+
+    def get_stats(self) -> Dict[str, float]:
+        """Sampling cost so far; `overhead` is the fraction of one core spent sampling."""
+        elapsed = self._run_s + (time.perf_counter() - self._started_at if self._started_at is not None else 0.0)
+        samples = self.stats["samples"]
+        return {**self.stats,
+                "avg_sample_us": round(1e6 * self.stats["sampling_s"] / samples, 1) if samples else 0.0,
+                "overhead": round(self.stats["sampling_s"] / elapsed, 5) if elapsed else 0.0}
+
+
+def get_profiler() -> Optional[BotProfiler]:
+    """
+    Returns a profiler when PROFILER_ENABLED is true. Profiles go to
+    PYROSCOPE_SERVER_ADDRESS if set, and to PROFILER_DUMP_DIR (default ./profiles)
+    when that is unset or unreachable.
+    """
+    if os.environ.get("PROFILER_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    return BotProfiler(
+        app_name=os.environ.get("PROFILER_APP_NAME", "chatops-bot"),
+        server=os.environ.get("PYROSCOPE_SERVER_ADDRESS"),
+        sample_hz=float(os.environ.get("PROFILER_SAMPLE_HZ", DEFAULT_SAMPLE_HZ)),
+        upload_interval=float(os.environ.get("PROFILER_UPLOAD_INTERVAL", DEFAULT_UPLOAD_INTERVAL)),
+        dump_dir=os.environ.get("PROFILER_DUMP_DIR", "profiles"),
+        auth_token=os.environ.get("PYROSCOPE_AUTH_TOKEN"),
+        cpu_only=os.environ.get("PROFILER_CPU_ONLY", "true").lower() in ("1", "true", "yes"),
+    )
+
+
+# Overhead measurement: python bot_profiler.py [sample_hz] [idle_threads]
+if __name__ == "__main__":
+    import hashlib
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+    sample_hz = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAMPLE_HZ
+    idle_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    # A bot process under load: one busy handler thread and many idle pool threads. (With several
+    # CPU-bound threads the result is dominated by how the GIL gets handed between them.)
+    idle = threading.Event()
+    for i in range(idle_threads):
+        threading.Thread(target=idle.wait, name=f"ThreadPoolExecutor-0_{i}", daemon=True).start()
+
+    @bot_metrics.instrument_command("/burn-cpu")
+    def burn(seconds):
+        deadline = time.perf_counter() + seconds
+        ops = 0
+        while time.perf_counter() < deadline:
+            hashlib.sha256(str(ops).encode()).digest()
+            ops += 1
+        return ops
+
+    def throughput(seconds=3.0):
+        results = []
+        worker = threading.Thread(target=lambda: results.append(burn(seconds)), name="handler_0")
+        worker.start()
+        worker.join()
+        return results[0] / seconds
+
+    # Interleave rounds so drift in CPU frequency / noisy neighbours hits both sides equally
+    profiler = BotProfiler(sample_hz=sample_hz, upload_interval=3600, dump_dir=tempfile.mkdtemp())
+    baselines, profiled = [], []
+    for _ in range(3):
+        baselines.append(throughput())
+        profiler.start()
+        profiled.append(throughput())
+        profiler.stop(flush=False)
+    stats = profiler.get_stats()
+    profiler.flush()
+    dumps = sorted(profiler.dump_dir.glob("*.folded"))
+    top = max((line for d in dumps for line in d.read_text().splitlines()),
+              key=lambda line: int(line.rsplit(" ", 1)[1]), default="")
+    baseline, profiled = sorted(baselines)[1], sorted(profiled)[1]
+    logger.info(f"{sample_hz:g} Hz, {idle_threads} idle threads: throughput {baseline:,.0f} -> {profiled:,.0f} ops/s "
+                f"({100 * (1 - profiled / baseline):+.1f}% slowdown); sampler {stats['avg_sample_us']} us/sample, "
+                f"{100 * stats['overhead']:.2f}% of one core; {stats['stacks']} stacks in {len(dumps)} dumps under {profiler.dump_dir}")
+    logger.info(f"Hottest stack: ...{top[-160:]}")
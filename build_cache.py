@@ -0,0 +1,189 @@
+# build_cache.py
+"""
+Content-addressed cache for the website image builds.
+
+The build context is hashed from its files' paths, modes and SHA-256 digests
+(a file whose size and mtime are unchanged since the last run reuses its
+recorded digest, so an unchanged tree is not re-read). Images are tagged
+`<repo>:ctx-<hash>`; when an image with the context's tag already exists the
+build is skipped and that image is re-tagged. A JSON manifest in
+BUILD_CACHE_DIR keeps the file digests, the build time of each context and
+running hit/miss totals between runs, so every build can report its hit
+rate and the build time it saved.
+
+Only the files build_context.py would send are hashed: a file excluded by
+.dockerignore can change without invalidating the cache. On a miss the
+same file list is streamed to the daemon as the build context.
+"""
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import docker
+
+import build_context
+import docker_handler
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+# Build records kept per image repository
+MAX_BUILDS = 20
+
+_lock = threading.Lock()
+
+
+def _cache_dir() -> str:
+    return os.environ.get("BUILD_CACHE_DIR", ".build_cache")
+
+
+def _manifest_path() -> str:
+    return os.path.join(_cache_dir(), "manifest.json")
+
+
+def load_manifest() -> Dict[str, Any]:
+    try:
+        with open(_manifest_path()) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable build cache manifest: {e}")
+    return {"version": MANIFEST_VERSION, "files": {}, "builds": {}, "totals": {}}
+
+
+def save_manifest(manifest: Dict[str, Any]):
+    """Writes the manifest atomically (bot processes may build concurrently)."""
+    os.makedirs(_cache_dir(), exist_ok=True)
+    tmp = f"{_manifest_path()}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    os.replace(tmp, _manifest_path())
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def context_digest(entries: List[build_context.ContextEntry],
+                   known: Optional[Dict[str, list]] = None) -> Tuple[str, Dict[str, list], int]:
+    """
+    Hash of the build context made of `entries` (from build_context.walk_context).
+    `known` maps relative paths to
+    [size, mtime_ns, sha256] from the previous run; files whose size and mtime
+    still match are not read again. Returns (hex digest, updated file table,
+    number of files hashed from disk).
+    """
+    known = known or {}
+    files: Dict[str, list] = {}
+    context = hashlib.sha256()
+    rehashed = 0
+    for rel, full, st in entries:
+        if stat.S_ISLNK(st.st_mode):
+            content = "link:" + os.readlink(full)
+        else:
+            entry = known.get(rel)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                content = entry[2]
+            else:
+                content = _file_digest(full)
+                rehashed += 1
+            files[rel] = [st.st_size, st.st_mtime_ns, content]
+        # The executable bit is part of the image; other mode bits and mtimes are not
+        context.update(f"{rel}\0{bool(st.st_mode & 0o111)}\0{content}\n".encode())
+    return context.hexdigest(), files, rehashed
+
+
+def cached_build(client, path: str, tag: str, dockerfile: Optional[str] = None,
+                 progress: Optional[Callable[[str], None]] = None, excludes: Iterable[str] = ()):
+    """
+    Builds `path` into `tag` unless an image of the same context already exists.
+    `excludes` are ignore patterns applied on top of the context's .dockerignore.
+    Returns (image, report): whether it was a hit, the content tag, hashing and
+    build seconds, the build time saved, the context size and upload time on a
+    miss, and this repository's running totals.
+    """
+    progress = progress or (lambda message: None)
+    repository, tag_name = docker.utils.parse_repository_tag(tag)
+    t0 = time.monotonic()
+    with _lock:
+        manifest = load_manifest()
+    context_key = f"{os.path.abspath(path)}|{dockerfile or 'Dockerfile'}"
+    entries, ignored = build_context.walk_context(path, dockerfile, excludes)
+    digest, files, rehashed = context_digest(entries, manifest["files"].get(context_key))
+    # The Dockerfile name selects a different recipe over the same files
+    digest = hashlib.sha256(f"{digest}|{dockerfile or 'Dockerfile'}".encode()).hexdigest()
+    content_tag = f"{repository}:ctx-{digest[:12]}"
+    hash_s = time.monotonic() - t0
+
+    try:
+        image = client.images.get(content_tag)
+        hit = True
+    except docker.errors.ImageNotFound:
+        hit = False
+    if hit:
+        progress(f"Build cache hit: {content_tag} (context unchanged)")
+        build_s = 0.0
+        context = None
+    else:
+        progress(f"Build cache miss: building {content_tag}")
+        t1 = time.monotonic()
+        stream = build_context.ContextStream(entries, ignored)
+        progress(f"Sending build context: {build_context.format_size(stream.size)} "
+                 f"({len(entries)} files, {ignored} ignored)")
+        image = docker_handler.build_image(client, path, content_tag, dockerfile=dockerfile,
+                                           progress=progress, context=stream)
+        build_s = time.monotonic() - t1
+        context = stream.report()
+    image.tag(repository, tag=tag_name or "latest")
+    # Recency and hits for the image garbage collector
+    docker_handler.record_image_use(image.id, hit=hit)
+
+    with _lock, docker_handler.locked_file(_manifest_path()):
+        # Re-read under the lock: another process may have built meanwhile
+        manifest = load_manifest()
+        manifest["files"][context_key] = files
+        builds = manifest["builds"].setdefault(repository, {})
+        record = builds.pop(digest, None) or {"build_s": build_s, "built_at": time.time()}
+        record["used_at"] = time.time()
+        record["image_id"] = image.id
+        builds[digest] = record
+        while len(builds) > MAX_BUILDS:
+            builds.pop(next(iter(builds)))
+        totals = manifest["totals"].setdefault(repository, {"hits": 0, "misses": 0, "saved_s": 0.0})
+        saved_s = max(record["build_s"] - hash_s, 0.0) if hit else 0.0
+        totals["hits" if hit else "misses"] += 1
+        totals["saved_s"] += saved_s
+        try:
+            save_manifest(manifest)
+        except OSError as e:
+            logger.warning(f"Could not save build cache manifest: {e}")
+    report = {"hit": hit, "tag": content_tag, "digest": digest, "hash_s": round(hash_s, 3),
+              "files_hashed": rehashed, "files": len(files), "build_s": round(build_s, 2),
+              "saved_s": round(saved_s, 2), "hits": totals["hits"], "misses": totals["misses"],
+              "total_saved_s": round(totals["saved_s"], 1), "ignored": ignored, "context": context}
+    logger.info(f"Build of {tag}: {format_cache_report(report)}")
+    return image, report
+
+
+def format_cache_report(report: Dict[str, Any]) -> str:
+    total = report["hits"] + report["misses"]
+    rate = (f"hit rate {report['hits']}/{total} ({report['hits'] / total:.0%}), "
+            f"{report['total_saved_s']:.0f}s saved so far")
+    if report["hit"]:
+        return (f"cache hit `{report['tag']}`, build skipped (~{report['saved_s']:.1f}s saved; "
+                f"context hashed in {report['hash_s']:.2f}s); {rate}")
+    return (f"cache miss, built `{report['tag']}` in {report['build_s']:.1f}s "
+            f"({report['files_hashed']}/{report['files']} files re-hashed); "
+            f"{build_context.format_context_report(report['context'])}; {rate}")
@@ -0,0 +1,270 @@
+# build_context.py
+"""
+Minimal, streamed Docker build contexts.
+
+`images.build(path=...)` walks the whole directory and tars it into memory
+before the upload starts. Here the context is the directory minus whatever
+its .dockerignore (plus any excludes the caller adds) rules out. The file
+list comes from a single walk that build_cache also hashes, so ignored files
+neither reach the daemon nor change the context hash. The tar is generated
+while the daemon reads it: file data is read from disk in blocks as the
+request body is sent, and the body length is known up front from the walk.
+Tar headers depend only on a file's name, size, mode and mtime, so the
+headers of unchanged files are reused from earlier builds.
+"""
+import logging
+import os
+import re
+import stat
+import tarfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BLOCK = tarfile.BLOCKSIZE
+READ_SIZE = 64 * 1024
+# Tar headers kept between builds, keyed by name, size, mode and mtime
+MAX_CACHED_HEADERS = 20_000
+
+_header_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+_header_lock = threading.Lock()
+
+
+class ContextEntry(NamedTuple):
+    rel: str       # path inside the context, "/"-separated
+    full: str      # path on disk
+    st: os.stat_result
+
+
+def _translate(pattern: str) -> "re.Pattern":
+    """Regex for a .dockerignore pattern (Go filepath.Match syntax plus `**`)."""
+    regex, i = "", 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i):
+            # "**/" matches any number of directories, including none
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            else:
+                regex += ".*"
+                i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("^") or body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body.replace(chr(92), chr(92) * 2)}]"
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex)
+
+
+class IgnoreRules:
+    """
+    .dockerignore semantics: the last matching pattern wins, `!` re-includes,
+    and a pattern that matches a directory excludes everything below it.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.rules: List[Tuple[bool, "re.Pattern"]] = []
+        for line in patterns:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:].strip()
+            line = os.path.normpath(line).replace(os.sep, "/").lstrip("/")
+            if line in ("", "."):
+                continue
+            self.rules.append((negate, _translate(line)))
+        self.has_exceptions = any(negate for negate, _ in self.rules)
+
+    @classmethod
+    def load(cls, path: str, excludes: Iterable[str] = ()) -> "IgnoreRules":
+        patterns = list(excludes)
+        try:
+            with open(os.path.join(path, ".dockerignore"), encoding="utf-8") as f:
+                patterns += f.read().splitlines()
+        except FileNotFoundError:
+            pass
+        return cls(patterns)
+
+    def excluded(self, rel: str) -> bool:
+        parts = rel.split("/")
+        prefixes = ["/".join(parts[:n]) for n in range(1, len(parts) + 1)]
+        result = False
+        for negate, regex in self.rules:
+            if any(regex.fullmatch(prefix) for prefix in prefixes):
+                result = not negate
+        return result
+
+
+def walk_context(path: str, dockerfile: Optional[str] = None,
+                 excludes: Iterable[str] = ()) -> Tuple[List[ContextEntry], int]:
+    """
+    Regular files and symlinks of the context at `path` that the ignore rules
+    keep, in a stable order. The Dockerfile and .dockerignore are always sent,
+    as `docker build` does. Returns (entries, number of paths ignored).
+    """
+    rules = IgnoreRules.load(path, excludes)
+    always = {(dockerfile or "Dockerfile").replace(os.sep, "/"), ".dockerignore"}
+    entries: List[ContextEntry] = []
+    ignored = 0
+    for root, dirs, names in os.walk(path):
+        rel_root = os.path.relpath(root, path).replace(os.sep, "/")
+        rel_root = "" if rel_root == "." else rel_root + "/"
+        dirs.sort()
+        if not rules.has_exceptions:
+            # Nothing below an excluded directory can be re-included, so don't descend
+            kept = [d for d in dirs if not rules.excluded(rel_root + d)]
+            ignored += len(dirs) - len(kept)
+            dirs[:] = kept
+        for name in sorted(names):
+            rel = rel_root + name
+            if rel not in always and rules.excluded(rel):
+                ignored += 1
+                continue
+            full = os.path.join(root, name)
+            st = os.lstat(full)
+            if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                entries.append(ContextEntry(rel, full, st))
+    return entries, ignored
+
+
+def _mode(st: os.stat_result) -> int:
+    # Only the executable bit is kept (the same bit the context hash covers)
+    return 0o755 if st.st_mode & 0o111 else 0o644
+
+
+def _header(entry: ContextEntry) -> bytes:
+    st = entry.st
+    link = os.readlink(entry.full) if stat.S_ISLNK(st.st_mode) else ""
+    key = (entry.rel, st.st_size, st.st_mode, st.st_mtime_ns, link)
+    with _header_lock:
+        header = _header_cache.get(key)
+        if header is not None:
+            _header_cache.move_to_end(key)
+            return header
+    info = tarfile.TarInfo(entry.rel)
+    info.mtime = int(st.st_mtime)
+    if link:
+        info.type, info.linkname, info.mode, info.size = tarfile.SYMTYPE, link, 0o777, 0
+    else:
+        info.mode, info.size = _mode(st), st.st_size
+    header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+    with _header_lock:
+        _header_cache[key] = header
+        while len(_header_cache) > MAX_CACHED_HEADERS:
+            _header_cache.popitem(last=False)
+    return header
+
+
+def _padding(size: int) -> int:
+    return -size % BLOCK
+
+
+class ContextStream:
+    """
+    File-like tar of `entries`, produced as it is read. Its length is exact,
+    so the request carries a Content-Length and only one block of file data
+    is in memory at a time. After the upload, `report()` gives its size and
+    how long the daemon took to read it.
+    """
+
+    def __init__(self, entries: List[ContextEntry], ignored: int = 0):
+        self.entries = entries
+        self.ignored = ignored
+        self._headers = [_header(entry) for entry in entries]
+        self.size = sum(len(header) + (0 if stat.S_ISLNK(entry.st.st_mode)
+                                       else entry.st.st_size + _padding(entry.st.st_size))
+                        for entry, header in zip(entries, self._headers)) + 2 * BLOCK
+        self._chunks = self._generate()
+        self._buffer = b""
+        self._offset = 0
+        self.sent = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _generate(self) -> Iterator[bytes]:
+        for entry, header in zip(self.entries, self._headers):
+            yield header
+            if stat.S_ISLNK(entry.st.st_mode):
+                continue
+            remaining = entry.st.st_size
+            with open(entry.full, "rb") as f:
+                while remaining:
+                    block = f.read(min(READ_SIZE, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+            if remaining:
+                # Shrunk since the walk: pad so the archive stays the announced size
+                logger.warning(f"{entry.rel} changed during the build context upload")
+                yield b"\0" * remaining
+            yield b"\0" * _padding(entry.st.st_size)
+        yield b"\0" * (2 * BLOCK)
+
+    def read(self, size: int = -1) -> bytes:
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        available = len(self._buffer) - self._offset
+        if size < 0 or available < size:
+            parts = [self._buffer[self._offset:]]
+            while size < 0 or available < size:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                parts.append(chunk)
+                available += len(chunk)
+            self._buffer, self._offset = b"".join(parts), 0
+        end = len(self._buffer) if size < 0 else self._offset + size
+        data = self._buffer[self._offset:end]
+        self._offset += len(data)
+        self.sent += len(data)
+        if not data and self.finished_at is None:
+            self.finished_at = time.monotonic()
+        return data
+
+    def report(self) -> Dict[str, Any]:
+        upload_s = None
+        if self.started_at is not None:
+            upload_s = round((self.finished_at or time.monotonic()) - self.started_at, 3)
+        return {"bytes": self.size, "sent": self.sent, "files": len(self.entries),
+                "ignored": self.ignored, "upload_s": upload_s}
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def format_context_report(report: Dict[str, Any]) -> str:
+    text = f"context {format_size(report['bytes'])} ({report['files']} files, {report['ignored']} ignored)"
+    if report["upload_s"] is not None:
+        text += f" uploaded in {report['upload_s']:.2f}s"
+    return text
@@ -0,0 +1,126 @@
+# capacity_forecasting.py
+import logging
+import warnings
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def fit_trend(timestamps: np.ndarray, values: np.ndarray):
+    """
+    Least-squares linear trend for every row of `values` at once, ignoring NaNs.
+    Returns (slope per second, level at the last timestamp).
+    """
+    valid = ~np.isnan(values)
+    weights = valid.astype(float)
+    filled = np.where(valid, values, 0.0)
+    t = timestamps - timestamps[-1]
+    n = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t_mean = (weights * t).sum(axis=1) / n
+        y_mean = filled.sum(axis=1) / n
+        dt = (t[None, :] - t_mean[:, None]) * weights
+        slope = (dt * (filled - y_mean[:, None])).sum(axis=1) / (dt * dt).sum(axis=1)
+    slope = np.where(n >= 2, slope, 0.0)
+    level = y_mean - slope * t_mean
+    return slope, level
+
+
+def seasonal_profile(residuals: np.ndarray, period: int) -> np.ndarray:
+    """
+    Average residual for each phase of the period (e.g. hour of day), aligned so
+    that the last column of `residuals` is the last phase. Zero-centred per series.
+    """
+    n_series, n_points = residuals.shape
+    if period < 2 or n_points < 2 * period:
+        return np.zeros((n_series, max(period, 1)))
+    pad = (-n_points) % period
+    padded = np.concatenate([np.full((n_series, pad), np.nan), residuals], axis=1)
+    with warnings.catch_warnings():
+        # Phases with no samples at all are expected for short or gappy series
+        warnings.simplefilter("ignore", RuntimeWarning)
+        profile = np.nanmean(padded.reshape(n_series, -1, period), axis=1)
+        profile = profile - np.nanmean(profile, axis=1, keepdims=True)
+    return np.nan_to_num(profile, nan=0.0)
+
+
+def forecast(timestamps: np.ndarray, values: np.ndarray, horizon_s: float,
+             period: int = 24, capacity: float = 1.0) -> Dict[str, np.ndarray]:
+    """
+    Trend + seasonal forecast for every series (rows of `values`).
+
+    Returns per-series arrays: current value, slope per day, predicted value at
+    `horizon_s`, and seconds until trend plus seasonal peak reaches `capacity`
+    (0 if already there, inf if it never does on the current trend).
+    """
+    values = np.asarray(values, dtype=float)
+    step = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 1.0
+    slope, level = fit_trend(timestamps, values)
+    trend = level[:, None] + slope[:, None] * (timestamps - timestamps[-1])[None, :]
+    profile = seasonal_profile(values - trend, period)
+    # Refit the trend on the deseasonalised data so partial cycles don't bias the slope
+    phases = (np.arange(values.shape[1]) - values.shape[1]) % profile.shape[1]
+    slope, level = fit_trend(timestamps, values - profile[:, phases])
+
+    # Phase of the forecast point relative to the last observed column
+    horizon_steps = int(round(horizon_s / step))
+    phase = (horizon_steps - 1) % profile.shape[1]
+    predicted = level + slope * horizon_s + profile[:, phase]
+
+    valid = ~np.isnan(values)
+    last_idx = np.where(valid.any(axis=1), values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1), 0)
+    current = values[np.arange(values.shape[0]), last_idx]
+
+    # Exhaustion when the seasonal peak on top of the trend crosses capacity
+    peak = level + profile.max(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tte = np.where(slope > 0, (capacity - peak) / slope, np.inf)
+    tte = np.where((peak >= capacity) | (current >= capacity), 0.0, np.maximum(tte, 0.0))
+    tte = np.where(np.isnan(tte), np.inf, tte)
+    return {
+        "current": current,
+        "slope_per_day": slope * 86400,
+        "predicted": predicted,
+        "time_to_exhaustion_s": tte
+    }
+
+
+def format_time_to_exhaustion(seconds: Optional[float]) -> str:
+    """Human-readable time to exhaustion."""
+    if seconds is None or not np.isfinite(seconds):
+        return "not projected"
+    if seconds <= 0:
+        return "now"
+    days, remainder = divmod(int(seconds), 86400)
+    hours = remainder // 3600
+    if days > 365:
+        return "> 1 year"
+    return f"{days}d {hours}h" if days else f"{hours}h {(remainder % 3600) // 60}m"
+
+
+# Benchmark: python capacity_forecasting.py [n_series]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+    n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_points = 7 * 24  # 7 days at 1h resolution
+    rng = np.random.default_rng(7)
+    ts = time.time() - 3600 * np.arange(n_points)[::-1]
+    growth = rng.uniform(-0.0005, 0.003, size=(n_series, 1))
+    daily = 0.1 * np.sin(2 * np.pi * np.arange(n_points) / 24)
+    data = rng.uniform(0.2, 0.6, size=(n_series, 1)) + growth * np.arange(n_points) + daily
+    data += rng.normal(0, 0.01, data.shape)
+    data[rng.random(data.shape) < 0.03] = np.nan
+
+    t0 = time.perf_counter()
+    result = forecast(ts, data, horizon_s=7 * 86400)
+    elapsed = time.perf_counter() - t0
+    true_slope = growth[:, 0] * 24
+    error = np.nanmedian(np.abs(result["slope_per_day"] - true_slope))
+    logger.info(f"{n_series} series x {n_points} points in {elapsed * 1000:.1f} ms; "
+                f"median slope error {error:.5f}/day; "
+                f"{np.isfinite(result['time_to_exhaustion_s']).sum()} series projected to exhaust")
@@ -1,10 +1,24 @@
 # docker_handler.py
 import docker
 from docker.errors import DockerException
+import contextlib
 import logging
+import json
 import os
+import re
+import threading
+import time
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import build_context
+import log_pipeline
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only the in-process locks apply
+    fcntl = None
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO)
@@ -110,45 +124,368 @@ def get_container_logs(client: docker.DockerClient, container_name: str, lines=5
     except Exception as e:
         return False, f"Error retrieving logs: {str(e)}"
 
-def get_recent_logs(client, container_id=None, max_lines=100):
+def get_unhealthy_containers(client: docker.DockerClient):
+    """
+    Returns containers that are exited with a non-zero code, restarting, dead,
+    or reported unhealthy by their HEALTHCHECK.
+    """
+    if not client:
+        return False, "Docker client not initialized."
+    try:
+        unhealthy = []
+        for container in client.containers.list(all=True):
+            state = container.attrs.get("State", {})
+            health = (state.get("Health") or {}).get("Status")
+            exit_code = state.get("ExitCode", 0)
+            if (container.status in ("restarting", "dead")
+                    or (container.status == "exited" and exit_code != 0)
+                    or health == "unhealthy"):
+                unhealthy.append({
+                    "name": container.name,
+                    "id": container.short_id,
+                    "image": container.image.tags[0] if container.image.tags else container.image.short_id,
+                    "status": container.status,
+                    "health": health,
+                    "exit_code": exit_code,
+                    "restart_count": container.attrs.get("RestartCount", 0),
+                    "error": state.get("Error") or None
+                })
+        return True, unhealthy
+    except DockerException as e:
+        logger.error(f"DockerException while listing unhealthy containers: {e}")
+        return False, f"Error listing containers: Could not communicate with Docker daemon. ({e})"
+    except Exception as e:
+        logger.error(f"An unexpected error occurred listing unhealthy containers: {e}", exc_info=True)
+        return False, f"Error listing containers: {str(e)}"
+
+def iter_container_logs(container, max_lines=100, since=None):
+    """
+    Streams one container's recent log lines as log_pipeline records (and on to Loki, if configured).
+    `max_lines=None` reads the whole log; `since` (unix seconds) skips older lines.
+    """
+    try:
+        options = {"since": int(since)} if since else {}
+        stream = container.logs(stream=True, follow=False, tail=max_lines or "all", timestamps=True, **options)
+        records = log_pipeline.parse_records("docker", container.name, log_pipeline.iter_lines(stream))
+        yield from log_pipeline.to_shipper(records, {"source": "docker", "container": container.name})
+    except docker.errors.APIError as e:
+        yield log_pipeline.error_record("docker", container.name, f"Error getting logs: {str(e)}")
+
+
+def get_log_streams(client, container_id=None, max_lines=100, since=None):
+    """One lazy record stream per container (or just `container_id`). Raises docker.errors.NotFound."""
+    containers = [client.containers.get(container_id)] if container_id else client.containers.list()
+    return [iter_container_logs(container, max_lines, since) for container in containers]
+
+
+def get_recent_logs(client, container_id=None, max_lines=100, max_chars=None, merged=False):
     """
     Get recent logs from Docker containers.
     If container_id is provided, gets logs for that specific container.
     Otherwise, gets logs from all running containers.
+    `max_chars` caps the returned text (newest lines are kept); `merged` interleaves
+    containers by time instead of listing them one after another.
     """
     try:
         if not client:
             return False, "Docker client not initialized"
-        
-        if container_id:
-            # Get logs for specific container
-            try:
-                container = client.containers.get(container_id)
-                logs = container.logs(tail=max_lines, timestamps=True).decode('utf-8')
-                return True, logs
-            except docker.errors.NotFound:
-                return False, f"Container {container_id} not found. Use '/docker-ps' to see available containers."
-            except docker.errors.APIError as e:
-                return False, f"Error getting logs for container {container_id}: {str(e)}"
-        else:
-            # Get logs from all running containers
-            containers = client.containers.list()
-            if not containers:
-                return False, "No running containers found. To start a sample container, you can use:\n```docker run -d --name my-nginx nginx```"
-            
-            all_logs = []
-            for container in containers:
-                try:
-                    logs = container.logs(tail=max_lines, timestamps=True).decode('utf-8')
-                    all_logs.append(f"=== Container: {container.name} ({container.id[:12]}) ===\n{logs}")
-                except docker.errors.APIError as e:
-                    all_logs.append(f"=== Container: {container.name} ({container.id[:12]}) ===\nError getting logs: {str(e)}")
-            
-            if not all_logs:
-                return False, "No logs found in any containers. The containers might be too new or not generating logs yet."
-            
-            return True, "\n\n".join(all_logs)
-            
+
+        try:
+            streams = get_log_streams(client, container_id, max_lines)
+        except docker.errors.NotFound:
+            return False, f"Container {container_id} not found. Use '/docker-ps' to see available containers."
+        if not streams:
+            return False, "No running containers found. To start a sample container, you can use:\n```docker run -d --name my-nginx nginx```"
+
+        count, logs = log_pipeline.collect_streams(streams, max_chars, merged)
+        if not count:
+            return False, "No logs found in any containers. The containers might be too new or not generating logs yet."
+        return True, logs
+
     except Exception as e:
         logger.error(f"Error getting Docker logs: {str(e)}")
-        return False, f"Error getting logs: {str(e)}"
\ No newline at end of file
+        return False, f"Error getting logs: {str(e)}"
+
+# --- Image pulls and builds with progress ---
+def pull_image(client, image, progress=None):
+    """
+    Pulls `image` through the streaming API, calling `progress(message)` as
+    layers complete. Returns the Image. Raises docker.errors.NotFound for an
+    unknown image and docker.errors.APIError for other failures.
+    """
+    repository, tag = docker.utils.parse_repository_tag(image)
+    layers, done = set(), set()
+    for event in client.api.pull(repository, tag=tag or "latest", stream=True, decode=True):
+        if "error" in event:
+            raise docker.errors.APIError(event["error"])
+        layer, status = event.get("id"), event.get("status", "")
+        if not layer or status.startswith(("Pulling from", "Digest", "Status")):
+            continue
+        layers.add(layer)
+        if status in ("Pull complete", "Already exists") and layer not in done:
+            done.add(layer)
+            if progress:
+                progress(f"Pulled {len(done)}/{len(layers)} layers of {image}")
+    return client.images.get(image if tag else f"{repository}:latest")
+
+
+def build_image(client, path, tag, dockerfile=None, progress=None, context=None):
+    """
+    Builds `path` into `tag` through the streaming API, calling `progress(message)`
+    at each Dockerfile step. `context` is an uncompressed tar file object to send
+    instead of `path` (see build_context.py). Returns the Image; raises
+    docker.errors.BuildError.
+    """
+    if context is not None:
+        source = {"fileobj": context, "custom_context": True}
+    else:
+        source = {"path": path}
+    build_log = []
+    for event in client.api.build(tag=tag, dockerfile=dockerfile, rm=True, decode=True, **source):
+        build_log.append(event)
+        del build_log[:-50]
+        if "error" in event:
+            raise docker.errors.BuildError(event["error"], build_log)
+        line = event.get("stream", "").strip()
+        if progress and line.startswith("Step "):
+            progress(line)
+    return client.images.get(tag)
+
+
+# --- Image garbage collection ---
+# `docker system prune` drops the images later builds would reuse. This removes
+# images least-recently used first, and only until image storage is back
+# under IMAGE_GC_TARGET. It never removes:
+#  * images that containers (running or stopped) were created from,
+#  * the IMAGE_GC_KEEP_TAGS most recently used images of each repository,
+#  * base images of anything kept (their layers are a prefix of a kept
+#    image's), so `FROM` lines keep resolving locally,
+#  * images used within the last IMAGE_GC_MIN_AGE seconds.
+# Usage comes from BUILD_CACHE_DIR/image_usage.json: build_cache records each
+# build (and whether it was a cache hit), and every collection records the
+# images that containers use.
+IMAGE_GC_KEEP_TAGS = int(os.environ.get("IMAGE_GC_KEEP_TAGS", "3"))
+IMAGE_GC_MIN_AGE = float(os.environ.get("IMAGE_GC_MIN_AGE", "3600"))
+IMAGE_GC_INTERVAL = float(os.environ.get("IMAGE_GC_INTERVAL", "3600"))
+# Usage records kept (least recently used are dropped first)
+MAX_USAGE_RECORDS = 2000
+
+_SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+_usage_lock = threading.Lock()
+
+
+def parse_size(text) -> int:
+    """Bytes in "20GB", "512 MB" or "1048576"."""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?B?)\s*", str(text).upper())
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    unit = match.group(2)
+    return int(float(match.group(1)) * _SIZE_UNITS[unit if unit.endswith("B") or not unit else unit + "B"])
+
+
+def _usage_path() -> str:
+    return os.path.join(os.environ.get("BUILD_CACHE_DIR", ".build_cache"), "image_usage.json")
+
+
+def load_image_usage() -> Dict[str, Dict]:
+    """{image id: {"used_at", "uses", "hits"}}"""
+    try:
+        with open(_usage_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable image usage file: {e}")
+        return {}
+
+
+@contextlib.contextmanager
+def locked_file(path: str):
+    """
+    Holds an exclusive flock on `path`.lock, so that a load, update and replace
+    of the JSON file at `path` is not interleaved with another process's.
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        lock = open(f"{path}.lock", "a")
+    except OSError as e:
+        # The write that follows will most likely fail and be reported too
+        logger.warning(f"Could not lock {path}: {e}")
+        yield
+        return
+    with lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def record_image_use(image_ids, hit: bool = False, now: Optional[float] = None):
+    """Marks `image_ids` as used now. `hit` counts a build cache hit on them."""
+    now = now or time.time()
+    try:
+        with _usage_lock, locked_file(_usage_path()):
+            usage = load_image_usage()
+            for image_id in ([image_ids] if isinstance(image_ids, str) else image_ids):
+                record = usage.pop(image_id, None) or {"uses": 0, "hits": 0}
+                record["used_at"] = now
+                record["uses"] += 1
+                record["hits"] += int(hit)
+                usage[image_id] = record
+            while len(usage) > MAX_USAGE_RECORDS:
+                usage.pop(next(iter(usage)))
+            tmp = f"{_usage_path()}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(usage, f, separators=(",", ":"))
+            os.replace(tmp, _usage_path())
+    except OSError as e:
+        logger.warning(f"Could not save image usage: {e}")
+
+
+def _image_inventory(client) -> Tuple[List[Dict], int]:
+    """Images with their tags, sizes and layer chains, and the total size of all layers."""
+    df = client.df()
+    images = []
+    for summary in df.get("Images") or []:
+        try:
+            layers = client.api.inspect_image(summary["Id"])["RootFS"].get("Layers") or []
+        except docker.errors.NotFound:
+            continue
+        shared = summary.get("SharedSize", -1)
+        images.append({"id": summary["Id"],
+                       "tags": [tag for tag in summary.get("RepoTags") or [] if tag != "<none>:<none>"],
+                       "created": summary.get("Created", 0), "size": summary.get("Size", 0),
+                       # Bytes only this image holds: what removing it frees
+                       "unique": summary.get("Size", 0) - (shared if shared > 0 else 0),
+                       "layers": tuple(layers)})
+    return images, df.get("LayersSize") or sum(image["unique"] for image in images)
+
+
+def collect_images(client, target: Optional[int] = None, keep_tags: int = IMAGE_GC_KEEP_TAGS,
+                   min_age: float = IMAGE_GC_MIN_AGE, dry_run: bool = False,
+                   progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """
+    Removes least-recently-used images until the images take at most `target`
+    bytes (default IMAGE_GC_TARGET, 20GB). Returns the report (see
+    format_gc_report); with `dry_run` nothing is removed.
+    """
+    progress = progress or (lambda message: None)
+    target = parse_size(os.environ.get("IMAGE_GC_TARGET", "20GB")) if target is None else target
+    now = time.time()
+    in_use = {container.attrs.get("Image") for container in client.containers.list(all=True)}
+    in_use.discard(None)
+    if in_use:
+        record_image_use(in_use, now=now)
+    usage = load_image_usage()
+    images, before = _image_inventory(client)
+    for image in images:
+        image["used_at"] = usage.get(image["id"], {}).get("used_at") or image["created"]
+
+    keep: Dict[str, str] = {image["id"]: "in use" for image in images if image["id"] in in_use}
+    repositories: Dict[str, List[Dict]] = {}
+    for image in images:
+        for repository in {tag.rsplit(":", 1)[0] for tag in image["tags"]}:
+            repositories.setdefault(repository, []).append(image)
+    for members in repositories.values():
+        for image in sorted(members, key=lambda image: image["used_at"], reverse=True)[:keep_tags]:
+            keep.setdefault(image["id"], "recent")
+    for image in images:
+        if now - image["used_at"] < min_age:
+            keep.setdefault(image["id"], "just used")
+    # Base images: their layer chain is a prefix of a kept image's chain
+    kept_prefixes = {image["layers"][:n] for image in images if image["id"] in keep
+                     for n in range(1, len(image["layers"]))}
+    for image in images:
+        if image["id"] not in keep and image["layers"] in kept_prefixes:
+            keep[image["id"]] = "base"
+
+    report = {"before": before, "target": target, "removed": [], "errors": [], "dry_run": dry_run,
+              "kept": {reason: list(keep.values()).count(reason) for reason in sorted(set(keep.values()))}}
+    estimate, gone = before, set()
+    # Untagged images first (superseded builds), then the least recently used
+    candidates = sorted((image for image in images if image["id"] not in keep),
+                        key=lambda image: (bool(image["tags"]), image["used_at"]))
+    for image in candidates:
+        if estimate <= target:
+            break
+        name = ", ".join(image["tags"]) or image["id"][7:19]
+        if not dry_run:
+            try:
+                # Untag one by one: removing a multi-tag image by id needs force
+                for reference in image["tags"] or [image["id"]]:
+                    client.images.remove(reference)
+            except docker.errors.APIError as e:
+                # e.g. a child image still depends on it
+                report["errors"].append(f"{name}: {e.explanation or e}")
+                continue
+        progress(f"{'Would remove' if dry_run else 'Removed'} {name} ({build_context.format_size(image['unique'])})")
+        estimate -= image["unique"]
+        gone.add(image["id"])
+        report["removed"].append({"image": name, "bytes": image["unique"],
+                                  "idle_h": round((now - image["used_at"]) / 3600, 1)})
+
+    report["after"] = estimate if dry_run else _image_inventory(client)[1]
+    report["reclaimed"] = max(before - report["after"], 0)
+    # Of the build cache hits on the images there were, how many landed on images still here
+    hits = {image["id"]: usage.get(image["id"], {}).get("hits", 0) for image in images}
+    report["hits_preserved"] = (sum(count for image_id, count in hits.items() if image_id not in gone),
+                                sum(hits.values()))
+    report["images"] = len(images) - len(gone)
+    logger.info(f"Image GC: {format_gc_report(report)}")
+    return report
+
+
+def format_gc_report(report: Dict[str, Any]) -> str:
+    size = build_context.format_size
+    verb = "would reclaim" if report["dry_run"] else "reclaimed"
+    lines = [f"Images {size(report['before'])} → {size(report['after'])} (target {size(report['target'])}): "
+             f"{verb} {size(report['reclaimed'])} from {len(report['removed'])} image(s); "
+             f"{report['images']} left"]
+    lines.append("Kept: " + (", ".join(f"{count} {reason}" for reason, count in report["kept"].items()) or "none"))
+    kept_hits, hits = report["hits_preserved"]
+    if hits:
+        lines.append(f"Build cache: images with {kept_hits}/{hits} of the recorded hits kept ({kept_hits / hits:.0%})")
+    for entry in report["removed"][:10]:
+        lines.append(f"  - {entry['image']} ({size(entry['bytes'])}, idle {entry['idle_h']:.0f}h)")
+    if len(report["removed"]) > 10:
+        lines.append(f"  ... and {len(report['removed']) - 10} more")
+    for error in report["errors"][:5]:
+        lines.append(f"  ⚠️ {error}")
+    return "\n".join(lines)
+
+
+class ImageGarbageCollector:
+    """Runs collect_images every IMAGE_GC_INTERVAL seconds on a daemon thread."""
+
+    def __init__(self, client, interval: float = IMAGE_GC_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last_report = collect_images(self.client)
+            except Exception as e:
+                logger.error(f"Image garbage collection failed: {e}", exc_info=True)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="image-gc", daemon=True)
+        self._thread.start()
+        logger.info(f"Image garbage collection every {self.interval:.0f}s")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+def get_image_gc(client) -> Optional[ImageGarbageCollector]:
+    """The scheduled collector, unless there is no Docker client or IMAGE_GC_ENABLED is false."""
+    if client is None or os.environ.get("IMAGE_GC_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return ImageGarbageCollector(client)
@@ -0,0 +1,222 @@
+# idempotency_store.py
+"""
+Drops duplicate Slack deliveries before they reach a handler.
+
+Slack redelivers a command or event when it is not acknowledged in time, and
+with several bot processes the same delivery can land on two of them. Every
+request is keyed by its Slack IDs (event_id, trigger_id, action/view IDs) and
+claimed in an SQLite table shared by all processes on the host; only the
+first claim runs, later ones are acked and dropped. Claims expire after a TTL
+so the table stays small.
+
+The check sits on every request, so it is kept cheap: an in-process cache
+answers repeats seen by this process without touching SQLite, and a new claim
+is a single UPSERT in WAL mode with synchronous=NORMAL (no fsync per commit).
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 3600.0
+DEFAULT_CACHE_SIZE = 10_000
+# Expired rows are purged every this many claims
+PURGE_EVERY = 1000
+
+DEDUPE_REQUESTS = bot_metrics.REGISTRY.register(bot_metrics.Counter(
+    "chatops_dedupe_requests", "Slack deliveries checked for duplicates, by result", ["result"]))
+
+
+def dedupe_key(body: Dict) -> Optional[str]:
+    """
+    Identity of a Slack delivery, the same across Slack's retries. Slash commands,
+    shortcuts and interactions carry a unique trigger_id; events an event_id.
+    """
+    if body.get("event_id"):
+        return f"event:{body['event_id']}"
+    if body.get("trigger_id"):
+        return f"trigger:{body['trigger_id']}"
+    actions = body.get("actions") or []
+    if actions and actions[0].get("action_ts"):
+        user = (body.get("user") or {}).get("id", "")
+        return f"action:{user}:{actions[0].get('action_id', '')}:{actions[0]['action_ts']}"
+    view = body.get("view") or {}
+    if view.get("id") and view.get("hash"):
+        return f"view:{view['id']}:{view['hash']}"
+    return None
+
+
+class IdempotencyStore:
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.owner = f"{os.uname().nodename}:{os.getpid()}"
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # One connection shared under a lock: claims are tens of microseconds, so
+        # contention between handler threads is not worth per-thread connections
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS claims (
+                                key TEXT PRIMARY KEY,
+                                owner TEXT NOT NULL,
+                                claimed_at REAL NOT NULL,
+                                expires_at REAL NOT NULL
+                            ) WITHOUT ROWID""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS claims_expiry ON claims (expires_at)")
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, float]" = OrderedDict()
+        self._claims_since_purge = 0
+        self.stats = {"claimed": 0, "duplicate_cache": 0, "duplicate_store": 0, "purged": 0}
+
+    def claim(self, key: str) -> bool:
+        """True if this is the first delivery of `key` within the TTL (the caller should run it)."""
+        now = time.time()
+        with self._lock:
+            expires = self._cache.get(key)
+            if expires is not None and expires > now:
+                self.stats["duplicate_cache"] += 1
+                return False
+            # Insert, or take over a row whose claim has expired; changes() is 0 otherwise
+            cursor = self._db.execute(
+                """INSERT INTO claims (key, owner, claimed_at, expires_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, claimed_at = excluded.claimed_at,
+                                                  expires_at = excluded.expires_at
+                   WHERE claims.expires_at <= excluded.claimed_at""",
+                (key, self.owner, now, now + self.ttl))
+            claimed = cursor.rowcount == 1
+            # Either way the key is now taken until at least now + ttl (or the other claim's expiry)
+            self._cache[key] = now + self.ttl if claimed else now + min(self.ttl, 60.0)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self._claims_since_purge += 1
+            if self._claims_since_purge >= PURGE_EVERY:
+                self._purge(now)
+        self.stats["claimed" if claimed else "duplicate_store"] += 1
+        return claimed
+
+    def _purge(self, now: float):
+        self._claims_since_purge = 0
+        cursor = self._db.execute("DELETE FROM claims WHERE expires_at <= ?", (now,))
+        self.stats["purged"] += cursor.rowcount
+
+    def purge(self):
+        with self._lock:
+            self._purge(time.time())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT COUNT(*) FROM claims").fetchone()[0]
+        return {**self.stats, "rows": rows, "cached": len(self._cache)}
+
+
+def bolt_middleware(store: IdempotencyStore) -> Callable:
+    """
+    Global Bolt middleware: `app.middleware(bolt_middleware(store))`. Duplicate
+    deliveries are acknowledged (so Slack stops retrying) and not passed on. If
+    the store fails, the delivery is passed on.
+    """
+    def dedupe_slack_deliveries(body, next, ack, logger):
+        key = dedupe_key(body)
+        if key is None:
+            DEDUPE_REQUESTS.inc(result="unkeyed")
+            return next()
+        try:
+            claimed = store.claim(key)
+        except sqlite3.Error as e:
+            # e.g. "database is locked" under load: fail open, running a rare duplicate
+            # rather than dropping the delivery unacknowledged
+            DEDUPE_REQUESTS.inc(result="error")
+            logger.warning(f"Could not check Slack delivery {key} for duplicates: {e}")
+            return next()
+        if claimed:
+            DEDUPE_REQUESTS.inc(result="new")
+            return next()
+        DEDUPE_REQUESTS.inc(result="duplicate")
+        logger.info(f"Dropping duplicate Slack delivery {key}")
+        ack()
+    return dedupe_slack_deliveries
+
+
+def get_idempotency_store() -> Optional[IdempotencyStore]:
+    """
+    Store at IDEMPOTENCY_DB (default $BOT_STATE_DIR/idempotency.db, BOT_STATE_DIR
+    defaulting to ./state), unless IDEMPOTENCY_ENABLED is false. Processes that
+    should dedupe against each other must point at the same file on a local disk.
+    """
+    if os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    path = os.environ.get("IDEMPOTENCY_DB") or os.path.join(os.environ.get("BOT_STATE_DIR", "state"),
+                                                            "idempotency.db")
+    try:
+        return IdempotencyStore(path, ttl=float(os.environ.get("IDEMPOTENCY_TTL", DEFAULT_TTL)))
+    except sqlite3.Error as e:
+        logger.error(f"Could not open idempotency store {path}: {e}; duplicate deliveries will not be dropped")
+        return None
+
+
+# Hot-path cost and cross-process check: python idempotency_store.py [claims]
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    from multiprocessing import Pool
+
+    logging.basicConfig(level=logging.INFO)
+    claims = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CACHE_SIZE
+
+    def _race(args):
+        path, keys = args
+        store = IdempotencyStore(path)
+        return sum(store.claim(key) for key in keys)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "idempotency.db")
+        store = IdempotencyStore(path)
+        keys = [f"trigger:{hashlib.sha1(str(i).encode()).hexdigest()}" for i in range(claims)]
+
+        t0 = time.perf_counter()
+        for key in keys:
+            store.claim(key)
+        new_us = (time.perf_counter() - t0) / claims * 1e6
+        t0 = time.perf_counter()
+        for key in keys:
+            store.claim(key)
+        cached_us = (time.perf_counter() - t0) / claims * 1e6
+        # Another process's view: nothing cached locally, every check goes to SQLite
+        other = IdempotencyStore(path)
+        t0 = time.perf_counter()
+        duplicates = sum(not other.claim(key) for key in keys)
+        store_us = (time.perf_counter() - t0) / claims * 1e6
+        logger.info(f"{claims:,} claims: new {new_us:.1f} us, repeat (cached) {cached_us:.2f} us, "
+                    f"repeat seen by another process {store_us:.1f} us; {duplicates:,} duplicates detected")
+
+        # Four processes receive the same 2,000 deliveries: each must run exactly once
+        race_keys = [f"event:race-{i}" for i in range(2000)]
+        with Pool(4) as pool:
+            won = pool.map(_race, [(path, race_keys)] * 4)
+        logger.info(f"4 processes x {len(race_keys):,} identical deliveries: {sum(won):,} ran ({won})")
+
+        # Expired claims can be taken again, and are purged
+        short = IdempotencyStore(os.path.join(tmp, "short.db"), ttl=0.05)
+        first, repeat = short.claim("trigger:x"), short.claim("trigger:x")
+        time.sleep(0.06)
+        short._cache.clear()
+        after_ttl = short.claim("trigger:x")
+        time.sleep(0.06)
+        short.purge()
+        logger.info(f"ttl: first {first}, repeat {repeat}, after expiry {after_ttl}; {short.get_stats()}")
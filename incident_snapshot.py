@@ -0,0 +1,108 @@
+# incident_snapshot.py
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+import docker_handler
+import jenkins_handler
+import k8s_handler
+
+logger = logging.getLogger(__name__)
+
+# Overall time budget for collecting a snapshot, in seconds
+DEFAULT_DEADLINE = 20.0
+# Max characters kept from each source's logs so the AI prompt stays small (the newest lines are kept)
+DEFAULT_LOG_CHARS = 4000
+
+
+def collect_incident_snapshot(namespace: str = "default", jenkins_client=None, core_v1_api=None,
+                              docker_client=None, deadline: float = DEFAULT_DEADLINE,
+                              log_chars: int = DEFAULT_LOG_CHARS) -> Dict[str, Any]:
+    """
+    Collects incident data from Kubernetes, Docker and Jenkins concurrently.
+
+    Every source runs in its own thread and the whole collection is bounded by
+    `deadline` seconds. Sources that have not finished by then are reported in
+    `timed_out` and left out of the snapshot instead of holding up the report.
+    """
+    collectors = {}
+    if core_v1_api:
+        collectors["failing_pods"] = lambda: k8s_handler.get_failing_pods(core_v1_api, namespace)
+        collectors["k8s_events"] = lambda: k8s_handler.get_recent_events(core_v1_api, namespace)
+        collectors["k8s_logs"] = lambda: k8s_handler.get_recent_logs(
+            core_v1_api, namespace, max_lines=50, max_chars=log_chars, merged=True)
+    if docker_client:
+        collectors["unhealthy_containers"] = lambda: docker_handler.get_unhealthy_containers(docker_client)
+        collectors["docker_logs"] = lambda: docker_handler.get_recent_logs(
+            docker_client, max_lines=50, max_chars=log_chars, merged=True)
+    if jenkins_client:
+        collectors["failed_builds"] = lambda: jenkins_handler.get_failed_builds(jenkins_client)
+        # Build consoles have no real line timestamps, so they stay grouped per build
+        collectors["jenkins_logs"] = lambda: jenkins_handler.get_recent_logs(
+            jenkins_client, max_lines=50, max_chars=log_chars)
+
+    snapshot = {
+        "namespace": namespace,
+        "collected_at": datetime.now(timezone.utc).isoformat(),
+        "sources": {},
+        "errors": {},
+        "timed_out": [],
+        "timings_s": {}
+    }
+    if not collectors:
+        snapshot["errors"]["all"] = "No Kubernetes, Docker or Jenkins client is available."
+        return snapshot
+
+    start = time.monotonic()
+
+    def timed(fn):
+        t0 = time.monotonic()
+        result = fn()
+        return result, round(time.monotonic() - t0, 3)
+
+    executor = ThreadPoolExecutor(max_workers=len(collectors), thread_name_prefix="incident")
+    futures = {executor.submit(timed, fn): name for name, fn in collectors.items()}
+    done, not_done = wait(futures, timeout=deadline)
+    # Don't wait for stragglers; their threads finish in the background and are discarded
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in done:
+        name = futures[future]
+        try:
+            (success, data), elapsed = future.result()
+            snapshot["timings_s"][name] = elapsed
+            if success:
+                snapshot["sources"][name] = data
+            else:
+                snapshot["errors"][name] = data
+        except Exception as e:
+            logger.error(f"Incident collector '{name}' failed: {e}", exc_info=True)
+            snapshot["errors"][name] = str(e)
+    for future in not_done:
+        name = futures[future]
+        snapshot["timed_out"].append(name)
+        logger.warning(f"Incident collector '{name}' did not finish within {deadline}s")
+
+    snapshot["duration_s"] = round(time.monotonic() - start, 3)
+    return snapshot
+
+
+def format_snapshot_summary(snapshot: Dict[str, Any]) -> str:
+    """Short Slack summary of what went into the snapshot."""
+    sources = snapshot["sources"]
+    lines = [f"*Snapshot for `{snapshot['namespace']}`* (collected in {snapshot.get('duration_s', 0):.1f}s)"]
+    if "failing_pods" in sources:
+        lines.append(f"• Failing pods: {len(sources['failing_pods'])}")
+    if "k8s_events" in sources:
+        lines.append(f"• Warning events: {len(sources['k8s_events'])}")
+    if "unhealthy_containers" in sources:
+        lines.append(f"• Unhealthy containers: {len(sources['unhealthy_containers'])}")
+    if "failed_builds" in sources:
+        lines.append(f"• Recent failed builds: {len(sources['failed_builds'])}")
+    if snapshot["timed_out"]:
+        lines.append(f"• :hourglass: Timed out (partial data): {', '.join(sorted(snapshot['timed_out']))}")
+    if snapshot["errors"]:
+        lines.append(f"• :warning: Unavailable: {', '.join(sorted(snapshot['errors']))}")
+    return "\n".join(lines)
@@ -3,6 +3,10 @@ import os
 import jenkins
 from dotenv import load_dotenv
 import logging # Import the logging module
+import io
+from collections import deque
+
+import log_pipeline
 
 # Load environment variables
 load_dotenv()
@@ -175,61 +179,124 @@ def get_build_log(server: jenkins.Jenkins, job_name: str, build_number_str: str
         return False, f"An unexpected error occurred while getting logs for `{job_name}` build `{build_number_str}`."
 
 
-def get_recent_logs(client, job_name=None, build_number=None, max_lines=100):
+def get_failed_builds(server: jenkins.Jenkins, limit: int = 5, max_jobs: int = 25):
+    """
+    Returns the most recent failed builds across jobs, newest first.
+    Only the first `max_jobs` jobs are inspected to bound the number of API calls.
+    """
+    if not server:
+        return False, "Jenkins client not initialized."
+    try:
+        failed = []
+        for job in server.get_jobs()[:max_jobs]:
+            job_name = job.get('fullname') or job['name']
+            job_info = server.get_job_info(job_name)
+            last_failed = job_info.get('lastFailedBuild')
+            if not last_failed or last_failed.get('number') is None:
+                continue
+            build_info = server.get_build_info(job_name, last_failed['number'])
+            failed.append({
+                "job": job_name,
+                "build": last_failed['number'],
+                "result": build_info.get('result'),
+                "timestamp": build_info.get('timestamp', 0),
+                "duration_s": build_info.get('duration', 0) // 1000,
+                "url": build_info.get('url')
+            })
+        failed.sort(key=lambda b: b["timestamp"], reverse=True)
+        return True, failed[:limit]
+    except jenkins.JenkinsException as e:
+        logger.error(f"JenkinsException listing failed builds: {e}")
+        return False, f"Error listing failed builds: {e}"
+    except Exception as e:
+        logger.error(f"Unexpected error listing failed builds: {e}", exc_info=True)
+        return False, f"An unexpected error occurred while listing failed builds: {str(e)}"
+
+
+def iter_build_logs(server: jenkins.Jenkins, job_name: str, build_number: int, max_lines: int = 100,
+                    since: float = None):
+    """
+    Yields the last `max_lines` console lines of a build (all of them if None) as
+    log_pipeline records, and ships them to Loki if configured. Builds that ended
+    before `since` (unix seconds) yield nothing. Console lines carry no
+    timestamps, so each gets build start + line number microseconds. That keeps
+    them in order and stable across fetches.
+    """
+    entity = f"{job_name}#{build_number}"
+    try:
+        build_info = server.get_build_info(job_name, build_number)
+        start_ms = build_info.get('timestamp', 0)
+        if since and not build_info.get('building') and (start_ms + build_info.get('duration', 0)) / 1000 < since:
+            return
+        # python-jenkins returns the console as one string; keep only the numbered tail of it
+        console = server.get_build_console_output(job_name, build_number)
+        lines = enumerate(io.StringIO(console))
+        if max_lines:
+            lines = deque(lines, maxlen=max_lines)
+            del console
+        records = (log_pipeline.LogRecord("jenkins", entity, start_ms * 1_000_000 + index * 1000, line.rstrip("\r\n"))
+                   for index, line in lines if line.strip())
+        yield from log_pipeline.to_shipper(records, {"source": "jenkins", "jenkins_job": job_name},
+                                           stream_id=(job_name, build_number))
+    except jenkins.JenkinsException as e:
+        yield log_pipeline.error_record("jenkins", entity, f"Error getting logs: {str(e)}")
+
+
+def get_log_streams(server: jenkins.Jenkins, job_name=None, build_number=None, max_lines=100, max_jobs=5,
+                    since=None):
+    """
+    One lazy record stream per build: `build_number` (default: the last build) of
+    `job_name`, or the last build of each of the first `max_jobs` jobs that have one.
+    """
+    if job_name:
+        if build_number:
+            return [iter_build_logs(server, job_name, int(build_number), max_lines, since)]
+        job_names = [job_name]
+    else:
+        job_names = [job.get('fullname') or job['name'] for job in server.get_jobs()]
+    streams = []
+    for name in job_names:
+        last_build = server.get_job_info(name).get('lastBuild')
+        if last_build and last_build.get('number') is not None:
+            streams.append(iter_build_logs(server, name, last_build['number'], max_lines, since))
+        if len(streams) >= max_jobs:
+            break
+    return streams
+
+
+def get_recent_logs(client, job_name=None, build_number=None, max_lines=100, max_chars=None, merged=False):
     """
     Get recent logs from Jenkins.
     If job_name is provided, gets logs for that specific job.
     Otherwise, gets logs from recent builds across all jobs.
+    `max_chars` caps the returned text (newest lines are kept); `merged` interleaves
+    builds by time instead of listing them one after another.
     """
     try:
         if not client:
             return False, "Jenkins client not initialized"
-        
+
         # Get all jobs first to check if any exist
         all_jobs = client.get_jobs()
         if not all_jobs:
             return False, "No Jenkins jobs found. Please create a job first."
-        
-        if job_name:
-            # Check if the specified job exists
-            job_exists = any(job['name'] == job_name for job in all_jobs)
-            if not job_exists:
-                return False, f"Job '{job_name}' not found. Available jobs: {', '.join(job['name'] for job in all_jobs)}"
-            
-            # Get logs for specific job
-            try:
-                job = client.get_job(job_name)
-                if not build_number:
-                    build = job.get_last_build()
-                else:
-                    build = job.get_build(int(build_number))
-                
-                log = build.get_console_output()
-                return True, log
-            except jenkins.JenkinsException as e:
-                return False, f"Error getting logs for job {job_name}: {str(e)}"
-        else:
-            # Get logs from recent builds across all jobs
-            recent_logs = []
-            
-            for job_info in all_jobs:
-                try:
-                    job = client.get_job(job_info['name'])
-                    last_build = job.get_last_build()
-                    if last_build:
-                        log = last_build.get_console_output()
-                        recent_logs.append(f"=== {job_info['name']} (Build #{last_build.get_number()}) ===\n{log}")
-                except jenkins.JenkinsException:
-                    continue
-                
-                if len(recent_logs) >= 5:  # Limit to 5 most recent jobs
-                    break
-            
-            if not recent_logs:
-                return False, "No recent builds found. Please trigger a build first."
-            
-            return True, "\n\n".join(recent_logs)
-            
+
+        if job_name and not any(job_name in (job['name'], job.get('fullname')) for job in all_jobs):
+            return False, f"Job '{job_name}' not found. Available jobs: {', '.join(job['name'] for job in all_jobs)}"
+
+        try:
+            streams = get_log_streams(client, job_name, build_number, max_lines)
+        except jenkins.JenkinsException as e:
+            return False, f"Error getting logs for job {job_name}: {str(e)}"
+        if not streams:
+            return False, "No recent builds found. Please trigger a build first."
+
+        # Console timestamps are synthetic (see iter_build_logs), so they are not shown
+        count, logs = log_pipeline.collect_streams(streams, max_chars, merged, timestamps=False)
+        if not count:
+            return False, "The recent builds have no console output yet."
+        return True, logs
+
     except Exception as e:
         logger.error(f"Error getting Jenkins logs: {str(e)}")
         return False, f"Error getting logs: {str(e)}"
@@ -0,0 +1,514 @@
+# job_queue.py
+"""
+Local job queue for long-running command work, shared by every bot process.
+
+Slash command handlers must ack within three seconds, and with several bot
+processes (see bot_cluster.py) whichever one received a command is not
+necessarily the least busy. Handlers enqueue a job into an SQLite table (WAL
+mode) instead; JobWorker threads in every process claim jobs from it, run
+them and reply through the command's response_url.
+
+A claimed job holds a lease that its worker renews while it runs. If the
+process dies, the lease runs out and another worker takes the job over. A
+handler that raises is retried with exponential backoff; either way a job
+runs at most `max_attempts` times. Handlers report progress through their
+JobContext, which records an event per step (shown by /job-status) and is
+also where a cancellation requested with /job-cancel takes effect.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE = 60.0
+DEFAULT_MAX_ATTEMPTS = 3
+# A failed attempt is retried after RETRY_DELAY * 2^(attempt - 1) seconds, at most MAX_RETRY_DELAY
+RETRY_DELAY = 10.0
+MAX_RETRY_DELAY = 300.0
+# Progress events kept per job
+MAX_EVENTS = 50
+# Idle workers poll with backoff between these intervals; enqueues in the same process wake them at once
+MIN_POLL_INTERVAL = 0.02
+MAX_POLL_INTERVAL = 1.0
+# Finished jobs are kept this long for inspection
+RETENTION = 7 * 86400.0
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+JOBS = bot_metrics.REGISTRY.register(bot_metrics.Counter(
+    "chatops_jobs", "Job attempts finished, by kind and outcome", ["kind", "outcome"]))
+JOB_WAIT = bot_metrics.REGISTRY.register(bot_metrics.Histogram(
+    "chatops_job_wait_seconds", "Time from enqueue to a worker claiming the job", ["kind"], JOB_BUCKETS))
+JOB_DURATION = bot_metrics.REGISTRY.register(bot_metrics.Histogram(
+    "chatops_job_duration_seconds", "Time a worker spent running the job", ["kind"], JOB_BUCKETS))
+JOBS_RUNNING = bot_metrics.REGISTRY.register(bot_metrics.Gauge(
+    "chatops_jobs_running", "Jobs running in this process"))
+
+
+class JobCancelled(BaseException):
+    """
+    Raised inside a handler (by JobContext.progress) once the job is cancelled.
+    Like asyncio.CancelledError it is not an Exception, so the handlers'
+    `except Exception` blocks do not swallow it.
+    """
+
+
+class JobFailed(Exception):
+    """Raised by a handler for a failure that retrying will not fix (bad input, missing image)."""
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    summary: str            # one line for /jobs, e.g. "docker-deploy nginx:1.27"
+    payload: Dict[str, Any]
+    state: str              # queued, running, succeeded, failed or cancelled
+    attempts: int
+    max_attempts: int
+    owner: Optional[str]    # "host:pid" of the process running (or that ran) it
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    cancel_requested: bool
+    progress: Optional[str]  # latest progress message
+    result: Optional[str]
+    error: Optional[str]    # error of the last failed attempt
+
+
+_COLUMNS = ("id, kind, summary, payload, state, attempts, max_attempts, owner, created_at, started_at, "
+            "finished_at, cancel_requested, progress, result, error")
+# Columns added after the first release of the table, with their definitions
+_ADDED_COLUMNS = {
+    "summary": "TEXT NOT NULL DEFAULT ''",
+    "max_attempts": f"INTEGER NOT NULL DEFAULT {DEFAULT_MAX_ATTEMPTS}",
+    "run_after": "REAL NOT NULL DEFAULT 0",
+    "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+    "progress": "TEXT",
+}
+
+
+def _job(row) -> Job:
+    return Job(row[0], row[1], row[2], json.loads(row[3]), *row[4:11], bool(row[11]), *row[12:])
+
+
+class JobContext:
+    """Handed to a job handler: progress reporting and cancellation for the running job."""
+
+    def __init__(self, queue: "JobQueue", job: Job):
+        self.queue = queue
+        self.job = job
+        # Also set by the worker's lease renewal, for handlers that poll instead of reporting progress
+        self.cancelled = threading.Event()
+
+    @property
+    def last_attempt(self) -> bool:
+        return self.job.attempts >= self.job.max_attempts
+
+    def progress(self, message: str):
+        """Records a progress event; raises JobCancelled if the job has been cancelled."""
+        if self.queue.progress(self.job.id, message):
+            self.cancelled.set()
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+
+class JobQueue:
+    def __init__(self, path: str, lease: float = DEFAULT_LEASE, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=10.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                kind TEXT NOT NULL,
+                                payload TEXT NOT NULL,
+                                state TEXT NOT NULL DEFAULT 'queued',
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                owner TEXT,
+                                created_at REAL NOT NULL,
+                                started_at REAL,
+                                finished_at REAL,
+                                lease_expires REAL,
+                                result TEXT,
+                                error TEXT
+                            )""")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, definition in _ADDED_COLUMNS.items():
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS job_events (
+                                job_id INTEGER NOT NULL,
+                                ts REAL NOT NULL,
+                                message TEXT NOT NULL
+                            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, ts)")
+        self._lock = threading.Lock()
+        # Set on enqueue so this process's idle workers skip the rest of their poll interval
+        self.wakeup = threading.Event()
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], summary: str = "",
+                max_attempts: Optional[int] = None) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (kind, summary, payload, max_attempts, created_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, summary or kind, json.dumps(payload), max_attempts or self.max_attempts, now))
+            self._db.execute("INSERT INTO job_events (job_id, ts, message) VALUES (?, ?, 'queued')",
+                             (cursor.lastrowid, now))
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def claim(self, owner: str, kinds: Iterable[str]) -> Optional[Job]:
+        """
+        Takes the oldest due queued job of one of `kinds`, or a running one whose
+        lease has run out (its process died). Jobs that have used up their
+        attempts, or were cancelled while their worker was gone, are closed
+        instead of being run again.
+        """
+        kinds = list(kinds)
+        marks = ",".join("?" * len(kinds))
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so two processes cannot pick the same row
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    row = self._db.execute(
+                        f"""SELECT id, attempts, max_attempts, cancel_requested FROM jobs
+                            WHERE kind IN ({marks})
+                              AND ((state = 'queued' AND run_after <= ?)
+                                   OR (state = 'running' AND lease_expires < ?))
+                            ORDER BY id LIMIT 1""", (*kinds, now, now)).fetchone()
+                    if row is None:
+                        self._db.execute("COMMIT")
+                        return None
+                    job_id, attempts, max_attempts, cancel_requested = row
+                    if cancel_requested:
+                        self._close(job_id, "cancelled", now, "cancelled while its worker was gone")
+                        continue
+                    if attempts >= max_attempts:
+                        self._close(job_id, "failed", now, f"worker lost after {attempts} attempt(s)")
+                        continue
+                    self._db.execute("""UPDATE jobs SET state = 'running', owner = ?, attempts = attempts + 1,
+                                            started_at = ?, lease_expires = ? WHERE id = ?""",
+                                     (owner, now, now + self.lease, job_id))
+                    self._event(job_id, now, f"attempt {attempts + 1}/{max_attempts} started on {owner}")
+                    job = self._db.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                    self._db.execute("COMMIT")
+                    return _job(job)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _event(self, job_id: int, now: float, message: str):
+        self._db.execute("INSERT INTO job_events (job_id, ts, message) VALUES (?, ?, ?)", (job_id, now, message))
+
+    def _close(self, job_id: int, state: str, now: float, error: Optional[str] = None):
+        self._db.execute("""UPDATE jobs SET state = ?, finished_at = ?, error = COALESCE(?, error),
+                                lease_expires = NULL WHERE id = ?""", (state, now, error, job_id))
+        self._event(job_id, now, state + (f": {error}" if error else ""))
+
+    def renew(self, job_ids: List[int], owner: str) -> List[int]:
+        """Extends the leases of jobs `owner` is still running; returns those with a cancellation pending."""
+        if not job_ids:
+            return []
+        marks = ",".join("?" * len(job_ids))
+        with self._lock:
+            self._db.execute(f"""UPDATE jobs SET lease_expires = ?
+                                 WHERE id IN ({marks}) AND owner = ? AND state = 'running'""",
+                             (time.time() + self.lease, *job_ids, owner))
+            rows = self._db.execute(f"SELECT id FROM jobs WHERE id IN ({marks}) AND cancel_requested = 1",
+                                    job_ids).fetchall()
+        return [row[0] for row in rows]
+
+    def progress(self, job_id: int, message: str) -> bool:
+        """Records a progress event; True if the job has been asked to cancel."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("UPDATE jobs SET progress = ? WHERE id = ?", (message, job_id))
+                self._event(job_id, now, message)
+                cancel = self._db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return bool(cancel and cancel[0])
+
+    def finish(self, job_id: int, owner: str, state: str, result: Optional[str] = None,
+               error: Optional[str] = None, retry_delay: Optional[float] = None) -> bool:
+        """
+        Records the outcome of an attempt: succeeded, failed or cancelled, or back
+        to queued after `retry_delay` seconds. False if the job was meanwhile taken
+        over by another worker.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                if retry_delay is not None:
+                    cursor = self._db.execute(
+                        """UPDATE jobs SET state = 'queued', run_after = ?, error = ?, lease_expires = NULL
+                           WHERE id = ? AND owner = ? AND state = 'running'""",
+                        (now + retry_delay, error, job_id, owner))
+                    message = f"attempt failed: {error}; retrying in {retry_delay:.0f}s"
+                else:
+                    cursor = self._db.execute(
+                        """UPDATE jobs SET state = ?, finished_at = ?, result = ?, error = ?, lease_expires = NULL
+                           WHERE id = ? AND owner = ? AND state = 'running'""",
+                        (state, now, result, error, job_id, owner))
+                    message = state + (f": {error}" if error else "")
+                if cursor.rowcount == 1:
+                    self._event(job_id, now, message)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id: int, by: str = "") -> Optional[str]:
+        """
+        Cancels a queued job at once, or asks the worker of a running one to stop
+        at its next progress report. Returns the job's resulting state
+        ("cancelled", "cancelling" or the state it had already finished in), or
+        None if there is no such job.
+        """
+        now = time.time()
+        note = f" by {by}" if by else ""
+        with self._lock:
+            row = self._db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] == "queued":
+                self._close(job_id, "cancelled", now, f"cancelled{note} before it ran")
+                return "cancelled"
+            if row[0] == "running":
+                self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                self._event(job_id, now, f"cancel requested{note}")
+                return "cancelling"
+            return row[0]
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._lock:
+            row = self._db.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def events(self, job_id: int, limit: int = 10) -> List[Tuple[float, str]]:
+        """The job's newest `limit` progress events, oldest first."""
+        with self._lock:
+            rows = self._db.execute("SELECT ts, message FROM job_events WHERE job_id = ? ORDER BY ts DESC LIMIT ?",
+                                    (job_id, limit)).fetchall()
+        return rows[::-1]
+
+    def list_jobs(self, limit: int = 20) -> List[Job]:
+        """Queued and running jobs, then the most recently finished ones, up to `limit` in all."""
+        with self._lock:
+            active = self._db.execute(f"""SELECT {_COLUMNS} FROM jobs WHERE state IN ('queued', 'running')
+                                          ORDER BY id LIMIT ?""", (limit,)).fetchall()
+            finished = self._db.execute(f"""SELECT {_COLUMNS} FROM jobs
+                                            WHERE state NOT IN ('queued', 'running')
+                                            ORDER BY finished_at DESC LIMIT ?""",
+                                        (max(limit - len(active), 0),)).fetchall()
+        return [_job(row) for row in active + finished]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def purge(self, older_than: float = RETENTION) -> int:
+        cutoff = time.time() - older_than
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+            self._db.execute("DELETE FROM job_events WHERE job_id NOT IN (SELECT id FROM jobs)")
+            # Keep the newest MAX_EVENTS events of chatty jobs
+            self._db.execute("""DELETE FROM job_events WHERE rowid IN (
+                                    SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER
+                                        (PARTITION BY job_id ORDER BY ts DESC) AS n FROM job_events)
+                                    WHERE n > ?)""", (MAX_EVENTS,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JobWorker:
+    """
+    Runs jobs from `queue` on `threads` daemon threads. `handlers` maps a job
+    kind to a callable taking (Job, JobContext); its return value (if any) is
+    stored as the job's result. JobFailed fails the job; any other exception
+    fails the attempt, and the job is retried while it has attempts left.
+    """
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable[[Job, JobContext], Any]], threads: int = 2):
+        self.queue = queue
+        self.handlers = handlers
+        self.threads = threads
+        self.owner = f"{os.uname().nodename}:{os.getpid()}"
+        self._running: Dict[int, JobContext] = {}
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.stats = {"succeeded": 0, "failed": 0, "retried": 0, "cancelled": 0, "lost": 0}
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._maintain, name="job-lease", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        logger.info(f"Job worker {self.owner} started with {self.threads} threads for {sorted(self.handlers)}")
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        self.queue.wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        idle = MIN_POLL_INTERVAL
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(self.owner, self.handlers)
+            except sqlite3.Error as e:
+                logger.error(f"Could not claim a job: {e}")
+                job = None
+            if job is None:
+                self.queue.wakeup.wait(idle)
+                self.queue.wakeup.clear()
+                idle = min(idle * 2, MAX_POLL_INTERVAL)
+                continue
+            idle = MIN_POLL_INTERVAL
+            self._execute(job)
+
+    def _execute(self, job: Job):
+        JOB_WAIT.observe(job.started_at - job.created_at, kind=job.kind)
+        context = JobContext(self.queue, job)
+        with self._running_lock:
+            self._running[job.id] = context
+        JOBS_RUNNING.inc()
+        state, result, error, retry_delay = "succeeded", None, None, None
+        t0 = time.monotonic()
+        try:
+            # Label the worker thread with the command, as for Bolt handlers: the profiler
+            # attributes its samples to it and the command duration covers the actual work
+            result = bot_metrics.instrument_command(f"/{job.kind}")(self.handlers[job.kind])(job, context)
+        except JobCancelled:
+            state = "cancelled"
+        except JobFailed as e:
+            state, error = "failed", str(e) or type(e).__name__
+        except Exception as e:
+            logger.error(f"Job #{job.id} ({job.kind}) attempt {job.attempts} failed: {e}", exc_info=True)
+            state, error = "failed", str(e) or type(e).__name__
+            if not context.last_attempt:
+                retry_delay = min(RETRY_DELAY * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+        finally:
+            JOBS_RUNNING.dec()
+            with self._running_lock:
+                del self._running[job.id]
+        JOB_DURATION.observe(time.monotonic() - t0, kind=job.kind)
+        outcome = "retried" if retry_delay is not None else state
+        if not self.queue.finish(job.id, self.owner, state, None if result is None else str(result), error,
+                                 retry_delay):
+            # Our lease ran out (e.g. the process was stalled) and another worker took the job over
+            outcome = "lost"
+            logger.warning(f"Job #{job.id} ({job.kind}) was taken over by another worker before it finished")
+        self.stats[outcome] += 1
+        JOBS.inc(kind=job.kind, outcome=outcome)
+
+    def _maintain(self):
+        """Renews the leases of running jobs, passes on cancellations, and purges old jobs about hourly."""
+        last_purge = 0.0
+        # Often enough that a cancellation reaches a handler that never reports progress within seconds
+        interval = min(self.queue.lease / 3, 5.0)
+        while not self._stop.wait(interval):
+            with self._running_lock:
+                running = dict(self._running)
+            try:
+                for job_id in self.queue.renew(list(running), self.owner):
+                    running[job_id].cancelled.set()
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    self.queue.purge()
+            except sqlite3.Error as e:
+                logger.error(f"Could not renew job leases: {e}")
+
+
+def _age(seconds: float) -> str:
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.1f}h"
+
+
+_STATE_ICONS = {"queued": ":hourglass:", "running": ":gear:", "succeeded": ":white_check_mark:",
+                "failed": ":x:", "cancelled": ":no_entry_sign:"}
+
+
+def format_job_line(job: Job, now: Optional[float] = None) -> str:
+    now = now or time.time()
+    state = "cancelling" if job.state == "running" and job.cancel_requested else job.state
+    if job.state == "queued":
+        detail = f"queued {_age(now - job.created_at)} ago"
+        if job.attempts:
+            detail += f", retry {job.attempts + 1}/{job.max_attempts}"
+    elif job.state == "running":
+        detail = f"running for {_age(now - job.started_at)}" + (f": {job.progress}" if job.progress else "")
+    else:
+        took = _age(job.finished_at - (job.started_at or job.created_at))
+        detail = f"{state} {_age(now - job.finished_at)} ago after {took}"
+    return f"{_STATE_ICONS.get(job.state, '')} #{job.id} `{job.summary or job.kind}` ({detail})"
+
+
+def format_job_status(job: Job, events: List[Tuple[float, str]]) -> str:
+    """Slack message for /job-status: state, attempts, outcome and the latest progress events."""
+    lines = [format_job_line(job)]
+    requested_by = job.payload.get("user_id")
+    lines.append(f"Attempts: {job.attempts}/{job.max_attempts}"
+                 + (f" • requested by <@{requested_by}>" if requested_by else "")
+                 + (f" • worker {job.owner}" if job.owner else ""))
+    if job.error:
+        lines.append(f"Last error: {job.error}")
+    if job.result:
+        lines.append(f"Result: {job.result[:500]}")
+    if events:
+        lines.append("```" + "\n".join(f"{time.strftime('%H:%M:%S', time.localtime(ts))} {message}"
+                                        for ts, message in events) + "```")
+    return "\n".join(lines)
+
+
+def get_job_queue() -> Optional[JobQueue]:
+    """
+    Queue at JOB_QUEUE_DB (default $BOT_STATE_DIR/jobs.db), unless
+    JOB_QUEUE_ENABLED is false. All bot processes on the host share the file.
+    """
+    if os.environ.get("JOB_QUEUE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    path = os.environ.get("JOB_QUEUE_DB") or os.path.join(os.environ.get("BOT_STATE_DIR", "state"), "jobs.db")
+    try:
+        return JobQueue(path, lease=float(os.environ.get("JOB_LEASE_SECONDS", DEFAULT_LEASE)))
+    except sqlite3.Error as e:
+        logger.error(f"Could not open job queue {path}: {e}; long-running commands will run in the handler")
+        return None
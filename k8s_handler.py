@@ -4,6 +4,9 @@ from kubernetes import client, config
 from kubernetes.client.exceptions import ApiException
 from datetime import datetime, timezone
 import logging # Use logging for better output control
+import time
+
+import log_pipeline
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO)
@@ -182,42 +185,138 @@ def restart_deployment(apps_v1_api, name: str, namespace: str = "default"):
     except Exception as e:
         return False, f"Error restarting deployment: {str(e)}"
 
-def get_recent_logs(core_v1_api, namespace="default", max_lines=100):
+def get_failing_pods(core_v1_api, namespace="default"):
+    """
+    Returns pods that are not healthy: failed/pending/unknown phase, or with a
+    container that is waiting (CrashLoopBackOff, ImagePullBackOff, ...) or restarting.
+    """
+    if not core_v1_api:
+        return False, "Kubernetes API client not initialized."
+    try:
+        pods = core_v1_api.list_namespaced_pod(namespace=namespace, timeout_seconds=10)
+        failing = []
+        for pod in pods.items:
+            phase = pod.status.phase
+            restarts = 0
+            reasons = []
+            for cs in pod.status.container_statuses or []:
+                restarts += cs.restart_count
+                if cs.state and cs.state.waiting and cs.state.waiting.reason:
+                    reasons.append(f"{cs.name}: {cs.state.waiting.reason}")
+                elif cs.state and cs.state.terminated and cs.state.terminated.exit_code:
+                    reasons.append(f"{cs.name}: {cs.state.terminated.reason} (exit {cs.state.terminated.exit_code})")
+                elif not cs.ready and phase == "Running":
+                    reasons.append(f"{cs.name}: not ready")
+            if phase in ("Failed", "Pending", "Unknown") or reasons:
+                failing.append({
+                    "name": pod.metadata.name,
+                    "phase": phase,
+                    "restarts": restarts,
+                    "reasons": reasons,
+                    "age": _calculate_age(pod.metadata.creation_timestamp)
+                })
+        return True, failing
+    except ApiException as e:
+        logger.error(f"ApiException listing failing pods in {namespace}: {e.status} - {e.reason}")
+        return False, f"Error listing pods in `{namespace}` (API Error {e.status})."
+    except Exception as e:
+        logger.error(f"An unexpected error occurred listing failing pods: {e}", exc_info=True)
+        return False, f"Error listing pods in `{namespace}`: {str(e)}"
+
+def get_recent_events(core_v1_api, namespace="default", limit=20, warnings_only=True):
+    """Returns the most recent events in a namespace, newest first."""
+    if not core_v1_api:
+        return False, "Kubernetes API client not initialized."
+    try:
+        field_selector = "type=Warning" if warnings_only else None
+        events = core_v1_api.list_namespaced_event(
+            namespace=namespace,
+            field_selector=field_selector,
+            timeout_seconds=10
+        )
+        epoch = datetime.min.replace(tzinfo=timezone.utc)
+        items = sorted(
+            events.items,
+            key=lambda ev: ev.last_timestamp or ev.event_time or ev.metadata.creation_timestamp or epoch,
+            reverse=True
+        )
+        recent = []
+        for ev in items[:limit]:
+            timestamp = ev.last_timestamp or ev.event_time or ev.metadata.creation_timestamp
+            recent.append({
+                "time": timestamp.isoformat() if timestamp else None,
+                "type": ev.type,
+                "reason": ev.reason,
+                "object": f"{ev.involved_object.kind}/{ev.involved_object.name}",
+                "count": ev.count or 1,
+                "message": (ev.message or "").strip()
+            })
+        return True, recent
+    except ApiException as e:
+        logger.error(f"ApiException listing events in {namespace}: {e.status} - {e.reason}")
+        return False, f"Error listing events in `{namespace}` (API Error {e.status})."
+    except Exception as e:
+        logger.error(f"An unexpected error occurred listing events: {e}", exc_info=True)
+        return False, f"Error listing events in `{namespace}`: {str(e)}"
+
+def iter_container_logs(core_v1_api, namespace, pod_name, container_name, max_lines=100, since=None):
+    """
+    Streams one pod container's recent log lines as log_pipeline records (and on to Loki, if configured).
+    `max_lines=None` reads the whole log; `since` (unix seconds) skips older lines.
+    """
+    entity = f"{namespace}/{pod_name}/{container_name}"
+    options = {}
+    if max_lines:
+        options["tail_lines"] = max_lines
+    if since:
+        options["since_seconds"] = max(int(time.time() - since), 1)
+    try:
+        # _preload_content=False hands back the raw HTTP response so the body is read incrementally
+        response = core_v1_api.read_namespaced_pod_log(
+            name=pod_name,
+            namespace=namespace,
+            container=container_name,
+            timestamps=True,
+            _preload_content=False,
+            **options
+        )
+        try:
+            records = log_pipeline.parse_records("k8s", entity, log_pipeline.iter_lines(response.stream(64 * 1024)))
+            yield from log_pipeline.to_shipper(records, {"source": "k8s", "namespace": namespace, "pod": pod_name,
+                                                         "container": container_name})
+        finally:
+            response.release_conn()
+    except Exception as e:
+        yield log_pipeline.error_record("k8s", entity, f"Error getting logs: {str(e)}")
+
+
+def get_log_streams(core_v1_api, namespace="default", max_lines=100, since=None):
+    """One lazy record stream per container of every pod in `namespace`."""
+    pods = core_v1_api.list_namespaced_pod(namespace)
+    return [iter_container_logs(core_v1_api, namespace, pod.metadata.name, container.name, max_lines, since)
+            for pod in pods.items for container in pod.spec.containers]
+
+
+def get_recent_logs(core_v1_api, namespace="default", max_lines=100, max_chars=None, merged=False):
     """
     Get recent logs from Kubernetes pods.
     Returns logs from all pods in the specified namespace.
+    `max_chars` caps the returned text (newest lines are kept); `merged` interleaves
+    containers by time instead of listing them one after another.
     """
     try:
         if not core_v1_api:
             return False, "Kubernetes client not initialized"
-        
-        # Get all pods in the namespace
-        pods = core_v1_api.list_namespaced_pod(namespace)
-        if not pods.items:
+
+        streams = get_log_streams(core_v1_api, namespace, max_lines)
+        if not streams:
             return False, f"No pods found in namespace '{namespace}'. Please deploy your application first.\n\nTo deploy a sample application, you can use:\n```kubectl create deployment nginx --image=nginx\nkubectl expose deployment nginx --port=80 --type=NodePort```"
-        
-        all_logs = []
-        for pod in pods.items:
-            pod_name = pod.metadata.name
-            try:
-                # Get logs for each container in the pod
-                for container in pod.spec.containers:
-                    container_name = container.name
-                    logs = core_v1_api.read_namespaced_pod_log(
-                        name=pod_name,
-                        namespace=namespace,
-                        container=container_name,
-                        tail_lines=max_lines
-                    )
-                    all_logs.append(f"=== Pod: {pod_name}, Container: {container_name} ===\n{logs}")
-            except Exception as e:
-                all_logs.append(f"=== Pod: {pod_name} ===\nError getting logs: {str(e)}")
-        
-        if not all_logs:
+
+        count, logs = log_pipeline.collect_streams(streams, max_chars, merged)
+        if not count:
             return False, "No logs found in any pods. The pods might be too new or not generating logs yet."
-        
-        return True, "\n\n".join(all_logs)
-        
+        return True, logs
+
     except Exception as e:
         logger.error(f"Error getting Kubernetes logs: {str(e)}")
         return False, f"Error getting logs: {str(e)}"
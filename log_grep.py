@@ -0,0 +1,248 @@
+# log_grep.py
+"""
+Cross-source log search behind /logs-grep.
+
+Every pod container, Docker container and Jenkins build is read as its own
+log_pipeline stream on a worker thread, and each line is tested against one
+precompiled matcher as it arrives. Once `max_matches` lines have matched, the
+other workers stop reading and close their streams (which closes the
+underlying HTTP responses), so a search for a common error does not read every
+log to the end.
+"""
+import logging
+import re
+import shlex
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List
+
+from log_pipeline import LogRecord, format_timestamp
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MATCHES = 20
+DEFAULT_CONTEXT = 2
+DEFAULT_DEADLINE = 30.0
+# Lines read per container/build when no --since is given
+DEFAULT_TAIL_LINES = 5000
+MAX_WORKERS = 16
+
+_DURATION_RE = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+
+
+def parse_duration(text: str) -> float:
+    """'30m' -> 1800.0 seconds."""
+    match = _DURATION_RE.match(text.strip())
+    if not match:
+        raise ValueError(f"Invalid duration '{text}' (use e.g. 90s, 30m, 6h, 2d)")
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def compile_matcher(pattern: str, ignore_case: bool = False) -> Callable[[str], bool]:
+    """
+    Compiles `pattern` once. Plain strings without regex metacharacters use a
+    substring test, which is several times faster than re.search.
+    """
+    if not ignore_case and not _REGEX_SPECIAL.intersection(pattern):
+        return lambda line: pattern in line
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0).search
+
+
+def parse_grep_args(text: str) -> Dict:
+    """
+    Parses `<regex> [--source k8s|docker|jenkins] [--since 30m] [--namespace ns]
+    [--max N] [--context N] [-i]`. The regex may be quoted to include spaces.
+    """
+    tokens = shlex.split(text)
+    options = {"pattern": None, "sources": None, "since": None, "namespace": "default",
+               "max_matches": DEFAULT_MAX_MATCHES, "context": DEFAULT_CONTEXT, "ignore_case": False}
+    values = iter(tokens)
+    for token in values:
+        try:
+            if token == "--source":
+                options["sources"] = [s.strip() for s in next(values).split(",") if s.strip()]
+            elif token == "--since":
+                options["since"] = parse_duration(next(values))
+            elif token == "--namespace":
+                options["namespace"] = next(values)
+            elif token == "--max":
+                options["max_matches"] = max(int(next(values)), 1)
+            elif token == "--context":
+                options["context"] = max(min(int(next(values)), 10), 0)
+            elif token == "-i":
+                options["ignore_case"] = True
+            elif options["pattern"] is None:
+                options["pattern"] = token
+            else:
+                raise ValueError(f"Unexpected argument '{token}'")
+        except StopIteration:
+            raise ValueError(f"{token} needs a value")
+    if not options["pattern"]:
+        raise ValueError("No search pattern given")
+    return options
+
+
+class _Search:
+    """Shared state of one search: the match budget and the stop signal."""
+
+    def __init__(self, matcher: Callable[[str], bool], max_matches: int, context: int):
+        self.matcher = matcher
+        self.max_matches = max_matches
+        self.context = context
+        self.matches = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def claim_match(self) -> bool:
+        with self.lock:
+            if self.matches >= self.max_matches:
+                return False
+            self.matches += 1
+            if self.matches >= self.max_matches:
+                self.stop.set()
+            return True
+
+    def scan(self, records: Iterable[LogRecord]) -> Dict:
+        """
+        Matches one stream. Returns hit blocks, each a list of (record, matched)
+        with up to `context` lines either side, like grep -C.
+        """
+        before = deque(maxlen=self.context)
+        blocks: List[List] = []
+        block = None
+        after_left = 0
+        gap = 0  # lines since the current block ended
+        lines = 0
+        iterator = iter(records)
+        try:
+            for record in iterator:
+                lines += 1
+                if self.matcher(record.line):
+                    if block is not None and (after_left or not gap):
+                        # Within (or right after) the previous hit's context: extend that block
+                        if not self.claim_match():
+                            if not after_left:
+                                break
+                            # Budget spent: still owed as trailing context of the previous hit
+                            block.append((record, False))
+                            after_left -= 1
+                            continue
+                    else:
+                        if self.stop.is_set() or not self.claim_match():
+                            break
+                        block = [(r, False) for r in before]
+                        blocks.append(block)
+                    block.append((record, True))
+                    after_left = self.context
+                    gap = 0
+                    before.clear()
+                elif after_left:
+                    block.append((record, False))
+                    after_left -= 1
+                else:
+                    if self.stop.is_set():
+                        # Budget reached elsewhere and no trailing context owed here
+                        break
+                    before.append(record)
+                    gap += 1
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+        return {"blocks": blocks, "lines": lines}
+
+
+def grep_logs(sources: Dict[str, Callable[[], List[Iterable[LogRecord]]]], pattern: str,
+              ignore_case: bool = False, max_matches: int = DEFAULT_MAX_MATCHES, context: int = DEFAULT_CONTEXT,
+              deadline: float = DEFAULT_DEADLINE) -> Dict:
+    """
+    Searches every stream of every source concurrently. `sources` maps a source
+    name to a callable returning its per-entity streams (e.g. a get_log_streams
+    call). Returns the hit blocks plus per-source stream, line and timing stats.
+    """
+    search = _Search(compile_matcher(pattern, ignore_case), max_matches, context)
+    stats = {name: {"streams": 0, "lines": 0, "matches": 0, "seconds": 0.0, "error": None} for name in sources}
+    hits = []
+    collected = threading.Event()
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="logs-grep")
+
+    def scan_source(name: str):
+        t0 = time.monotonic()
+        try:
+            streams = sources[name]()
+        except Exception as e:
+            logger.warning(f"logs-grep: could not list {name} logs: {e}")
+            stats[name]["error"] = str(e)
+            return []
+        stats[name]["streams"] = len(streams)
+        return [(name, t0, stream) for stream in streams]
+
+    def scan_stream(name: str, t0: float, stream):
+        result = search.scan(stream)
+        with search.lock:
+            if collected.is_set():
+                # Finished after the deadline: the results have already been returned
+                return
+            stats[name]["lines"] += result["lines"]
+            stats[name]["matches"] += sum(1 for block in result["blocks"] for _, matched in block if matched)
+            stats[name]["seconds"] = max(stats[name]["seconds"], time.monotonic() - t0)
+            hits.extend(result["blocks"])
+
+    # Listing pods/containers/builds is itself a round trip per source, so it runs concurrently too
+    listed = [executor.submit(scan_source, name) for name in sources]
+    done, _ = wait(listed, timeout=deadline)
+    scans = [executor.submit(scan_stream, *task) for future in done for task in future.result()]
+    remaining = max(deadline - (time.monotonic() - started), 0)
+    _, not_done = wait(scans, timeout=remaining)
+    timed_out = bool(not_done) or len(done) < len(listed)
+    # Stragglers (e.g. a slow API call) are told to stop and left to finish in the background
+    search.stop.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+    with search.lock:
+        collected.set()
+        blocks = list(hits)
+        source_stats = {name: dict(source) for name, source in stats.items()}
+
+    blocks.sort(key=lambda block: next(record.timestamp for record, matched in block if matched))
+    return {
+        "pattern": pattern,
+        "matches": search.matches,
+        "limit_reached": search.matches >= max_matches,
+        "timed_out": timed_out,
+        "duration_s": round(time.monotonic() - started, 3),
+        "blocks": blocks,
+        "sources": source_stats,
+    }
+
+
+def format_grep_result(result: Dict, max_chars: int = 3500) -> str:
+    """Slack message: summary and per-source timing, then hits with context (matches marked with '>')."""
+    limit = " (stopped at the match limit)" if result["limit_reached"] else ""
+    timeout = " :hourglass: timed out, results are partial" if result["timed_out"] else ""
+    lines = [f"*:mag: logs-grep* `{result['pattern']}`: {result['matches']} matches{limit} "
+             f"in {result['duration_s']:.1f}s{timeout}"]
+    for name, stats in result["sources"].items():
+        if stats["error"]:
+            lines.append(f"• {name}: :warning: {stats['error']}")
+        else:
+            lines.append(f"• {name}: {stats['streams']} streams, {stats['lines']:,} lines read, "
+                         f"{stats['matches']} matches, {stats['seconds']:.2f}s")
+    message = "\n".join(lines)
+    shown = 0
+    for block in result["blocks"]:
+        first = block[0][0]
+        # Jenkins console lines have no real timestamps (see jenkins_handler.iter_build_logs)
+        stamp = (lambda record: "") if first.source == "jenkins" else (
+            lambda record: format_timestamp(record.timestamp) + " ")
+        body = "\n".join(f"{'>' if matched else ' '} {stamp(record)}{record.line}" for record, matched in block)
+        section = f"\n*{first.source}/{first.entity}*\n```{body}```"
+        if len(message) + len(section) > max_chars:
+            message += f"\n_... {len(result['blocks']) - shown} more hit(s) not shown_"
+            break
+        message += section
+        shown += 1
+    return message
@@ -0,0 +1,264 @@
+# log_pipeline.py
+"""
+Generator-based pipeline for the logs the bot collects from Jenkins, Kubernetes
+and Docker.
+
+Each source yields LogRecord tuples straight off the API response stream;
+stages filter them, merge several sources into time order and cut them down to
+an output budget. Nothing upstream of truncate() holds more than a line at a
+time, and truncate() only keeps what fits in the budget, so memory follows the
+size of the answer rather than the size of the logs that were read.
+
+    records = merge_by_time(docker_records, k8s_records)
+    records = filter_records(records, include=r"ERROR|WARN")
+    count, text = collect(records, max_chars=8000)
+"""
+import codecs
+import heapq
+import itertools
+import re
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Pattern, Tuple, Union
+
+import log_shipper
+from log_shipper import parse_timestamp
+
+# Lines are forwarded to the log shipper in chunks of this many records
+SHIP_CHUNK_LINES = 500
+
+
+class LogRecord(NamedTuple):
+    source: str     # "jenkins", "k8s" or "docker"
+    entity: str     # container name, "namespace/pod/container" or "job#build"
+    timestamp: int  # unix ns
+    line: str
+
+
+def iter_lines(chunks: Iterable[Union[bytes, str]]) -> Iterator[str]:
+    """Re-chunks a byte/str stream (HTTP body, docker log stream) into lines, without buffering it whole."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        if "\n" not in pending:
+            continue
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+def parse_records(source: str, entity: str, lines: Iterable[str],
+                  default_ts: Optional[int] = None) -> Iterator[LogRecord]:
+    """
+    Turns raw lines into records, splitting off leading RFC 3339 timestamps.
+    Lines without one inherit the previous line's time, or `default_ts`
+    (now, if not given) at the start of the stream.
+    """
+    previous = default_ts if default_ts is not None else time.time_ns()
+    for line in lines:
+        if not line.strip():
+            continue
+        ts, line = parse_timestamp(line)
+        if ts is None:
+            ts = previous
+        previous = ts
+        yield LogRecord(source, entity, ts, line)
+
+
+def error_record(source: str, entity: str, message: str) -> LogRecord:
+    return LogRecord(source, entity, time.time_ns(), message)
+
+
+# --- Stages ---
+def filter_records(records: Iterable[LogRecord], include: Union[str, Pattern, None] = None,
+                   exclude: Union[str, Pattern, None] = None, since: Optional[int] = None,
+                   until: Optional[int] = None) -> Iterator[LogRecord]:
+    """Keeps records whose line matches `include` and not `exclude`, within [since, until] ns."""
+    include = re.compile(include) if isinstance(include, str) else include
+    exclude = re.compile(exclude) if isinstance(exclude, str) else exclude
+    for record in records:
+        if since is not None and record.timestamp < since:
+            continue
+        if until is not None and record.timestamp > until:
+            continue
+        if include is not None and not include.search(record.line):
+            continue
+        if exclude is not None and exclude.search(record.line):
+            continue
+        yield record
+
+
+def merge_by_time(*streams: Iterable[LogRecord]) -> Iterator[LogRecord]:
+    """
+    Interleaves per-entity streams (each already in time order, as container and
+    pod logs are) into one time-ordered stream, holding one record per input.
+    """
+    return heapq.merge(*streams, key=lambda record: record.timestamp)
+
+
+def truncate(records: Iterable[LogRecord], max_chars: Optional[int], keep: str = "tail",
+             cost: Callable[[LogRecord], int] = lambda record: len(record.line) + 1) -> Tuple[List[LogRecord], int]:
+    """
+    Cuts records down to `max_chars`, as measured by `cost` (line length by
+    default). keep="tail" keeps the newest lines and drains the input;
+    keep="head" keeps the first lines and stops reading the input as soon as the
+    budget is spent. Returns (records, omitted).
+    """
+    if max_chars is None:
+        return list(records), 0
+    kept = deque()
+    used = 0
+    omitted = 0
+    if keep == "head":
+        iterator = iter(records)
+        for record in iterator:
+            size = cost(record)
+            if used + size > max_chars:
+                omitted = 1
+                break
+            kept.append(record)
+            used += size
+        if omitted and hasattr(iterator, "close"):
+            # Closing the generator stops the upstream fetches too
+            iterator.close()
+        return list(kept), omitted
+    sizes = deque()
+    for record in records:
+        size = cost(record)
+        kept.append(record)
+        sizes.append(size)
+        used += size
+        while used > max_chars and kept:
+            kept.popleft()
+            used -= sizes.popleft()
+            omitted += 1
+    return list(kept), omitted
+
+
+def to_shipper(records: Iterable[LogRecord], labels: Dict[str, str], stream_id=None) -> Iterator[LogRecord]:
+    """Passes records through unchanged, forwarding them to the log shipper (if configured) in chunks."""
+    if not log_shipper.enabled():
+        yield from records
+        return
+    chunk = []
+    try:
+        for record in records:
+            chunk.append((record.timestamp, record.line))
+            if len(chunk) >= SHIP_CHUNK_LINES:
+                log_shipper.ship_entries(labels, chunk, stream_id)
+                chunk = []
+            yield record
+    finally:
+        # Also runs when a downstream head-truncation closes the generator early
+        log_shipper.ship_entries(labels, chunk, stream_id)
+
+
+# --- Output ---
+_TIMESTAMP_WIDTH = len("2024-01-01T00:00:00.000Z ")
+
+
+def format_timestamp(ts: int) -> str:
+    seconds, nanos = divmod(ts, 1_000_000_000)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{nanos // 1_000_000:03d}Z"
+
+
+def rendered_size(record: LogRecord, timestamps: bool = True, grouped: bool = True) -> int:
+    """Length of the line render() writes for `record` (group headers aside), without formatting it."""
+    size = len(record.line) + 1 + (_TIMESTAMP_WIDTH if timestamps else 0)
+    return size if grouped else size + len(record.source) + len(record.entity) + 4
+
+
+def render(records: Iterable[LogRecord], timestamps: bool = True, grouped: bool = True, omitted: int = 0,
+           keep: str = "tail") -> str:
+    """
+    Formats records for Slack or an AI prompt. grouped=True writes a header each
+    time the entity changes (sequential per-source output); grouped=False prefixes
+    every line with its source and entity (merged, time-ordered output).
+    """
+    parts = []
+    if omitted and keep == "tail":
+        parts.append(f"... ({omitted} earlier lines omitted) ...")
+    current = None
+    for record in records:
+        prefix = f"{format_timestamp(record.timestamp)} " if timestamps else ""
+        if grouped:
+            if (record.source, record.entity) != current:
+                current = (record.source, record.entity)
+                if parts:
+                    parts.append("")
+                parts.append(f"=== {record.source}: {record.entity} ===")
+            parts.append(prefix + record.line)
+        else:
+            parts.append(f"{prefix}[{record.source}/{record.entity}] {record.line}")
+    if omitted and keep == "head":
+        parts.append("... (output truncated) ...")
+    return "\n".join(parts)
+
+
+def collect(records: Iterable[LogRecord], max_chars: Optional[int] = None, keep: str = "tail",
+            timestamps: bool = True, grouped: bool = True) -> Tuple[int, str]:
+    """truncate() + render(); returns (records kept, text of about `max_chars`)."""
+    kept, omitted = truncate(records, max_chars, keep,
+                             cost=lambda record: rendered_size(record, timestamps, grouped))
+    return len(kept), render(kept, timestamps=timestamps, grouped=grouped, omitted=omitted, keep=keep)
+
+
+def collect_streams(streams: List[Iterable[LogRecord]], max_chars: Optional[int] = None, merged: bool = False,
+                    timestamps: bool = True) -> Tuple[int, str]:
+    """
+    Collects per-entity streams either one after another, each under its own
+    header, or (merged=True) interleaved by time, so a budget keeps the newest
+    lines across all entities instead of only the last entities.
+    """
+    records = merge_by_time(*streams) if merged else itertools.chain.from_iterable(streams)
+    return collect(records, max_chars, timestamps=timestamps, grouped=not merged)
+
+
+# Memory check against the old join-everything approach: python log_pipeline.py
+if __name__ == "__main__":
+    import logging
+    import tracemalloc
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    containers, lines_per_container, budget = 100, 2000, 16_000
+    start_ns = time.time_ns() - 3600 * 10**9
+
+    def log_stream(c):
+        """What docker's logs(stream=True) hands back: one bytes frame per line."""
+        for i in range(lines_per_container):
+            ts = start_ns + (i * containers + c) * 1_000_000
+            yield (f"{format_timestamp(ts)[:-1]}000000Z level=info container=web-{c} msg=\"handled request\" "
+                   f"path=/api/items/{i} status=200 duration={i % 97}ms\n").encode()
+
+    def join_and_slice():
+        joined = "\n\n".join(f"=== Container: web-{c} ===\n" + b"".join(log_stream(c)).decode()
+                               for c in range(containers))
+        return joined[-budget:]
+
+    def pipeline():
+        streams = [parse_records("docker", f"web-{c}", iter_lines(log_stream(c))) for c in range(containers)]
+        return collect(merge_by_time(*streams), max_chars=budget, grouped=False)
+
+    def measure(fn):
+        """Wall time without tracing (tracemalloc slows allocation down a lot), then peak memory with it."""
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, elapsed, peak
+
+    _, old_s, old_peak = measure(join_and_slice)
+    (count, _), new_s, new_peak = measure(pipeline)
+    total = containers * lines_per_container
+    logger.info(f"{total:,} lines from {containers} containers, {budget:,} char budget")
+    logger.info(f"join + slice: peak {old_peak / 1e6:.1f} MB, {old_s:.2f}s")
+    logger.info(f"pipeline:     peak {new_peak / 1e6:.2f} MB, {new_s:.2f}s ({total / new_s:,.0f} lines/s), "
+                f"kept the newest {count} lines across all containers")
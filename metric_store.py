@@ -0,0 +1,353 @@
+# metric_store.py
+"""
+In-process time-series store for metrics the bot samples itself from Docker and
+Kubernetes, so the monitoring commands still have data when Prometheus is not
+deployed or is down.
+
+Every series keeps fixed-capacity NumPy ring buffers at three resolutions (raw,
+1m, 10m), so memory per series is constant and the total is bounded by
+`memory_budget_bytes`. When the budget is full, the least recently updated series
+is evicted if it has gone stale (e.g. a removed container); otherwise the new
+series is dropped, so an overloaded store keeps its existing history instead of
+churning. Queries go through the PromQL subset in promql_lite.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from promql_lite import QueryEngine
+
+logger = logging.getLogger(__name__)
+
+# (tier name, bucket width in seconds, capacity in points). Raw keeps every sample;
+# downsampled tiers keep the last sample of each bucket, which is what rate() needs.
+DEFAULT_TIERS = (
+    ("raw", 0, 720),     # 3h at a 15s sampling interval
+    ("1m", 60, 1440),    # 24h
+    ("10m", 600, 1008),  # 7d
+)
+BYTES_PER_POINT = 16  # int64 timestamp + float64 value
+
+
+class _Ring:
+    """Fixed-capacity ring of (timestamp ms, value) pairs in insertion (= time) order."""
+    __slots__ = ("t", "v", "pos", "size")
+
+    def __init__(self, capacity: int):
+        self.t = np.zeros(capacity, dtype=np.int64)
+        self.v = np.zeros(capacity, dtype=np.float64)
+        self.pos = 0
+        self.size = 0
+
+    def append(self, t: int, v: float):
+        self.t[self.pos] = t
+        self.v[self.pos] = v
+        self.pos = (self.pos + 1) % len(self.t)
+        self.size = min(self.size + 1, len(self.t))
+
+    def oldest(self) -> Optional[int]:
+        if not self.size:
+            return None
+        return int(self.t[(self.pos - self.size) % len(self.t)])
+
+    def newest(self) -> Optional[int]:
+        return int(self.t[self.pos - 1]) if self.size else None
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.size < len(self.t):
+            return self.t[:self.size].copy(), self.v[:self.size].copy()
+        return np.roll(self.t, -self.pos), np.roll(self.v, -self.pos)
+
+
+class _Series:
+    __slots__ = ("labels", "rings", "buckets", "pending")
+
+    def __init__(self, labels: Dict[str, str], tiers):
+        self.labels = labels
+        self.rings = [_Ring(capacity) for _, _, capacity in tiers]
+        self.buckets = [width for _, width, _ in tiers]
+        # Last sample of the open bucket of each downsampled tier
+        self.pending: List[Optional[Tuple[int, float]]] = [None] * len(tiers)
+
+    def append(self, t: int, v: float) -> bool:
+        newest = self.rings[0].newest()
+        if newest is not None and t <= newest:
+            return False
+        self.rings[0].append(t, v)
+        for i in range(1, len(self.rings)):
+            width_ms = self.buckets[i] * 1000
+            pending = self.pending[i]
+            if pending is not None and pending[0] // width_ms != t // width_ms:
+                self.rings[i].append(*pending)
+            self.pending[i] = (t, v)
+        return True
+
+    def read(self, mint: int, maxt: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Finest data available for each part of the range: raw, then 1m, then 10m further back."""
+        parts_t, parts_v = [], []
+        cutoff = None
+        for ring in self.rings:
+            if not ring.size:
+                continue
+            t, v = ring.snapshot()
+            if cutoff is not None:
+                keep = t < cutoff
+                t, v = t[keep], v[keep]
+            parts_t.append(t)
+            parts_v.append(v)
+            cutoff = ring.oldest() if cutoff is None else min(cutoff, ring.oldest())
+            if cutoff <= mint:
+                break
+        if not parts_t:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        t = np.concatenate(parts_t[::-1])
+        v = np.concatenate(parts_v[::-1])
+        keep = (t >= mint) & (t <= maxt)
+        return t[keep], v[keep]
+
+
+class MetricStore(QueryEngine):
+    """
+    Bounded in-memory metric store with the same custom_query / custom_query_range
+    interface as PrometheusClient.
+    """
+
+    def __init__(self, memory_budget_bytes: int = 64 * 1024 * 1024, tiers=DEFAULT_TIERS,
+                 stale_after: float = 300.0):
+        self.tiers = tiers
+        self.memory_budget_bytes = memory_budget_bytes
+        self.stale_after_ms = int(stale_after * 1000)
+        self.series_bytes = sum(capacity for _, _, capacity in tiers) * BYTES_PER_POINT
+        self.max_series = max(memory_budget_bytes // self.series_bytes, 1)
+        # Ordered by last update, so the first entry is the eviction candidate
+        self._series: "OrderedDict[Tuple, _Series]" = OrderedDict()
+        self._postings: Dict[str, Dict[str, set]] = {}
+        self._lock = threading.RLock()
+        self.stats = {"samples": 0, "rejected": 0, "evicted": 0, "dropped_series": 0}
+
+    # --- Writes ---
+    def add(self, name: str, labels: Dict[str, str], value: float, timestamp: Optional[float] = None):
+        """Appends one sample; `timestamp` is in seconds and defaults to now."""
+        self.add_many([(name, labels, value)], timestamp)
+
+    def add_many(self, samples: Iterable[Tuple[str, Dict[str, str], float]], timestamp: Optional[float] = None):
+        """Appends (name, labels, value) samples that share one timestamp."""
+        t = int((time.time() if timestamp is None else timestamp) * 1000)
+        with self._lock:
+            for name, labels, value in samples:
+                full = {"__name__": name, **{k: str(v) for k, v in labels.items()}}
+                key = tuple(sorted(full.items()))
+                series = self._series.get(key)
+                if series is None:
+                    if len(self._series) >= self.max_series and not self._evict_stale(t):
+                        self.stats["dropped_series"] += 1
+                        continue
+                    series = self._series[key] = _Series(full, self.tiers)
+                    for label, label_value in full.items():
+                        self._postings.setdefault(label, {}).setdefault(label_value, set()).add(key)
+                else:
+                    self._series.move_to_end(key)
+                if series.append(t, float(value)):
+                    self.stats["samples"] += 1
+                else:
+                    self.stats["rejected"] += 1
+
+    def _evict_stale(self, now_ms: int) -> bool:
+        """Evicts the least recently updated series if it is stale; returns whether one was evicted."""
+        key, series = next(iter(self._series.items()))
+        newest = series.rings[0].newest()
+        if newest is not None and now_ms - newest < self.stale_after_ms:
+            return False
+        del self._series[key]
+        for label, value in series.labels.items():
+            keys = self._postings[label][value]
+            keys.discard(key)
+            if not keys:
+                del self._postings[label][value]
+        self.stats["evicted"] += 1
+        return True
+
+    # --- QueryEngine interface ---
+    def series_keys(self) -> List[Tuple]:
+        return list(self._series.keys())
+
+    def series_labels(self, key: Tuple) -> Dict[str, str]:
+        return self._series[key].labels
+
+    def match_series(self, matchers: List[Tuple[str, str, str]]) -> List[Tuple]:
+        with self._lock:
+            return super().match_series(matchers)
+
+    def read_series(self, key: Tuple, mint: int, maxt: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:  # evicted since it was matched
+                return np.empty(0, dtype=np.int64), np.empty(0)
+            return series.read(mint, maxt)
+
+    def series_end(self, key: Tuple) -> Optional[int]:
+        with self._lock:
+            series = self._series.get(key)
+            return series.rings[0].newest() if series else None
+
+    # --- Introspection ---
+    def series_count(self) -> int:
+        return len(self._series)
+
+    def memory_bytes(self) -> int:
+        return len(self._series) * self.series_bytes
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "series": len(self._series), "max_series": self.max_series,
+                    "memory_bytes": self.memory_bytes(), "memory_budget_bytes": self.memory_budget_bytes}
+
+
+# --- Sampling ---
+def _docker_container_samples(container) -> List[Tuple[str, Dict[str, str], float]]:
+    """cAdvisor-style samples from one `docker stats` snapshot."""
+    stats = container.stats(stream=False)
+    labels = {"name": container.name, "id": container.short_id,
+              "image": container.image.tags[0] if container.image.tags else container.image.short_id}
+    samples = []
+    cpu = stats.get("cpu_stats", {}).get("cpu_usage", {}).get("total_usage")
+    if cpu is not None:
+        samples.append(("container_cpu_usage_seconds_total", labels, cpu / 1e9))
+    memory = stats.get("memory_stats", {})
+    if "usage" in memory:
+        # Working set excludes inactive page cache, as cAdvisor reports it (cgroup v2 / v1 keys)
+        inactive = memory.get("stats", {}).get("inactive_file", memory.get("stats", {}).get("total_inactive_file", 0))
+        samples.append(("container_memory_working_set_bytes", labels, max(memory["usage"] - inactive, 0)))
+        if memory.get("limit"):
+            samples.append(("container_spec_memory_limit_bytes", labels, memory["limit"]))
+    networks = stats.get("networks") or {}
+    if networks:
+        samples.append(("container_network_receive_bytes_total", labels,
+                        sum(n.get("rx_bytes", 0) for n in networks.values())))
+        samples.append(("container_network_transmit_bytes_total", labels,
+                        sum(n.get("tx_bytes", 0) for n in networks.values())))
+    return samples
+
+
+def _k8s_pod_samples(core_v1_api) -> List[Tuple[str, Dict[str, str], float]]:
+    """kube-state-metrics-style restart and readiness samples for every container."""
+    samples = []
+    for pod in core_v1_api.list_pod_for_all_namespaces(watch=False).items:
+        for status in pod.status.container_statuses or []:
+            labels = {"namespace": pod.metadata.namespace, "pod": pod.metadata.name, "container": status.name}
+            samples.append(("kube_pod_container_status_restarts_total", labels, status.restart_count))
+            samples.append(("kube_pod_container_status_ready", labels, 1.0 if status.ready else 0.0))
+    return samples
+
+
+class MetricSampler:
+    """Background thread that samples Docker and Kubernetes into a MetricStore."""
+
+    def __init__(self, store: MetricStore, docker_client=None, core_v1_api=None,
+                 interval: float = 15.0, max_workers: int = 8):
+        self.store = store
+        self.docker_client = docker_client
+        self.core_v1_api = core_v1_api
+        self.interval = interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="metric-sampler")
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_duration_s = None
+
+    def sample_once(self) -> int:
+        """Collects one round of samples; returns the number stored."""
+        t0 = time.monotonic()
+        timestamp = time.time()
+        samples = []
+        if self.docker_client:
+            try:
+                containers = self.docker_client.containers.list()
+                # `docker stats` blocks ~1s per container for the CPU delta, so fetch them concurrently
+                for future in [self._executor.submit(_docker_container_samples, c) for c in containers]:
+                    try:
+                        samples.extend(future.result())
+                    except Exception as e:
+                        logger.warning(f"Could not sample container stats: {e}")
+            except Exception as e:
+                logger.warning(f"Could not list Docker containers: {e}")
+        if self.core_v1_api:
+            try:
+                samples.extend(_k8s_pod_samples(self.core_v1_api))
+            except Exception as e:
+                logger.warning(f"Could not sample Kubernetes pods: {e}")
+        self.store.add_many(samples, timestamp)
+        self.last_duration_s = round(time.monotonic() - t0, 3)
+        return len(samples)
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.sample_once()
+            except Exception as e:
+                logger.error(f"Metric sampling failed: {e}", exc_info=True)
+            self._stop.wait(max(self.interval - (time.monotonic() - started), 0.0))
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metric-sampler", daemon=True)
+        self._thread.start()
+        logger.info(f"Metric sampler started (every {self.interval:.0f}s)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval)
+
+
+def get_metric_store() -> Optional[MetricStore]:
+    """
+    Returns a MetricStore sized by METRIC_STORE_MEMORY_MB (default 64), or None when
+    METRIC_STORE_ENABLED is false.
+    """
+    if os.environ.get("METRIC_STORE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    budget_mb = float(os.environ.get("METRIC_STORE_MEMORY_MB", "64"))
+    return MetricStore(memory_budget_bytes=int(budget_mb * 1024 * 1024))
+
+
+# Benchmark: python metric_store.py [n_series]
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    store = MetricStore(memory_budget_bytes=32 * 1024 * 1024)
+    logger.info(f"Budget 32 MiB -> {store.max_series} series of {store.series_bytes:,} bytes")
+
+    rng = np.random.default_rng(1)
+    rates = rng.uniform(0.01, 2.0, n_series)
+    names = [f"app-{i}" for i in range(n_series)]
+    start = time.time() - 6 * 3600
+    n_rounds = 6 * 3600 // 15  # 6h at 15s
+    t0 = time.perf_counter()
+    for r in range(n_rounds):
+        ts = start + r * 15
+        store.add_many([("container_cpu_usage_seconds_total", {"name": names[i]}, rates[i] * r * 15)
+                        for i in range(n_series)], ts)
+    elapsed = time.perf_counter() - t0
+    logger.info(f"Ingested {n_series * n_rounds:,} samples in {elapsed:.2f}s "
+                f"({n_series * n_rounds / elapsed / 1e6:.2f}M samples/s); stats={store.get_stats()}")
+
+    end = start + (n_rounds - 1) * 15
+    for window in (3600, 6 * 3600):
+        t0 = time.perf_counter()
+        result = store.custom_query_range("rate(container_cpu_usage_seconds_total[5m])", end - window, end, 60)
+        elapsed = time.perf_counter() - t0
+        got = np.array([float(s["values"][-1][1]) for s in result])
+        expected = rates[[names.index(s["metric"]["name"]) for s in result]]
+        logger.info(f"rate() over last {window // 3600}h: {len(result)} series in {elapsed * 1000:.1f} ms, "
+                    f"max relative error {np.max(np.abs(got - expected) / expected):.2e}")
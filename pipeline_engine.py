@@ -0,0 +1,454 @@
+# pipeline_engine.py
+"""
+Small in-process DAG executor for build, test and deploy stages.
+
+A Pipeline is a set of Stages, each naming the stages it needs. Stages
+whose needs are met run concurrently on a thread pool. A failed stage skips
+everything that depends on it, but independent branches still finish.
+
+A stage can declare an `inputs` function that returns a digest of what it
+reads: source trees, settings, the outputs of the stages it needs. Its
+output is cached under that digest in BUILD_CACHE_DIR/pipeline.json. The next
+run skips the stage and reuses the output when the digest is unchanged and
+the stage's `check` confirms the output still exists (an image still
+present, a directory not deleted). The report lists each stage's status and
+time, the wall-clock time, and the critical path: the chain of dependent
+stages that bounded the run.
+
+website_pipeline() wires up the ChatOps pipeline: asset optimization, website
+lint, app lint and unit tests (hello-ci-cd, in a node container), the image
+build and, on request, the deploy.
+"""
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import docker
+
+import asset_pipeline
+import blue_green
+import build_cache
+import build_context
+import docker_handler
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+# Cached stage outputs kept
+MAX_CACHE_ENTRIES = 200
+STAGE_TIMEOUT = float(os.environ.get("PIPELINE_STAGE_TIMEOUT", "600"))
+NODE_IMAGE = os.environ.get("PIPELINE_NODE_IMAGE", "node:18-alpine")
+APP_DIR = os.environ.get("PIPELINE_APP_DIR", "hello-ci-cd")
+# Named volume that keeps npm's download cache between test runs
+NPM_CACHE_VOLUME = "chatops-npm-cache"
+
+_cache_lock = threading.Lock()
+# Per-tree file hashes from earlier digests: {path: {rel: [size, mtime_ns, sha256]}}
+_known_files: Dict[str, Dict[str, list]] = {}
+
+
+class StageFailed(Exception):
+    """Raised by a stage to fail with a message instead of a traceback."""
+
+
+class Stage:
+    """
+    `run(context)` does the work and returns a JSON-serializable output.
+    `inputs(outputs)` gets the outputs of the stages in `needs` and returns a
+    digest of everything the stage depends on, or None to always run.
+    `check(output)` says whether a cached output is still usable.
+    """
+
+    def __init__(self, name: str, run: Callable[["StageContext"], Any], needs: Iterable[str] = (),
+                 inputs: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None,
+                 check: Optional[Callable[[Any], bool]] = None):
+        self.name = name
+        self.run = run
+        self.needs = tuple(needs)
+        self.inputs = inputs
+        self.check = check
+
+
+class StageContext:
+    def __init__(self, name: str, outputs: Dict[str, Any], progress: Callable[[str], None]):
+        self.name = name
+        self.outputs = outputs
+        self._progress = progress
+
+    def progress(self, message: str):
+        self._progress(f"[{self.name}] {message}")
+
+
+def tree_digest(path: str, excludes: Iterable[str] = ()) -> str:
+    """
+    Content digest of the files under `path` that a Docker build of it would
+    see. Files whose size and mtime are unchanged since the last call are not
+    read again.
+    """
+    entries, _ = build_context.walk_context(path, excludes=excludes)
+    with _cache_lock:
+        known = _known_files.get(os.path.abspath(path))
+    digest, files, _ = build_cache.context_digest(entries, known)
+    with _cache_lock:
+        _known_files[os.path.abspath(path)] = files
+    return digest
+
+
+def _digest(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _cache_path() -> str:
+    return os.path.join(os.environ.get("BUILD_CACHE_DIR", ".build_cache"), "pipeline.json")
+
+
+def _load_cache() -> Dict[str, Any]:
+    try:
+        with open(_cache_path()) as f:
+            cache = json.load(f)
+        if cache.get("version") == CACHE_VERSION:
+            return cache
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable pipeline cache: {e}")
+    return {"version": CACHE_VERSION, "stages": {}}
+
+
+def _store(key: str, stage: str, output: Any, seconds: float):
+    """Records a stage output (re-reading the file under the lock: other processes may have written meanwhile)."""
+    with _cache_lock, docker_handler.locked_file(_cache_path()):
+        cache = _load_cache()
+        entries = cache["stages"]
+        entries.pop(key, None)
+        entries[key] = {"stage": stage, "output": output, "seconds": round(seconds, 2), "at": time.time()}
+        while len(entries) > MAX_CACHE_ENTRIES:
+            entries.pop(next(iter(entries)))
+        try:
+            os.makedirs(os.path.dirname(_cache_path()), exist_ok=True)
+            tmp = f"{_cache_path()}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f, separators=(",", ":"))
+            os.replace(tmp, _cache_path())
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not cache the output of stage {stage}: {e}")
+
+
+class Pipeline:
+    def __init__(self, name: str, stages: List[Stage]):
+        self.name = name
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        for stage in stages:
+            unknown = [need for need in stage.needs if need not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage {stage.name} needs unknown stage(s) {', '.join(unknown)}")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        order, done, visiting = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage dependency cycle through {name}")
+            visiting.add(name)
+            for need in self.stages[name].needs:
+                visit(need)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _execute(self, stage: Stage, outputs: Dict[str, Any], force: bool,
+                 progress: Callable[[str], None]) -> Dict[str, Any]:
+        started = time.monotonic()
+        result: Dict[str, Any] = {"started": started}
+        key = None
+        if stage.inputs is not None:
+            key = _digest(self.name, stage.name, stage.inputs(outputs))
+            cached = None if force else _load_cache()["stages"].get(key)
+            if cached is not None and (stage.check is None or stage.check(cached["output"])):
+                result.update(status="cached", output=cached["output"], saved_s=cached["seconds"],
+                              seconds=round(time.monotonic() - started, 2))
+                return result
+        try:
+            output = stage.run(StageContext(stage.name, outputs, progress))
+        except Exception as e:
+            if not isinstance(e, StageFailed):
+                logger.exception(f"Stage {stage.name} of {self.name} failed")
+            result.update(status="failed", error=str(e) or type(e).__name__,
+                          seconds=round(time.monotonic() - started, 2))
+            return result
+        seconds = time.monotonic() - started
+        if key is not None:
+            _store(key, stage.name, output, seconds)
+        result.update(status="succeeded", output=output, seconds=round(seconds, 2))
+        return result
+
+    def run(self, progress: Optional[Callable[[str], None]] = None, force: bool = False,
+            max_workers: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Runs every stage, as many at once as their needs allow. `force`
+        ignores cached outputs. Returns the report (see format_report).
+        """
+        progress_lock = threading.Lock()
+
+        def report_progress(message):
+            # Stage threads share the caller's callback (a job's progress is not thread-safe)
+            if progress:
+                with progress_lock:
+                    progress(message)
+
+        t0 = time.monotonic()
+        results: Dict[str, Dict[str, Any]] = {}
+        outputs: Dict[str, Any] = {}
+        running = {}
+        interrupted: Optional[BaseException] = None
+        executor = ThreadPoolExecutor(max_workers=max_workers or len(self.stages), thread_name_prefix="pipeline")
+        try:
+            while True:
+                if interrupted is None:
+                    for name in self.order:
+                        stage = self.stages[name]
+                        if name in results or any(results.get(need, {}).get("status") not in ("succeeded", "cached")
+                                                  for need in stage.needs):
+                            continue
+                        results[name] = {"status": "running"}
+                        report_progress(f"Starting stage {name}")
+                        needed = {need: outputs[need] for need in stage.needs}
+                        running[executor.submit(self._execute, stage, needed, force, report_progress)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException as e:
+                        # A cancelled job: start nothing new, let running stages finish, then re-raise
+                        results[name] = {"status": "failed", "error": "cancelled", "seconds": 0.0,
+                                         "started": t0}
+                        interrupted = interrupted or e
+                        continue
+                    results[name]["finished"] = time.monotonic()
+                    if results[name]["status"] in ("succeeded", "cached"):
+                        outputs[name] = results[name]["output"]
+                    report_progress(f"Stage {name} {results[name]['status']} "
+                                    f"({results[name]['seconds']:.1f}s)")
+                    if results[name]["status"] == "failed":
+                        self._skip_dependents(name, results)
+        finally:
+            executor.shutdown(wait=True)
+        if interrupted is not None:
+            raise interrupted
+        return self._report(results, time.monotonic() - t0)
+
+    def _skip_dependents(self, failed: str, results: Dict[str, Dict[str, Any]]):
+        for name in self.order:
+            stage = self.stages[name]
+            if name not in results and any(need == failed or results.get(need, {}).get("status") == "skipped"
+                                           for need in stage.needs):
+                results[name] = {"status": "skipped", "error": f"needs {failed}", "seconds": 0.0}
+
+    def _report(self, results: Dict[str, Dict[str, Any]], wall_s: float) -> Dict[str, Any]:
+        # Critical path: the chain of needs with the latest finish, using the time each stage took
+        finish: Dict[str, float] = {}
+        via: Dict[str, Optional[str]] = {}
+        for name in self.order:
+            before = max(self.stages[name].needs, key=lambda need: finish[need], default=None)
+            finish[name] = results[name]["seconds"] + (finish[before] if before else 0.0)
+            via[name] = before
+        path, name = [], max(finish, key=finish.get) if finish else None
+        while name:
+            path.append(name)
+            name = via[name]
+        stages = [{"name": name, **{key: value for key, value in results[name].items()
+                                    if key not in ("started", "finished")}} for name in self.order]
+        return {"pipeline": self.name, "stages": stages,
+                "success": all(stage["status"] in ("succeeded", "cached") for stage in stages),
+                "wall_s": round(wall_s, 2), "serial_s": round(sum(stage["seconds"] for stage in stages), 2),
+                "critical_path": path[::-1], "critical_s": round(finish[path[0]], 2) if path else 0.0,
+                "saved_s": round(sum(stage.get("saved_s", 0.0) for stage in stages), 2)}
+
+
+_STATUS_ICONS = {"succeeded": "✅", "cached": "♻️", "failed": "❌", "skipped": "⏭️"}
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [f"{'✅' if report['success'] else '❌'} *Pipeline {report['pipeline']}* finished in "
+             f"{report['wall_s']:.1f}s (stages took {report['serial_s']:.1f}s in total; critical path "
+             f"{report['critical_s']:.1f}s: {' → '.join(report['critical_path'])})"]
+    for stage in report["stages"]:
+        line = f"{_STATUS_ICONS.get(stage['status'], '•')} {stage['name']}: {stage['status']} {stage['seconds']:.1f}s"
+        if stage["status"] == "cached":
+            line += f" (inputs unchanged, {stage['saved_s']:.1f}s saved)"
+        output = stage.get("output")
+        if isinstance(output, dict) and output.get("summary"):
+            line += f" — {output['summary']}"
+        if stage.get("error"):
+            line += f" — {stage['error']}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# --- The website pipeline ---
+def _run_in_container(client, image: str, command: str, source: str, excludes: Iterable[str],
+                      progress: Callable[[str], None]):
+    """
+    Copies `source` to /app of a fresh `image` container, runs `command` there
+    and removes the container. Returns (exit code, output). The files go in
+    through the API rather than a bind mount, so this works wherever the
+    daemon runs.
+    """
+    try:
+        client.images.get(image)
+    except docker.errors.ImageNotFound:
+        docker_handler.pull_image(client, image, progress=progress)
+    container = client.containers.create(image, ["sh", "-c", command], working_dir="/app",
+                                         labels={"chatops.role": "pipeline"},
+                                         volumes={NPM_CACHE_VOLUME: {"bind": "/root/.npm", "mode": "rw"}})
+    try:
+        entries, _ = build_context.walk_context(source, excludes=excludes)
+        entries = [build_context.ContextEntry(f"app/{entry.rel}", entry.full, entry.st) for entry in entries]
+        container.put_archive("/", build_context.ContextStream(entries))
+        container.start()
+        try:
+            status = container.wait(timeout=STAGE_TIMEOUT)
+        except Exception as e:
+            raise StageFailed(f"timed out after {STAGE_TIMEOUT:.0f}s ({e})")
+        return status.get("StatusCode", 1), container.logs().decode(errors="replace")
+    finally:
+        container.remove(force=True)
+
+
+class _HtmlLint(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.refs: List[str] = []
+        self.missing_alt = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "img" and not attrs.get("alt"):
+            self.missing_alt += 1
+        for name in ("src", "href"):
+            if attrs.get(name):
+                self.refs.append(attrs[name])
+
+
+def _lint_website(root: str, excludes: Iterable[str]) -> Dict[str, Any]:
+    """Local links that point nowhere are errors; images without alt text are warnings."""
+    entries, _ = build_context.walk_context(root, excludes=excludes)
+    files = {entry.rel for entry in entries}
+    broken, warnings = [], []
+    for entry in entries:
+        if not entry.rel.endswith((".html", ".htm")):
+            continue
+        parser = _HtmlLint()
+        with open(entry.full, encoding="utf-8", errors="replace") as f:
+            parser.feed(f.read())
+        for ref in parser.refs:
+            resolved = asset_pipeline._resolve(entry.rel, ref)
+            if resolved and not {resolved[0], posixpath.join(resolved[0], "index.html")} & files:
+                broken.append(f"{entry.rel} → {ref}")
+        if parser.missing_alt:
+            warnings.append(f"{entry.rel}: {parser.missing_alt} image(s) without alt text")
+    if broken:
+        raise StageFailed(f"broken local links: {'; '.join(broken[:10])}")
+    return {"files": len(files), "warnings": warnings,
+            "summary": f"{len(files)} files, {len(warnings)} warning(s)" + (f": {'; '.join(warnings)}" if warnings else "")}
+
+
+def website_pipeline(handler, website_name: str = "my-website", deploy: bool = False,
+                     replicas: Optional[int] = None) -> Pipeline:
+    """
+    assets ─→ image ─┐
+    lint-website ────┤
+    lint-app ────────┼─→ deploy (only when `deploy`)
+    unit-tests ──────┘
+    """
+    client = handler.docker_client
+    website, app_dir, excludes = str(handler.website_dir), APP_DIR, handler.CONTEXT_EXCLUDES
+    app_excludes = ("node_modules",)
+    use_assets = asset_pipeline.enabled()
+
+    def lint_app(context):
+        scripts = [entry.rel for entry in build_context.walk_context(app_dir, excludes=app_excludes)[0]
+                   if entry.rel.endswith(".js")]
+        code, logs = _run_in_container(client, NODE_IMAGE, " && ".join(f"node --check {script}" for script in scripts)
+                                       or "true", app_dir, app_excludes, context.progress)
+        if code != 0:
+            raise StageFailed(f"syntax errors:\n{logs.strip()[-1500:]}")
+        return {"files": len(scripts), "summary": f"{len(scripts)} scripts parse"}
+
+    def unit_tests(context):
+        code, logs = _run_in_container(client, NODE_IMAGE,
+                                       "npm install --no-audit --no-fund --loglevel=error && npm test -- --ci",
+                                       app_dir, app_excludes, context.progress)
+        totals = [" ".join(line.split()) for line in logs.splitlines() if line.strip().startswith("Tests:")]
+        if code != 0:
+            raise StageFailed(f"npm test exited with {code}:\n{logs.strip()[-1500:]}")
+        return {"summary": totals[-1] if totals else "passed"}
+
+    def assets(context):
+        report = handler.optimize_assets(progress=context.progress)
+        return {"summary": asset_pipeline.format_asset_report(report)}
+
+    def image(context):
+        built, cache = handler.build_site_image(website_name, progress=context.progress)
+        return {"image_id": built.id, "tag": cache["tag"], "summary": build_cache.format_cache_report(cache)}
+
+    def image_exists(output):
+        try:
+            client.images.get(output["image_id"])
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    def release(context):
+        result = handler.release(website_name, replicas=replicas, progress=context.progress)
+        if not result["success"]:
+            raise StageFailed(blue_green.format_deploy_result(result))
+        return {"image_id": context.outputs["image"]["image_id"], "replicas": len(result["replicas"]),
+                "summary": blue_green.format_deploy_result(result).replace("\n", " ")}
+
+    def serving(output):
+        # Skipped only while that very image is what serves the site
+        info = blue_green.describe(client, website_name)
+        return bool(info) and info["image_id"] == output["image_id"] and info["replicas"] == output["replicas"]
+
+    site = str(handler.site_dir) if use_assets else website
+    stages = [
+        Stage("lint-website", lambda context: _lint_website(website, excludes),
+              inputs=lambda outputs: tree_digest(website, excludes)),
+        Stage("lint-app", lint_app, inputs=lambda outputs: [NODE_IMAGE, tree_digest(app_dir, app_excludes)]),
+        Stage("unit-tests", unit_tests, inputs=lambda outputs: [NODE_IMAGE, tree_digest(app_dir, app_excludes)]),
+        Stage("image", image, needs=("assets",) if use_assets else (),
+              inputs=lambda outputs: [website_name, tree_digest(site, () if use_assets else excludes)],
+              check=image_exists),
+    ]
+    if use_assets:
+        stages.insert(0, Stage("assets", assets,
+                            inputs=lambda outputs: [tree_digest(website, excludes), sorted(
+                                (key, value) for key, value in os.environ.items()
+                                if key.startswith(("ASSET_", "WEBSITE_NGINX_")))],
+                            check=lambda output: (handler.site_dir / asset_pipeline.SITE_ROOT).is_dir()))
+    if deploy:
+        stages.append(Stage("deploy", release, needs=("image", "lint-website", "lint-app", "unit-tests"),
+                            inputs=lambda outputs: [website_name, outputs["image"]["image_id"],
+                                                    replicas or os.environ.get("WEBSITE_REPLICAS")],
+                            check=serving))
+    return Pipeline(f"website {website_name}" + (" (deploy)" if deploy else ""), stages)
@@ -0,0 +1,440 @@
+# prometheus_handler.py
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+TimeLike = Union[datetime, float, int]
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "y": 31536000}
+
+
+class PrometheusError(Exception):
+    """Raised when the Prometheus HTTP API returns an error or cannot be reached."""
+
+
+class PrometheusTimeout(PrometheusError):
+    """Raised when a query does not complete within its timeout."""
+
+
+class PrometheusUnavailable(PrometheusError):
+    """Raised when the Prometheus server cannot be reached or is not serving queries."""
+
+
+def parse_duration(duration: Union[str, int, float]) -> float:
+    """Parses a Prometheus-style duration ("30s", "5m", "1h30m", "7d") into seconds."""
+    if isinstance(duration, (int, float)):
+        return float(duration)
+    text = duration.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(text)
+    if not parts or "".join(n + u for n, u in parts) != text:
+        raise ValueError(f"Invalid duration: '{duration}'")
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+
+def _to_timestamp(value: TimeLike) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def _series_key(metric: Dict[str, str]) -> Tuple:
+    return tuple(sorted(metric.items()))
+
+
+class PrometheusClient:
+    """
+    Minimal client for the Prometheus HTTP API.
+
+    Connections are pooled through a single requests.Session and every call has a
+    timeout. Range queries are cached per (query, step): windows are aligned to the
+    step so repeated queries hit the same evaluation timestamps, and only the part
+    of the window that is not cached yet is fetched. Samples newer than
+    `max_freshness` seconds are never cached because Prometheus may still revise them.
+    """
+
+    def __init__(self, url: str, timeout: float = 10.0, pool_size: int = 10, max_retries: int = 2,
+                 max_freshness: float = 60.0, cache_max_entries: int = 128):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.max_freshness = max_freshness
+        self.cache_max_entries = cache_max_entries
+        self.session = requests.Session()
+        # Retry refused connections and gateway errors, but never a query that timed out
+        retry = Retry(
+            total=max_retries,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"])
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._cache: "OrderedDict[Tuple[str, float], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "partial_hits": 0, "misses": 0, "requests": 0, "points_fetched": 0}
+
+    # --- HTTP ---
+    def _get(self, path: str, params: Dict[str, Any], timeout: Optional[float] = None) -> Any:
+        self.stats["requests"] += 1
+        try:
+            response = self.session.get(f"{self.url}{path}", params=params, timeout=timeout or self.timeout)
+        except requests.ConnectTimeout as e:
+            # Also a ConnectionError and a Timeout, but the server is unreachable (blackholed host,
+            # dropped SYN): fall back instead of reporting a slow query
+            raise PrometheusUnavailable(f"Could not reach Prometheus at {self.url}: {e}") from e
+        except (requests.Timeout, requests.exceptions.ConnectionError) as e:
+            # With read retries off, urllib3 reports a read timeout as a ConnectionError
+            if isinstance(e, requests.Timeout) or "read timed out" in str(e).lower():
+                raise PrometheusTimeout(f"Prometheus query timed out after {timeout or self.timeout}s") from e
+            raise PrometheusUnavailable(f"Could not reach Prometheus at {self.url}: {e}") from e
+        except requests.RequestException as e:
+            raise PrometheusUnavailable(f"Could not reach Prometheus at {self.url}: {e}") from e
+        try:
+            payload = response.json()
+        except ValueError:
+            if response.status_code >= 500:
+                # A proxy or a Prometheus that is still starting up, not a query error
+                raise PrometheusUnavailable(f"Prometheus at {self.url} is unavailable (HTTP {response.status_code})")
+            raise PrometheusError(f"Invalid response from Prometheus (HTTP {response.status_code})")
+        if payload.get("status") != "success":
+            raise PrometheusError(f"{payload.get('errorType', 'error')}: {payload.get('error', 'unknown error')}")
+        return payload["data"]
+
+    def check_connection(self) -> bool:
+        """Returns True if the Prometheus server answers its readiness endpoint."""
+        try:
+            return self.session.get(f"{self.url}/-/ready", timeout=self.timeout).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def custom_query(self, query: str, params: Optional[Dict[str, Any]] = None,
+                     timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Runs an instant query and returns the result list."""
+        request_params = {"query": query}
+        if params:
+            request_params.update(params)
+        if timeout:
+            request_params.setdefault("timeout", f"{int(timeout * 1000)}ms")
+        return self._get("/api/v1/query", request_params, timeout)["result"]
+
+    def _fetch_range(self, query: str, start: float, end: float, step: float,
+                     timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        data = self._get("/api/v1/query_range",
+                         {"query": query, "start": start, "end": end, "step": step}, timeout)
+        return data["result"]
+
+    # --- Range queries with cache ---
+    def custom_query_range(self, query: str, start_time: TimeLike, end_time: TimeLike,
+                           step: Union[str, float], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Runs a range query and returns the result in Prometheus matrix format
+        ([{"metric": {...}, "values": [[ts, "value"], ...]}, ...]).
+        """
+        step_s = parse_duration(step)
+        if step_s <= 0:
+            raise ValueError("step must be positive")
+        start = math.floor(_to_timestamp(start_time) / step_s) * step_s
+        end = math.floor(_to_timestamp(end_time) / step_s) * step_s
+        if end < start:
+            return []
+        key = (query, step_s)
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry["end"] >= entry["start"]:
+                self._cache.move_to_end(key)
+                cached_start, cached_end = entry["start"], entry["end"]
+            else:
+                cached_start = cached_end = None
+
+        # Work out which parts of [start, end] are missing from the cache
+        if cached_start is None or end < cached_start or start > cached_end + step_s:
+            missing = [(start, end)]
+            full_miss = True
+            self.stats["misses"] += 1
+        else:
+            full_miss = False
+            missing = []
+            if start < cached_start:
+                missing.append((start, cached_start - step_s))
+            if end > cached_end:
+                missing.append((cached_end + step_s, end))
+            self.stats["partial_hits" if missing else "hits"] += 1
+
+        fetched = [self._fetch_range(query, seg_start, seg_end, step_s, timeout) for seg_start, seg_end in missing]
+        return self._merge_and_slice(key, fetched, start, end, step_s, reuse=not full_miss)
+
+    def _merge_and_slice(self, key: Tuple[str, float], fetched: List[List[Dict[str, Any]]], start: float,
+                         end: float, step_s: float, reuse: bool) -> List[Dict[str, Any]]:
+        """Merges freshly fetched segments into the cache entry and returns the requested window."""
+        cache_limit = math.floor((time.time() - self.max_freshness) / step_s) * step_s
+        with self._lock:
+            entry = self._cache.get(key) if reuse else None
+            if entry is None:
+                entry = {"start": start, "end": start - step_s, "series": {}}
+            fresh: Dict[Tuple, Tuple[Dict[str, str], Dict[float, str]]] = {}
+            for result in fetched:
+                for series in result:
+                    skey = _series_key(series["metric"])
+                    cached_points = entry["series"].setdefault(skey, (series["metric"], {}))[1]
+                    fresh_points = fresh.setdefault(skey, (series["metric"], {}))[1]
+                    for ts, value in series["values"]:
+                        ts = float(ts)
+                        (cached_points if ts <= cache_limit else fresh_points)[ts] = value
+                        self.stats["points_fetched"] += 1
+
+            # Cache now covers [start, newest final sample]; older samples slid out of the window
+            entry["start"] = start
+            entry["end"] = max(entry["end"], min(end, cache_limit))
+            for skey, (_, points) in list(entry["series"].items()):
+                for ts in [ts for ts in points if ts < start]:
+                    del points[ts]
+                if not points:
+                    del entry["series"][skey]
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_max_entries:
+                self._cache.popitem(last=False)
+
+            result = []
+            for skey in entry["series"].keys() | fresh.keys():
+                metric, points = entry["series"].get(skey) or fresh[skey]
+                points = dict(points)
+                if skey in fresh:
+                    points.update(fresh[skey][1])
+                values = [[ts, points[ts]] for ts in sorted(points) if start <= ts <= end]
+                if values:
+                    result.append({"metric": metric, "values": values})
+        return result
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class FallbackClient:
+    """
+    Sends queries to `primary` and, when it is unavailable, to fallback sources with
+    the same custom_query/custom_query_range interface (the built-in metric store,
+    the offline TSDB reader). Fallbacks are tried in order; one that is missing,
+    fails or returns no series hands over to the next. Query errors and timeouts from the
+    primary are not retried elsewhere. After a failure the primary is skipped for
+    `cooldown` seconds.
+
+    Fallbacks are given as factories and created on first use, since opening them
+    may be expensive. A factory may return None if its source is not available; one
+    that raises is retried on the next query.
+    """
+
+    def __init__(self, primary: Optional[PrometheusClient], fallback_factories: List[Callable[[], Any]],
+                 cooldown: float = 30.0):
+        self.primary = primary
+        self.fallback_factories = fallback_factories
+        self.cooldown = cooldown
+        self._fallbacks: Dict[int, Any] = {}
+        self._fallback_lock = threading.Lock()
+        self._primary_down_until = 0.0
+        self.stats = {"primary": 0, "fallback": 0, "primary_failures": 0}
+
+    def _fallback(self, index: int):
+        with self._fallback_lock:
+            if index not in self._fallbacks:
+                self._fallbacks[index] = self.fallback_factories[index]()
+            return self._fallbacks[index]
+
+    def _call(self, method: str, *args, **kwargs):
+        if self.primary is not None and time.monotonic() >= self._primary_down_until:
+            try:
+                result = getattr(self.primary, method)(*args, **kwargs)
+                self.stats["primary"] += 1
+                return result
+            except PrometheusUnavailable as e:
+                self.stats["primary_failures"] += 1
+                self._primary_down_until = time.monotonic() + self.cooldown
+                logger.warning(f"{e}; using fallback data sources for the next {self.cooldown:.0f}s")
+        result = None
+        errors = []
+        for index in range(len(self.fallback_factories)):
+            try:
+                source = self._fallback(index)
+                if source is None:
+                    continue
+                result = getattr(source, method)(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"Fallback data source {index} failed: {e}")
+                errors.append(f"{type(e).__name__}: {e}")
+                continue
+            if result:
+                break
+        if result is None:
+            if errors:
+                raise PrometheusUnavailable(f"Prometheus and every fallback data source are unavailable "
+                                            f"({'; '.join(errors)})")
+            raise PrometheusUnavailable("Prometheus is unavailable and no fallback data source is configured")
+        self.stats["fallback"] += 1
+        return result
+
+    def custom_query(self, query: str, params: Optional[Dict[str, Any]] = None,
+                     timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        return self._call("custom_query", query, params=params, timeout=timeout)
+
+    def custom_query_range(self, query: str, start_time: TimeLike, end_time: TimeLike, step: Union[str, float],
+                           timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        return self._call("custom_query_range", query, start_time, end_time, step, timeout=timeout)
+
+    def check_connection(self) -> bool:
+        return self.primary is not None and self.primary.check_connection()
+
+
+def get_prometheus_client() -> Optional[PrometheusClient]:
+    """
+    Returns a PrometheusClient configured from PROMETHEUS_URL, or None when
+    PROMETHEUS_ENABLED is false or no URL is configured.
+    """
+    enabled = os.environ.get("PROMETHEUS_ENABLED", "true").lower() in ("1", "true", "yes")
+    url = os.environ.get("PROMETHEUS_URL")
+    if not enabled or not url:
+        logger.warning("Prometheus is disabled or PROMETHEUS_URL is not set.")
+        return None
+    timeout = float(os.environ.get("PROMETHEUS_TIMEOUT", "10"))
+    return PrometheusClient(url, timeout=timeout)
+
+
+# Self-check against a local stub server: python prometheus_handler.py
+# (exits non-zero if the range cache misaligns windows or refetches cached data)
+if __name__ == "__main__":
+    import json
+    import sys
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    logging.basicConfig(level=logging.INFO)
+    requested_ranges = []
+
+    class StubPrometheus(BaseHTTPRequestHandler):
+        """Answers /api/v1/query and /api/v1/query_range with deterministic series."""
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == "/-/ready":
+                body = b"Prometheus Server is Ready.\n"
+            elif url.path == "/api/v1/query":
+                now = time.time()
+                result = [{"metric": {"pod": f"pod-{i}"}, "value": [now, str(i + math.sin(now))]} for i in range(3)]
+                body = json.dumps({"status": "success", "data": {"resultType": "vector", "result": result}}).encode()
+            elif url.path == "/api/v1/query_range":
+                start, end, step = float(params["start"]), float(params["end"]), float(params["step"])
+                requested_ranges.append((start, end))
+                timestamps = [start + i * step for i in range(int((end - start) // step) + 1)]
+                result = [{"metric": {"pod": f"pod-{i}"},
+                           "values": [[ts, str(i + math.sin(ts / 600))] for ts in timestamps]} for i in range(3)]
+                body = json.dumps({"status": "success", "data": {"resultType": "matrix", "result": result}}).encode()
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPrometheus)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = PrometheusClient(f"http://127.0.0.1:{server.server_address[1]}", timeout=2)
+    failures = []
+
+    def check(condition: bool, message: str):
+        logger.info(f"{'ok  ' if condition else 'FAIL'} {message}")
+        if not condition:
+            failures.append(message)
+
+    def query(start: float, end: float):
+        """Runs a cached range query; returns (result, ranges requested from the stub, points fetched)."""
+        requests_before, points_before = len(requested_ranges), client.stats["points_fetched"]
+        result = client.custom_query_range("up", start, end, step)
+        ranges = requested_ranges[requests_before:]
+        expected = client._fetch_range("up", math.floor(start / step) * step, math.floor(end / step) * step, step)
+        del requested_ranges[requests_before + len(ranges):]
+        check([s["values"] for s in sorted(result, key=lambda s: s["metric"]["pod"])] ==
+              [s["values"] for s in expected], f"{start:.0f}-{end:.0f}: cached result matches an uncached fetch")
+        return result, ranges, client.stats["points_fetched"] - points_before
+
+    check(client.check_connection(), "stub answers /-/ready")
+    window, step, series = 6 * 3600, 60, 3
+    # A window that ended well before max_freshness, so all of it is cacheable
+    end = math.floor(time.time() / step) * step - 3 * 3600
+    start = end - window
+
+    _, ranges, points = query(start + 7, end + 7)
+    check(ranges == [(start, end)], f"cold query fetches the step-aligned window: {ranges}")
+    check(points == series * (window // step + 1), f"cold query fetches every point once: {points}")
+
+    _, ranges, points = query(start + 42, end + 42)
+    check(ranges == [] and points == 0, f"same window at other unaligned times is a cache hit: {ranges}")
+    check(client.stats["hits"] == 1, f"counted as a hit: {client.stats}")
+
+    _, ranges, points = query(start + 600, end + 600)
+    check(ranges == [(end + step, end + 600)], f"window moved 10m: only the new tail is fetched: {ranges}")
+    check(points == series * 10, f"10 new steps per series fetched: {points}")
+
+    _, ranges, points = query(start - 3600, end + 600)
+    check(ranges == [(start - 3600, start + 600 - step)], f"window extended 1h back: only the head is fetched: {ranges}")
+
+    # A live window: samples newer than max_freshness are refetched every time, older ones never
+    now = time.time()
+    query(now - window, now)
+    _, ranges, points = query(now - window, now + 1)
+    cache_limit = math.floor((time.time() - client.max_freshness) / step) * step
+    check(len(ranges) == 1 and ranges[0][0] >= cache_limit - step
+          and ranges[0][1] - ranges[0][0] <= client.max_freshness + step,
+          f"repeated live query refetches only the last {client.max_freshness:.0f}s: {ranges}")
+
+    # Fallbacks: a factory that raises or a source whose query fails hands over to the next one
+    class BrokenSource:
+        def custom_query(self, query, params=None, timeout=None):
+            raise OSError("snapshot unreadable")
+
+    def broken_factory():
+        raise OSError("no such store")
+
+    unreachable = PrometheusClient("http://127.0.0.1:9", timeout=1)
+    chain = FallbackClient(unreachable, [broken_factory, BrokenSource, lambda: None, lambda: client])
+    try:
+        check(len(chain.custom_query("up")) == series, "failing fallbacks are skipped for a working one")
+    except Exception as e:
+        check(False, f"failing fallbacks are skipped for a working one: {e!r}")
+    try:
+        FallbackClient(unreachable, [broken_factory, BrokenSource]).custom_query("up")
+        check(False, "all sources failing raises PrometheusUnavailable")
+    except PrometheusUnavailable as e:
+        check("no such store" in str(e) and "snapshot unreadable" in str(e),
+              f"all sources failing raises PrometheusUnavailable: {e}")
+
+    logger.info(f"Cache stats: {client.stats}")
+    server.shutdown()
+    if failures:
+        logger.error(f"{len(failures)} check(s) failed")
+        sys.exit(1)
@@ -0,0 +1,327 @@
+# promql_lite.py
+"""
+A small PromQL subset evaluated in-process over any series source. Used by the
+offline TSDB reader and the built-in metric store so both answer the same queries
+as PrometheusClient, in the same result format.
+
+Supported: selectors with =, !=, =~, !~; rate/irate/increase over a range;
+sum/avg/min/max/count with by/without; + - * / and comparison filters
+(== != > < >= <=) between scalars and vectors.
+"""
+import re
+import time
+import warnings
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from prometheus_handler import PrometheusError, parse_duration
+
+LOOKBACK_DELTA_MS = 5 * 60 * 1000
+
+
+class QueryEngine:
+    """
+    Base class for series sources. Subclasses provide `_postings`
+    ({label: {value: set(keys)}}) and implement series_keys, series_labels,
+    read_series (timestamps in ms) and series_end.
+
+    With `anchor_to_data`, windows that end after the newest matching sample are
+    shifted back to end at it. Returned timestamps are always the real ones.
+    """
+
+    anchor_to_data = False
+    _postings: Dict[str, Dict[str, set]]
+
+    def series_keys(self) -> Iterable[Tuple]:
+        raise NotImplementedError
+
+    def series_labels(self, key: Tuple) -> Dict[str, str]:
+        raise NotImplementedError
+
+    def read_series(self, key: Tuple, mint: int, maxt: int) -> Tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+    def series_end(self, key: Tuple) -> Optional[int]:
+        raise NotImplementedError
+
+    def match_series(self, matchers: List[Tuple[str, str, str]]) -> List[Tuple]:
+        """Returns the keys of series matching all (name, op, value) label matchers."""
+        candidates = None
+        for name, op, value in matchers:
+            if op == "=" and value != "":
+                found = self._postings.get(name, {}).get(value, set())
+                candidates = found if candidates is None else candidates & found
+        keys = candidates if candidates is not None else self.series_keys()
+        result = []
+        for key in keys:
+            labels = self.series_labels(key)
+            if all(_match(labels.get(name, ""), op, value) for name, op, value in matchers):
+                result.append(key)
+        return result
+
+    def _window(self, query: str, start_s: float, end_s: float) -> Tuple[float, float]:
+        """
+        Shifts [start, end] back so it ends at the newest sample of the series the
+        query selects. Sources often cover disjoint ranges per series (e.g. TSDB head
+        chunks vs WAL), so a store-wide maximum would leave most queries empty.
+        """
+        if not self.anchor_to_data:
+            return start_s, end_s
+        ends = [self.series_end(key) for selector in _selectors(query)
+                for key in self.match_series(_parse_selector(selector))]
+        latest = max((e for e in ends if e is not None), default=None)
+        if latest is not None and end_s * 1000 > latest:
+            shift = end_s - latest / 1000
+            return start_s - shift, end_s - shift
+        return start_s, end_s
+
+    def custom_query_range(self, query: str, start_time, end_time, step, timeout: Optional[float] = None
+                           ) -> List[Dict[str, Any]]:
+        step_s = parse_duration(step)
+        start = start_time.timestamp() if isinstance(start_time, datetime) else float(start_time)
+        end = end_time.timestamp() if isinstance(end_time, datetime) else float(end_time)
+        start, end = self._window(query, start, end)
+        eval_ts = np.arange((start // step_s) * step_s, (end // step_s) * step_s + step_s / 2, step_s)
+        return _to_matrix(self._evaluate(query.strip(), (eval_ts * 1000).astype(np.int64)), eval_ts)
+
+    def custom_query(self, query: str, params: Optional[Dict[str, Any]] = None,
+                     timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        now = time.time()
+        _, at = self._window(query, now, now)
+        result = self._evaluate(query.strip(), np.array([int(at * 1000)], dtype=np.int64))
+        return [{"metric": labels, "value": [at, repr(float(values[0]))]}
+                for labels, values in result if not np.isnan(values[0])]
+
+    def _evaluate(self, expr: str, eval_ms: np.ndarray) -> List[Tuple[Dict[str, str], np.ndarray]]:
+        while expr.startswith("(") and _closing_paren(expr, 0) == len(expr) - 1:
+            expr = expr[1:-1].strip()
+        binary = _split_binary(expr)
+        if binary:
+            lhs, op, rhs = binary
+            return _binary(op, self._operand(lhs, eval_ms), self._operand(rhs, eval_ms))
+        match = _AGGREGATION_RE.match(expr)
+        if match:
+            op, mode, grouping, inner = match.groups()
+            labels = [l.strip() for l in (grouping or "").split(",") if l.strip()]
+            return _aggregate(op, mode, labels, self._evaluate(inner, eval_ms))
+        match = _RANGE_FUNCTION_RE.match(expr)
+        if match:
+            function, selector, window = match.groups()
+            window_ms = int(parse_duration(window) * 1000)
+            out = []
+            for key in self.match_series(_parse_selector(selector)):
+                t, v = self.read_series(key, int(eval_ms[0]) - window_ms, int(eval_ms[-1]))
+                labels = {k: val for k, val in self.series_labels(key).items() if k != "__name__"}
+                out.append((labels, _rate(function, t, v, eval_ms, window_ms)))
+            return out
+        if _SELECTOR_RE.match(expr):
+            out = []
+            for key in self.match_series(_parse_selector(expr)):
+                t, v = self.read_series(key, int(eval_ms[0]) - LOOKBACK_DELTA_MS, int(eval_ms[-1]))
+                out.append((dict(self.series_labels(key)), _instant(t, v, eval_ms)))
+            return out
+        raise PrometheusError(f"Expression not supported by the local query engine: {expr}")
+
+    def _operand(self, expr: str, eval_ms: np.ndarray) -> Union[float, List[Tuple[Dict[str, str], np.ndarray]]]:
+        try:
+            return float(expr)
+        except ValueError:
+            return self._evaluate(expr, eval_ms)
+
+
+# --- Query helpers ---
+_SELECTOR_RE = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*(\{.*\})?$|^\{.*\}$")
+_MATCHER_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*,?')
+_RANGE_FUNCTION_RE = re.compile(r"^(rate|irate|increase)\s*\(\s*(.+?)\s*\[(\w+)\]\s*\)$")
+_EXPONENT_RE = re.compile(r"(?<![\w:])\d+(?:\.\d*)?[eE]$")
+_AGGREGATION_RE = re.compile(r"^(sum|avg|max|min|count)\s*(?:(by|without)\s*\(([^)]*)\))?\s*\((.+)\)$")
+
+
+def _closing_paren(expr: str, start: int) -> int:
+    depth = 0
+    for i in range(start, len(expr)):
+        if expr[i] == "(":
+            depth += 1
+        elif expr[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+# Binary operators from lowest to highest precedence
+_BINARY_LEVELS = (("==", "!=", ">=", "<=", ">", "<"), ("+", "-"), ("*", "/"))
+_COMPARISONS = {"==": np.equal, "!=": np.not_equal, ">=": np.greater_equal, "<=": np.less_equal,
+                ">": np.greater, "<": np.less}
+_ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide}
+
+
+def _split_binary(expr: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Splits at the last top-level operator of the lowest precedence, which makes
+    the operators left-associative. Returns None if there is none.
+    """
+    for operators in _BINARY_LEVELS:
+        depth = 0
+        quoted = False
+        for i in range(len(expr) - 1, 0, -1):
+            c = expr[i]
+            if c == '"' and expr[i - 1] != "\\":
+                quoted = not quoted
+            elif quoted:
+                continue
+            elif c in ")}]":
+                depth += 1
+            elif c in "({[":
+                depth -= 1
+            elif depth == 0:
+                op = expr[i - 1:i + 1] if expr[i - 1:i + 1] in operators else c if c in operators else None
+                if op is None or (op in "+-" and _EXPONENT_RE.search(expr, 0, i)):
+                    continue
+                lhs, rhs = expr[:i + 1 - len(op)].strip(), expr[i + 1:].strip()
+                if lhs and rhs:
+                    return lhs, op, rhs
+    return None
+
+
+def _binary(op: str, lhs, rhs) -> List[Tuple[Dict[str, str], np.ndarray]]:
+    """
+    Arithmetic and comparisons between scalars and vectors; vectors match one-to-one
+    on labels without __name__. Comparisons filter: the left-hand value is kept
+    where the comparison holds and dropped (NaN) elsewhere.
+    """
+    if isinstance(lhs, float) and isinstance(rhs, float):
+        raise PrometheusError("Scalar-only expressions are not supported by the local query engine")
+    compare = _COMPARISONS.get(op)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if compare is not None:
+            def apply(a, b):
+                # With a scalar on the left, the vector sample is what survives the filter
+                return np.where(compare(a, b), b if isinstance(a, float) else a, np.nan)
+            # Filtering keeps the metric name, arithmetic drops it
+            relabel = dict
+        else:
+            apply = _ARITHMETIC[op]
+            relabel = _drop_name
+        if isinstance(lhs, float):
+            return [(relabel(m), apply(lhs, v)) for m, v in rhs]
+        if isinstance(rhs, float):
+            return [(relabel(m), apply(v, rhs)) for m, v in lhs]
+        right = {tuple(sorted(_drop_name(m).items())): v for m, v in rhs}
+        out = []
+        for metric, values in lhs:
+            other = right.get(tuple(sorted(_drop_name(metric).items())))
+            if other is not None:
+                out.append((relabel(metric), apply(values, other)))
+        return out
+
+
+def _drop_name(metric: Dict[str, str]) -> Dict[str, str]:
+    return {k: v for k, v in metric.items() if k != "__name__"}
+
+
+def _selectors(expr: str) -> List[str]:
+    """Series selectors in a query of the supported subset."""
+    expr = expr.strip()
+    while expr.startswith("(") and _closing_paren(expr, 0) == len(expr) - 1:
+        expr = expr[1:-1].strip()
+    binary = _split_binary(expr)
+    if binary:
+        return _selectors(binary[0]) + _selectors(binary[2])
+    for pattern, group in ((_AGGREGATION_RE, 4), (_RANGE_FUNCTION_RE, 2)):
+        match = pattern.match(expr)
+        if match:
+            return _selectors(match.group(group))
+    return [expr] if _SELECTOR_RE.match(expr) else []
+
+
+def _parse_selector(selector: str) -> List[Tuple[str, str, str]]:
+    name, _, rest = selector.partition("{")
+    matchers = [("__name__", "=", name.strip())] if name.strip() else []
+    body = rest.rstrip().rstrip("}")
+    pos = 0
+    while pos < len(body):
+        match = _MATCHER_RE.match(body, pos)
+        if not match:
+            raise PrometheusError(f"Invalid selector: {selector}")
+        matchers.append((match.group(1), match.group(2), match.group(3).encode().decode("unicode_escape")))
+        pos = match.end()
+    return matchers
+
+
+def _match(actual: str, op: str, expected: str) -> bool:
+    if op == "=":
+        return actual == expected
+    if op == "!=":
+        return actual != expected
+    matched = re.fullmatch(expected, actual) is not None
+    return matched if op == "=~" else not matched
+
+
+def _instant(t: np.ndarray, v: np.ndarray, eval_ms: np.ndarray) -> np.ndarray:
+    """Latest sample at or before each evaluation time, within the lookback delta."""
+    idx = np.searchsorted(t, eval_ms, side="right") - 1
+    out = np.full(len(eval_ms), np.nan)
+    ok = idx >= 0
+    ok[ok] &= (eval_ms[ok] - t[idx[ok]]) <= LOOKBACK_DELTA_MS
+    out[ok] = v[idx[ok]]
+    return out
+
+
+def _rate(function: str, t: np.ndarray, v: np.ndarray, eval_ms: np.ndarray, window_ms: int) -> np.ndarray:
+    """rate/irate/increase over a trailing window (without Prometheus' edge extrapolation)."""
+    out = np.full(len(eval_ms), np.nan)
+    if len(t) < 2:
+        return out
+    # Undo counter resets so differences are always non-negative
+    drops = np.concatenate([[0.0], np.where(np.diff(v) < 0, v[:-1], 0.0)])
+    counter = v + np.cumsum(drops)
+    hi = np.searchsorted(t, eval_ms, side="right") - 1
+    lo = hi - 1 if function == "irate" else np.searchsorted(t, eval_ms - window_ms, side="right")
+    ok = (hi >= 0) & (lo >= 0) & (hi > lo)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        per_second = (counter[hi[ok]] - counter[lo[ok]]) / ((t[hi[ok]] - t[lo[ok]]) / 1000.0)
+    out[ok] = per_second * (window_ms / 1000.0) if function == "increase" else per_second
+    return out
+
+
+def _aggregate(op: str, mode: Optional[str], labels: List[str],
+               series: List[Tuple[Dict[str, str], np.ndarray]]) -> List[Tuple[Dict[str, str], np.ndarray]]:
+    groups: Dict[Tuple, List[np.ndarray]] = {}
+    group_labels: Dict[Tuple, Dict[str, str]] = {}
+    for metric, values in series:
+        if mode == "by":
+            kept = {k: metric[k] for k in labels if k in metric}
+        elif mode == "without":
+            kept = {k: v for k, v in metric.items() if k not in labels and k != "__name__"}
+        else:
+            kept = {}
+        key = tuple(sorted(kept.items()))
+        groups.setdefault(key, []).append(values)
+        group_labels[key] = kept
+    reducers = {"sum": np.nansum, "avg": np.nanmean, "max": np.nanmax, "min": np.nanmin,
+                "count": lambda a, axis: np.sum(~np.isnan(a), axis=axis).astype(float)}
+    out = []
+    for key, rows in groups.items():
+        stacked = np.vstack(rows)
+        with warnings.catch_warnings():
+            # All-NaN columns are expected where no series had a sample
+            warnings.simplefilter("ignore", RuntimeWarning)
+            reduced = reducers[op](stacked, axis=0)
+        reduced[np.all(np.isnan(stacked), axis=0)] = np.nan
+        out.append((group_labels[key], reduced))
+    return out
+
+
+def _to_matrix(series: List[Tuple[Dict[str, str], np.ndarray]], eval_ts: np.ndarray) -> List[Dict[str, Any]]:
+    result = []
+    for metric, values in series:
+        ok = ~np.isnan(values)
+        if ok.any():
+            result.append({"metric": metric,
+                           "values": [[float(ts), repr(float(val))] for ts, val in zip(eval_ts[ok], values[ok])]})
+    return result
+
+
@@ -0,0 +1,77 @@
+# shared_cache.py
+"""
+Small TTL cache shared by the bot processes on one host.
+
+Results that are expensive to compute and identical for every caller (the
+health score, capacity forecasts) are stored as JSON in an SQLite table, so a
+command answered by one process warms the cache for all of them instead of
+each process querying Prometheus on its own.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value):
+    # numpy scalars and arrays (anomaly and forecast results)
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class SharedCache:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL,
+                                expires_at REAL NOT NULL
+                            ) WITHOUT ROWID""")
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT value FROM cache WHERE key = ? AND expires_at > ?",
+                                       (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache read failed: {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        try:
+            data = json.dumps(value, default=_json_default)
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                                 (key, data, time.time() + ttl))
+                # Keys are a handful of fixed names, so expired rows are few; drop them as we go
+                self._db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning(f"Shared cache write of {key} failed: {e}")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def get_shared_cache() -> Optional[SharedCache]:
+    """Cache at SHARED_CACHE_DB (default $BOT_STATE_DIR/cache.db), unless SHARED_CACHE_ENABLED is false."""
+    if os.environ.get("SHARED_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    path = os.environ.get("SHARED_CACHE_DB") or os.path.join(os.environ.get("BOT_STATE_DIR", "state"), "cache.db")
+    try:
+        return SharedCache(path)
+    except sqlite3.Error as e:
+        logger.error(f"Could not open shared cache {path}: {e}; caches stay per process")
+        return None
@@ -0,0 +1,516 @@
+# tsdb_reader.py
+"""
+Read-only access to an on-disk Prometheus TSDB (e.g. monitoring-stack/prometheus_data)
+for when the Prometheus server itself is down.
+
+Block index and chunk files and the head chunk files are memory-mapped; XOR chunks
+are decoded straight from the mapping. The WAL is replayed once on open to recover
+head series labels and the samples not yet cut into head chunks. Queries go through
+the PromQL subset in promql_lite and return results in the same format as
+PrometheusClient.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from promql_lite import QueryEngine
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = 0xBAAAD700
+CHUNKS_MAGIC = 0x85BD40DD
+HEAD_CHUNKS_MAGIC = 0x0130BC91
+ENCODING_XOR = 1
+
+WAL_PAGE_SIZE = 32 * 1024
+WAL_HEADER_SIZE = 7
+WAL_REC_FULL, WAL_REC_FIRST, WAL_REC_MIDDLE, WAL_REC_LAST = 1, 2, 3, 4
+WAL_SNAPPY_FLAG, WAL_ZSTD_FLAG = 0x08, 0x10
+RECORD_SERIES, RECORD_SAMPLES = 1, 2
+
+_BE64 = struct.Struct(">Q")
+_BE32 = struct.Struct(">I")
+
+
+# --- Encoding helpers ---
+def _uvarint(buf, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _varint(buf, pos: int) -> Tuple[int, int]:
+    u, pos = _uvarint(buf, pos)
+    return (u >> 1) ^ -(u & 1), pos
+
+
+def snappy_decompress(data) -> bytes:
+    """Decodes a snappy block (the format the WAL uses for compressed records)."""
+    length, pos = _uvarint(data, 0)
+    out = bytearray()
+    end = len(data)
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        kind = tag & 0x03
+        if kind == 0:  # literal
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos:pos + extra], "little")
+                pos += extra
+            size += 1
+            out += data[pos:pos + size]
+            pos += size
+            continue
+        if kind == 1:
+            size = 4 + ((tag >> 2) & 0x07)
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset = data[pos] | (data[pos + 1] << 8)
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:  # overlapping copy repeats the last `offset` bytes
+            for i in range(size):
+                out.append(out[start + i])
+    if len(out) != length:
+        raise ValueError(f"snappy: expected {length} bytes, got {len(out)}")
+    return bytes(out)
+
+
+def decode_xor_chunk(data) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes a Gorilla/XOR chunk into (timestamps in ms, values).
+    `data` can be a memoryview into an mmap; bits are read from it in place.
+    """
+    n = (data[0] << 8) | data[1]
+    timestamps = np.empty(n, dtype=np.int64)
+    bits = np.empty(n, dtype=np.uint64)
+    if n == 0:
+        return timestamps, bits.view(np.float64)
+    from_bytes = int.from_bytes
+    size = len(data)
+
+    def read(pos, nbits):
+        start = pos >> 3
+        end = (pos + nbits + 7) >> 3
+        word = from_bytes(data[start:min(end, size)], "big") << (8 * max(end - size, 0))
+        return (word >> ((end - start) * 8 - (pos & 7) - nbits)) & ((1 << nbits) - 1)
+
+    t, byte_pos = _varint(data, 2)
+    pos = byte_pos * 8
+    value = read(pos, 64)
+    pos += 64
+    timestamps[0] = t
+    bits[0] = value
+    t_delta = 0
+    leading = trailing = 0
+    for i in range(1, n):
+        if i == 1:
+            # Second timestamp is a plain uvarint delta
+            shift = t_delta = 0
+            while True:
+                b = read(pos, 8)
+                pos += 8
+                t_delta |= (b & 0x7F) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+        else:
+            prefix = 0
+            for _ in range(4):
+                bit = read(pos, 1)
+                pos += 1
+                prefix = (prefix << 1) | bit
+                if not bit:
+                    break
+            if prefix == 0b0:
+                dod = 0
+            elif prefix == 0b1111:
+                dod = read(pos, 64)
+                pos += 64
+                if dod >= 1 << 63:
+                    dod -= 1 << 64
+            else:
+                width = {0b10: 14, 0b110: 17, 0b1110: 20}[prefix]
+                dod = read(pos, width)
+                pos += width
+                if dod > (1 << (width - 1)):
+                    dod -= 1 << width
+            t_delta += dod
+        t += t_delta
+        timestamps[i] = t
+
+        if read(pos, 1):
+            pos += 1
+            if read(pos, 1):
+                pos += 1
+                leading = read(pos, 5)
+                significant = read(pos + 5, 6) or 64
+                pos += 11
+                trailing = 64 - leading - significant
+            else:
+                pos += 1
+                significant = 64 - leading - trailing
+            value ^= read(pos, significant) << trailing
+            pos += significant
+        else:
+            pos += 1
+        bits[i] = value
+    return timestamps, bits.view(np.float64)
+
+
+def _map_file(path: Path) -> Optional[memoryview]:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# --- Series catalogue ---
+class _Series:
+    __slots__ = ("labels", "chunks", "wal_t", "wal_v")
+
+    def __init__(self, labels: Dict[str, str]):
+        self.labels = labels
+        self.chunks: List[Tuple[int, int, memoryview]] = []  # (mint, maxt, chunk data)
+        self.wal_t: List[int] = []
+        self.wal_v: List[float] = []
+
+
+class PrometheusTSDBReader(QueryEngine):
+    """
+    Read-only reader for a Prometheus data directory.
+
+    With `anchor_to_data`, queries that end after the newest stored sample are
+    shifted back to end at it, so "last 1h" means the last hour of recorded data.
+    """
+
+    def __init__(self, data_dir: Union[str, Path], anchor_to_data: bool = True):
+        self.data_dir = Path(data_dir)
+        self.anchor_to_data = anchor_to_data
+        self._series: Dict[Tuple, _Series] = {}
+        self._postings: Dict[str, Dict[str, set]] = {}
+        self._head_refs: Dict[int, Tuple] = {}
+        self.min_time = None
+        self.max_time = None
+        self.load_stats: Dict[str, Any] = {}
+        self._load()
+
+    # --- Loading ---
+    def _get_series(self, labels: Dict[str, str]) -> _Series:
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(labels)
+            for name, value in labels.items():
+                self._postings.setdefault(name, {}).setdefault(value, set()).add(key)
+        return series
+
+    def _extend_time(self, mint: int, maxt: int):
+        self.min_time = mint if self.min_time is None else min(self.min_time, mint)
+        self.max_time = maxt if self.max_time is None else max(self.max_time, maxt)
+
+    def _load(self):
+        if not self.data_dir.is_dir():
+            raise FileNotFoundError(f"Prometheus data directory not found: {self.data_dir}")
+        t0 = time.perf_counter()
+        blocks = sorted(p for p in self.data_dir.iterdir() if (p / "meta.json").is_file())
+        for block in blocks:
+            self._load_block(block)
+        t1 = time.perf_counter()
+        self._replay_wal()
+        t2 = time.perf_counter()
+        self._load_head_chunks()
+        t3 = time.perf_counter()
+        self.load_stats.update({
+            "blocks": len(blocks),
+            "series": len(self._series),
+            "block_index_s": round(t1 - t0, 3),
+            "wal_replay_s": round(t2 - t1, 3),
+            "head_chunks_s": round(t3 - t2, 3),
+        })
+        logger.info(f"Loaded offline TSDB from {self.data_dir}: {self.load_stats}")
+
+    def _load_block(self, block: Path):
+        index = _map_file(block / "index")
+        if index is None or _BE32.unpack_from(index, 0)[0] != INDEX_MAGIC:
+            logger.warning(f"Skipping block {block.name}: missing or invalid index")
+            return
+        if index[4] != 2:
+            logger.warning(f"Skipping block {block.name}: unsupported index version {index[4]}")
+            return
+        toc = struct.unpack_from(">6Q", index, len(index) - 52)
+        symbols_off, postings_table_off = toc[0], toc[5]
+
+        # Symbol table: v2 series reference symbols by their position
+        count = _BE32.unpack_from(index, symbols_off + 4)[0]
+        pos = symbols_off + 8
+        symbols = []
+        for _ in range(count):
+            length, pos = _uvarint(index, pos)
+            symbols.append(bytes(index[pos:pos + length]).decode())
+            pos += length
+
+        # All series are listed in the postings list for the empty label pair
+        all_postings = None
+        entries = _BE32.unpack_from(index, postings_table_off + 4)[0]
+        pos = postings_table_off + 8
+        for _ in range(entries):
+            _, pos = _uvarint(index, pos)
+            name_len, pos = _uvarint(index, pos)
+            pos += name_len
+            value_len, pos = _uvarint(index, pos)
+            pos += value_len
+            offset, pos = _uvarint(index, pos)
+            if name_len == 0 and value_len == 0:
+                all_postings = offset
+                break
+        if all_postings is None:
+            logger.warning(f"Skipping block {block.name}: no all-postings list")
+            return
+
+        chunk_files = [_map_file(p) for p in sorted((block / "chunks").glob("[0-9]*"))] \
+            if (block / "chunks").is_dir() else []
+        n_refs = _BE32.unpack_from(index, all_postings + 4)[0]
+        refs = struct.unpack_from(f">{n_refs}I", index, all_postings + 8)
+        missing_chunks = 0
+        for ref in refs:
+            pos = ref * 16
+            _, pos = _uvarint(index, pos)
+            n_labels, pos = _uvarint(index, pos)
+            labels = {}
+            for _ in range(n_labels):
+                name_ref, pos = _uvarint(index, pos)
+                value_ref, pos = _uvarint(index, pos)
+                labels[symbols[name_ref]] = symbols[value_ref]
+            series = self._get_series(labels)
+            n_chunks, pos = _uvarint(index, pos)
+            maxt = chunk_ref = 0
+            for i in range(n_chunks):
+                if i == 0:
+                    mint, pos = _varint(index, pos)
+                    delta, pos = _uvarint(index, pos)
+                    maxt = mint + delta
+                    chunk_ref, pos = _uvarint(index, pos)
+                else:
+                    gap, pos = _uvarint(index, pos)
+                    mint = maxt + gap
+                    delta, pos = _uvarint(index, pos)
+                    maxt = mint + delta
+                    ref_delta, pos = _varint(index, pos)
+                    chunk_ref += ref_delta
+                segment, offset = chunk_ref >> 32, chunk_ref & 0xFFFFFFFF
+                if segment >= len(chunk_files) or chunk_files[segment] is None:
+                    missing_chunks += 1
+                    continue
+                data = chunk_files[segment]
+                length, data_pos = _uvarint(data, offset)
+                if data[data_pos] == ENCODING_XOR:
+                    series.chunks.append((mint, maxt, data[data_pos + 1:data_pos + 1 + length]))
+                    # Only count time ranges we can actually read, so anchoring lands on real data
+                    self._extend_time(mint, maxt)
+        self.load_stats[f"block_{block.name}"] = {"series": len(refs), "missing_chunks": missing_chunks}
+        if missing_chunks:
+            logger.warning(f"Block {block.name}: {missing_chunks} chunks referenced by the index are "
+                           f"not on disk; only head/WAL samples are available for that range")
+
+    def _wal_records(self, directory: Path) -> Iterator[bytes]:
+        """Yields reassembled (and decompressed) records from all WAL segments in a directory."""
+        fragments = []
+        for segment in sorted(p for p in directory.iterdir() if p.name.isdigit()):
+            data = _map_file(segment)
+            if data is None:
+                continue
+            pos, size = 0, len(data)
+            while pos + WAL_HEADER_SIZE <= size:
+                page_left = WAL_PAGE_SIZE - pos % WAL_PAGE_SIZE
+                if page_left < WAL_HEADER_SIZE:
+                    pos += page_left
+                    continue
+                flags = data[pos]
+                kind = flags & 0x07
+                if kind == 0:  # page terminator: rest of the page is padding
+                    pos += page_left
+                    continue
+                length = (data[pos + 1] << 8) | data[pos + 2]
+                start = pos + WAL_HEADER_SIZE
+                fragments.append(data[start:start + length])
+                pos = start + length
+                if kind in (WAL_REC_FULL, WAL_REC_LAST):
+                    record = b"".join(fragments) if len(fragments) > 1 else fragments[0]
+                    fragments = []
+                    if flags & WAL_ZSTD_FLAG:
+                        self.load_stats["wal_zstd_skipped"] = self.load_stats.get("wal_zstd_skipped", 0) + 1
+                        continue
+                    yield snappy_decompress(record) if flags & WAL_SNAPPY_FLAG else bytes(record)
+
+    def _replay_wal(self):
+        wal_dir = self.data_dir / "wal"
+        if not wal_dir.is_dir():
+            return
+        directories = sorted(p for p in wal_dir.iterdir() if p.is_dir() and p.name.startswith("checkpoint."))
+        samples = 0
+        for directory in directories[-1:] + [wal_dir]:
+            for record in self._wal_records(directory):
+                if not record:
+                    continue
+                if record[0] == RECORD_SERIES:
+                    pos = 1
+                    while pos < len(record):
+                        ref = _BE64.unpack_from(record, pos)[0]
+                        n_labels, pos = _uvarint(record, pos + 8)
+                        labels = {}
+                        for _ in range(n_labels):
+                            length, pos = _uvarint(record, pos)
+                            name = record[pos:pos + length].decode()
+                            pos += length
+                            length, pos = _uvarint(record, pos)
+                            labels[name] = record[pos:pos + length].decode()
+                            pos += length
+                        self._get_series(labels)
+                        self._head_refs[ref] = tuple(sorted(labels.items()))
+                elif record[0] == RECORD_SAMPLES and len(record) > 17:
+                    base_ref, base_t = struct.unpack_from(">Qq", record, 1)
+                    pos = 17
+                    mint = maxt = base_t
+                    while pos < len(record):
+                        d_ref, pos = _varint(record, pos)
+                        d_t, pos = _varint(record, pos)
+                        value = struct.unpack_from(">d", record, pos)[0]
+                        pos += 8
+                        key = self._head_refs.get(base_ref + d_ref)
+                        if key is None:
+                            continue
+                        series = self._series[key]
+                        series.wal_t.append(base_t + d_t)
+                        series.wal_v.append(value)
+                        mint, maxt = min(mint, base_t + d_t), max(maxt, base_t + d_t)
+                        samples += 1
+                    self._extend_time(mint, maxt)
+        self.load_stats["wal_samples"] = samples
+
+    def _load_head_chunks(self):
+        head_dir = self.data_dir / "chunks_head"
+        if not head_dir.is_dir():
+            return
+        chunks = 0
+        for path in sorted(p for p in head_dir.iterdir() if p.name.isdigit()):
+            data = _map_file(path)
+            if data is None or _BE32.unpack_from(data, 0)[0] != HEAD_CHUNKS_MAGIC:
+                continue
+            pos = 8
+            while pos + 25 <= len(data):
+                ref, mint, maxt = struct.unpack_from(">Qqq", data, pos)
+                if ref == 0 and mint == 0 and maxt == 0:
+                    break  # preallocated, unused tail of the file
+                encoding = data[pos + 24]
+                length, start = _uvarint(data, pos + 25)
+                key = self._head_refs.get(ref)
+                if key is not None and encoding == ENCODING_XOR:
+                    self._series[key].chunks.append((mint, maxt, data[start:start + length]))
+                    self._extend_time(mint, maxt)
+                    chunks += 1
+                pos = start + length + 4  # skip CRC32
+        self.load_stats["head_chunks"] = chunks
+
+    # --- Series access ---
+    def read_series(self, key: Tuple, mint: int, maxt: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Decodes all samples of one series in [mint, maxt] (ms), sorted and de-duplicated."""
+        series = self._series[key]
+        parts_t, parts_v = [], []
+        for c_mint, c_maxt, data in series.chunks:
+            if c_maxt >= mint and c_mint <= maxt:
+                t, v = decode_xor_chunk(data)
+                parts_t.append(t)
+                parts_v.append(v)
+        if series.wal_t:
+            parts_t.append(np.asarray(series.wal_t, dtype=np.int64))
+            parts_v.append(np.asarray(series.wal_v, dtype=np.float64))
+        if not parts_t:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        t = np.concatenate(parts_t)
+        v = np.concatenate(parts_v)
+        # WAL samples overlap the head chunks they were cut into; keep one per timestamp
+        t, first = np.unique(t, return_index=True)
+        v = v[first]
+        keep = (t >= mint) & (t <= maxt)
+        return t[keep], v[keep]
+
+    def series_count(self) -> int:
+        return len(self._series)
+
+    def series_end(self, key: Tuple) -> Optional[int]:
+        """Timestamp (ms) of the newest stored sample of a series."""
+        series = self._series[key]
+        ends = [maxt for _, maxt, _ in series.chunks]
+        if series.wal_t:
+            ends.append(max(series.wal_t))
+        return max(ends) if ends else None
+
+    def series_labels(self, key: Tuple) -> Dict[str, str]:
+        return self._series[key].labels
+
+    def series_keys(self):
+        return self._series.keys()
+
+
+def get_offline_reader() -> Optional[PrometheusTSDBReader]:
+    """
+    Returns a reader for PROMETHEUS_DATA_DIR (default: monitoring-stack/prometheus_data
+    next to this file), or None if the directory is missing or unreadable.
+    """
+    default = Path(__file__).resolve().parent / "monitoring-stack" / "prometheus_data"
+    data_dir = Path(os.environ.get("PROMETHEUS_DATA_DIR", default))
+    if not data_dir.is_dir():
+        return None
+    try:
+        return PrometheusTSDBReader(data_dir)
+    except Exception as e:
+        logger.error(f"Could not open offline TSDB at {data_dir}: {e}", exc_info=True)
+        return None
+
+
+# Benchmark: python tsdb_reader.py [data_dir]
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else Path(__file__).resolve().parent / "monitoring-stack" / "prometheus_data"
+    reader = PrometheusTSDBReader(data_dir)
+    logger.info(f"Time range: {datetime.fromtimestamp(reader.min_time / 1000)} - "
+                f"{datetime.fromtimestamp(reader.max_time / 1000)}")
+
+    t0 = time.perf_counter()
+    total = 0
+    for key in reader.match_series([]):
+        t, _ = reader.read_series(key, reader.min_time, reader.max_time)
+        total += len(t)
+    elapsed = time.perf_counter() - t0
+    logger.info(f"Full scan: {reader.series_count()} series, {total:,} samples in {elapsed:.2f}s "
+                f"({total / elapsed / 1e6:.2f}M samples/s)")
+
+    t0 = time.perf_counter()
+    result = reader.custom_query_range("sum by (name) (rate(container_cpu_usage_seconds_total[5m]))",
+                                       time.time() - 3600, time.time(), 60)
+    logger.info(f"Range query (1h, 60s step): {len(result)} series in {(time.perf_counter() - t0) * 1000:.1f} ms")
@@ -1,24 +1,36 @@
 import os
 import shutil
-import subprocess
 import logging
 from pathlib import Path
 import docker
 from docker.errors import DockerException
 
+import asset_pipeline
+import blue_green
+import build_cache
+import pipeline_engine
+import website_loadtest
+import website_tests
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class WebsiteHandler:
+    # Generated by build_website/test_website; never part of an image
+    CONTEXT_EXCLUDES = ("build", "test")
+    PUBLIC_PORT = 8089
+    RUN_OPTIONS = {"restart_policy": {"Name": "always"}}
+
     def __init__(self, docker_client=None):
         self.docker_client = docker_client or docker.from_env()
         self.website_dir = Path("website")
         self.build_dir = self.website_dir / "build"
         self.test_dir = self.website_dir / "test"
+        self.site_dir = self.build_dir / "site"
 
-    def build_website(self):
-        """Build the website using Docker."""
+    def build_website(self, progress=None):
+        """Build the website using Docker. `progress(message)` is called at each build step."""
         try:
             # Create build directory if it doesn't exist
             self.build_dir.mkdir(parents=True, exist_ok=True)
@@ -42,12 +54,10 @@ CMD ["nginx", "-g", "daemon off;"]
 
             # Build Docker image
             if self.docker_client:
-                image, logs = self.docker_client.images.build(
-                    path=str(self.website_dir),
-                    tag="chatops-website:latest",
-                    rm=True
-                )
-                return True, "Website built successfully!"
+                _, cache = build_cache.cached_build(self.docker_client, str(self.website_dir),
+                                                    "chatops-website:latest", progress=progress,
+                                                    excludes=self.CONTEXT_EXCLUDES)
+                return True, f"Website built successfully! Build {build_cache.format_cache_report(cache)}"
             else:
                 return False, "Docker client not initialized"
 
@@ -55,118 +65,165 @@ CMD ["nginx", "-g", "daemon off;"]
             logger.error(f"Error building website: {str(e)}")
             return False, f"Error building website: {str(e)}"
 
-    def test_website(self):
-        """Run tests on the website."""
+    def test_website(self, image="chatops-website:latest", progress=None):
+        """
+        Smoke-tests `image` in its own container on an ephemeral port: waits for
+        it to answer, then checks every page and asset it links to (see
+        website_tests.py). Runs for different images can execute in parallel.
+        """
         try:
-            # Create test directory if it doesn't exist
-            self.test_dir.mkdir(parents=True, exist_ok=True)
-
-            # Create a simple test script
-            test_script = """
-const { test, expect } = require('@playwright/test');
-
-test('Website loads successfully', async ({ page }) => {
-    await page.goto('http://localhost:80');
-    const title = await page.title();
-    expect(title).toBeTruthy();
-});
-
-test('All links are working', async ({ page }) => {
-    await page.goto('http://localhost:80');
-    const links = await page.$$('a');
-    for (const link of links) {
-        const href = await link.getAttribute('href');
-        if (href && !href.startsWith('#')) {
-            const response = await page.goto(href);
-            expect(response.status()).toBe(200);
-        }
-    }
-});
-"""
-            with open(self.test_dir / "website.spec.js", "w") as f:
-                f.write(test_script)
-
-            # Run tests using Docker
-            if self.docker_client:
-                container = self.docker_client.containers.run(
-                    "chatops-website:latest",
-                    detach=True,
-                    ports={'80/tcp': 80}
-                )
-                
-                # Run Playwright tests
-                test_result = subprocess.run(
-                    ["npx", "playwright", "test"],
-                    cwd=str(self.test_dir),
-                    capture_output=True,
-                    text=True
-                )
-                
-                # Stop and remove the test container
-                container.stop()
-                container.remove()
-                
-                if test_result.returncode == 0:
-                    return True, "All tests passed successfully!"
-                else:
-                    return False, f"Tests failed: {test_result.stderr}"
-            else:
+            if not self.docker_client:
                 return False, "Docker client not initialized"
+            report = website_tests.run_tests(self.docker_client, image, progress=progress)
+            return report["passed"], website_tests.format_test_report(report)
 
         except Exception as e:
             logger.error(f"Error testing website: {str(e)}")
             return False, f"Error testing website: {str(e)}"
 
-    def deploy_website(self, website_name="my-website"):
-        """Deploy the website using Docker."""
+    def optimize_assets(self, progress=None):
+        """
+        Runs the asset pipeline over website/ into build/site, a self-contained
+        nginx build context with the site under build/site/html. Returns the
+        pipeline report.
+        """
+        return asset_pipeline.run(str(self.website_dir), str(self.site_dir), progress=progress,
+                                  excludes=self.CONTEXT_EXCLUDES)
+
+    def _replicas(self, website_name, replicas=None):
+        """Requested count, else WEBSITE_REPLICAS ("auto" = one per CPU), else as many as run now."""
+        setting = str(replicas or os.environ.get("WEBSITE_REPLICAS", "")).strip().lower()
+        if setting == "auto":
+            return min(os.cpu_count() or 1, blue_green.MAX_REPLICAS)
+        if setting:
+            return int(setting)
+        info = blue_green.describe(self.docker_client, website_name)
+        return info["replicas"] if info and info["strategy"] == "bluegreen" else 1
+
+    def deploy_website(self, website_name="my-website", progress=None, replicas=None):
+        """
+        Deploy the website using Docker. The image is built while the current
+        containers keep serving, then `replicas` containers of it are swapped in
+        behind the site's nginx router (blue/green by default, see
+        blue_green.py). `progress(message)` is called as the deploy advances.
+        """
+        progress = progress or (lambda message: None)
         try:
-            # Stop and remove existing container if it exists
-            try:
-                container = self.docker_client.containers.get(f"{website_name}-container")
-                container.stop()
-                container.remove()
-                logger.info(f"Stopped and removed existing container: {website_name}-container")
-            except docker.errors.NotFound:
-                logger.info(f"No existing container found: {website_name}-container")
-
             # Ensure website directory exists
             if not self.website_dir.exists():
                 return False, f"❌ Website directory not found at: {self.website_dir}"
 
-            # Build Docker image
-            logger.info(f"Building image {website_name}-image from {self.website_dir}")
-            image, logs = self.docker_client.images.build(
-                path=str(self.website_dir),
-                tag=f"{website_name}-image",
-                rm=True,
-                dockerfile="Dockerfile"
-            )
-
-            # Run the container
-            logger.info(f"Starting container {website_name}-container")
-            container = self.docker_client.containers.run(
-                f"{website_name}-image",
-                detach=True,
-                ports={'80/tcp': 8089},
-                name=f"{website_name}-container",
-                restart_policy={"Name": "always"}
-            )
-
-            # Verify container is running
-            container.reload()
-            if container.status != "running":
-                return False, f"❌ Container failed to start. Status: {container.status}"
-
-            return True, f"""✅ Successfully deployed website!
-• Container: {website_name}-container
+            # Optimized assets and their nginx config, unless ASSET_PIPELINE_ENABLED is false
+            assets = None
+            if asset_pipeline.enabled():
+                progress("Optimizing website assets")
+                assets = self.optimize_assets(progress=progress)
+
+            _, cache = self.build_site_image(website_name, progress=progress)
+            result = self.release(website_name, replicas=replicas, progress=progress)
+            if not result["success"]:
+                return False, f"❌ Deploy failed: {blue_green.format_deploy_result(result)}"
+
+            message = f"""✅ Successfully deployed website!
+• Containers: {', '.join(result['replicas'])}
 • Image: {website_name}-image
-• Port: 8089
-• Access at: http://localhost:8089"""
+• Port: {self.PUBLIC_PORT}
+• Access at: http://localhost:{self.PUBLIC_PORT}
+• Build: {build_cache.format_cache_report(cache)}
+• {blue_green.format_deploy_result(result)}"""
+            if assets:
+                message += f"\n• Assets: {asset_pipeline.format_asset_report(assets)}"
+            return True, message
 
         except Exception as e:
             logger.error(f"Error deploying website: {str(e)}")
             return False, f"❌ Failed to deploy website: {str(e)}"
 
+    def build_site_image(self, website_name="my-website", progress=None):
+        """
+        Builds `<website_name>-image` from build/site when the asset pipeline is
+        on (run optimize_assets first), else from website/. The build is skipped
+        when an image of an identical tree exists. Returns (image, cache report).
+        """
+        if asset_pipeline.enabled():
+            context, excludes = str(self.site_dir), ()
+        else:
+            context, excludes = str(self.website_dir), self.CONTEXT_EXCLUDES
+        logger.info(f"Building image {website_name}-image from {context}")
+        if progress:
+            progress(f"Building image {website_name}-image")
+        return build_cache.cached_build(self.docker_client, context, f"{website_name}-image",
+                                        dockerfile="Dockerfile", progress=progress, excludes=excludes)
+
+    def release(self, website_name="my-website", replicas=None, progress=None):
+        """Swaps `<website_name>-image` in as the serving version; returns the blue_green.deploy result."""
+        replicas = self._replicas(website_name, replicas)
+        logger.info(f"Deploying {website_name}-image ({replicas} replicas)")
+        return blue_green.deploy(self.docker_client, website_name, f"{website_name}-image",
+                                 public_port=self.PUBLIC_PORT, progress=progress, run_options=self.RUN_OPTIONS,
+                                 replicas=replicas)
+
+    def scale_website(self, website_name="my-website", replicas=None, progress=None):
+        """Rolling change of the deployed website's replica count, without dropping requests."""
+        try:
+            result = blue_green.scale(self.docker_client, website_name, self._replicas(website_name, replicas),
+                                      progress=progress, run_options=self.RUN_OPTIONS)
+            if not result["success"]:
+                return False, f"❌ Scaling failed: {blue_green.format_deploy_result(result)}"
+            return True, f"✅ {blue_green.format_deploy_result(result)}"
+
+        except ValueError as e:
+            return False, f"❌ {e}"
+        except Exception as e:
+            logger.error(f"Error scaling website: {str(e)}")
+            return False, f"❌ Failed to scale website: {str(e)}"
+
+    def run_pipeline(self, website_name="my-website", deploy=False, replicas=None, force=False, progress=None):
+        """
+        Lints, tests and builds the website (and deploys it with `deploy`)
+        through pipeline_engine, running independent stages concurrently and
+        reusing the outputs of stages whose inputs did not change.
+        """
+        try:
+            pipeline = pipeline_engine.website_pipeline(self, website_name, deploy=deploy, replicas=replicas)
+            report = pipeline.run(progress=progress, force=force)
+            return report["success"], pipeline_engine.format_report(report)
+        except (DockerException, OSError, ValueError) as e:
+            logger.error(f"Error running the website pipeline: {str(e)}")
+            return False, f"❌ Pipeline failed: {str(e)}"
+
+    def deployment_info(self, website_name="my-website"):
+        """The container, image and URL currently serving `website_name`, or None if it is not deployed."""
+        info = blue_green.describe(self.docker_client, website_name)
+        if info and info["public_port"]:
+            info["url"] = f"http://{blue_green.PROBE_HOST}:{info['public_port']}/"
+        return info
+
+    def load_test(self, website_name="my-website", progress=None, **options):
+        """
+        Load tests the deployed `website_name` (options as for
+        website_loadtest.run_load_test), stores the result with the deployment
+        it measured and compares it with the previous run against the same site.
+        """
+        try:
+            info = self.deployment_info(website_name)
+            if not info or "url" not in info:
+                return False, f"❌ {website_name} is not deployed (try `/deploy-website {website_name}`)"
+            if progress:
+                progress(f"Load testing {info['url']} ({info['container']}, {info['image']})")
+            record = website_loadtest.run_load_test(info["url"], progress=progress, **options)
+            record.update(website=info["app"], container=info["container"], image=info["image"],
+                          image_id=info["image_id"])
+            previous = website_loadtest.previous_result(record)
+            website_loadtest.save_result(record)
+            return True, website_loadtest.format_result(record, previous)
+
+        except ValueError as e:
+            return False, f"❌ {e}"
+        except Exception as e:
+            logger.error(f"Error load testing website: {str(e)}")
+            return False, f"❌ Error load testing website: {str(e)}"
+
     def cleanup(self):
         """Clean up build artifacts."""
         try:
@@ -0,0 +1,420 @@
+# website_loadtest.py
+"""
+HTTP load generator for deployed websites.
+
+Two ways to apply load:
+
+- closed loop: `concurrency` simulated users each send a request, wait for the
+  answer and send the next, so the offered load drops when the site slows down
+- open loop: requests start on a fixed schedule of `rps` per second whether or
+  not earlier ones finished, like independent visitors. Latency is measured
+  from each request's scheduled start, so time spent queued behind a slow
+  response counts (no coordinated omission).
+
+Requests go over a pool of HTTP/1.1 keep-alive connections (at most
+`connections`, reused unless keep_alive is off). Latencies are recorded in an
+HdrHistogram-style log-linear histogram, which keeps ~1% precision from
+microseconds to minutes. Each run is appended as one JSON line to
+LOADTEST_RESULTS (default $BOT_STATE_DIR/loadtests.jsonl), together with the
+deployment it measured, so results can be compared with earlier deploys.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+MODES = ("closed", "open")
+# Limits for runs started from Slack
+MAX_DURATION = float(os.environ.get("LOADTEST_MAX_DURATION", "120"))
+MAX_RPS = float(os.environ.get("LOADTEST_MAX_RPS", "2000"))
+MAX_CONNECTIONS = int(os.environ.get("LOADTEST_MAX_CONNECTIONS", "256"))
+REQUEST_TIMEOUT = float(os.environ.get("LOADTEST_TIMEOUT", "5"))
+PROGRESS_INTERVAL = 5.0
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of integer microseconds in the style of HdrHistogram:
+    values below 2^bits have their own bucket, and above that every power of
+    two is split into 2^(bits-1) buckets, so a bucket is at most 1/2^(bits-1)
+    of its value wide (~0.8% with the default 8 bits). Counts are sparse,
+    so a histogram is a few KB and can be stored and merged.
+    """
+
+    def __init__(self, bits: int = 8):
+        self.bits = bits
+        self.sub_buckets = 1 << bits
+        self.half = self.sub_buckets >> 1
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self.sum = 0
+        self.min: Optional[int] = None
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.bits
+        return self.sub_buckets + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def _highest(self, index: int) -> int:
+        """Largest value that falls in bucket `index`."""
+        if index < self.sub_buckets:
+            return index
+        shift = (index - self.sub_buckets) // self.half + 1
+        base = (index - self.sub_buckets) % self.half + self.half
+        return ((base + 1) << shift) - 1
+
+    def record(self, micros: int):
+        micros = max(int(micros), 0)
+        index = self._index(micros)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += micros
+        self.min = micros if self.min is None else min(self.min, micros)
+        self.max = max(self.max, micros)
+
+    def merge(self, other: "LatencyHistogram"):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> int:
+        if not self.total:
+            return 0
+        target = max(math.ceil(self.total * p / 100), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest(index), self.max)
+        return self.max
+
+    def summary_ms(self) -> Dict[str, float]:
+        summary = {f"p{p:g}": round(self.percentile(p) / 1000, 3) for p in PERCENTILES}
+        summary.update(min=round((self.min or 0) / 1000, 3), max=round(self.max / 1000, 3),
+                       mean=round(self.sum / self.total / 1000, 3) if self.total else 0.0)
+        return summary
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"bits": self.bits, "counts": {str(index): count for index, count in sorted(self.counts.items())},
+                "total": self.total, "sum": self.sum, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LatencyHistogram":
+        histogram = cls(data["bits"])
+        histogram.counts = {int(index): count for index, count in data["counts"].items()}
+        histogram.total, histogram.sum, histogram.min, histogram.max = (data["total"], data["sum"],
+                                                                        data["min"], data["max"])
+        return histogram
+
+
+class _Connection:
+    """One HTTP/1.1 connection that can carry several requests in turn."""
+
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.requests = 0
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def get(self, target: str, host_header: str, keep_alive: bool) -> Tuple[int, int, bool]:
+        """Sends a GET and reads the whole response. Returns (status, body bytes, reusable)."""
+        self.writer.write((f"GET {target} HTTP/1.1\r\nHost: {host_header}\r\nAccept-Encoding: gzip\r\n"
+                           f"User-Agent: chatops-loadtest\r\n"
+                           f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before a response")
+        self.requests += 1
+        version, status = status_line.split()[:2]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip().lower()
+        reusable = keep_alive and version == b"HTTP/1.1" and headers.get("connection") != "close"
+        if "content-length" in headers:
+            size = len(await self.reader.readexactly(int(headers["content-length"])))
+        elif headers.get("transfer-encoding") == "chunked":
+            size = 0
+            while True:
+                chunk = int((await self.reader.readline()).split(b";")[0], 16)
+                if chunk == 0:
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass  # trailers
+                    break
+                size += len(await self.reader.readexactly(chunk + 2)) - 2
+        else:
+            size = len(await self.reader.read())
+            reusable = False
+        return int(status), size, reusable
+
+
+class _ConnectionPool:
+    def __init__(self, url: str, max_connections: int, keep_alive: bool):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError(f"Only http:// URLs can be load tested, not {url}")
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.host_header = parts.netloc
+        self.target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.keep_alive = keep_alive
+        self.slots = asyncio.Semaphore(max_connections)
+        self.idle: List[_Connection] = []
+        self.opened = 0
+
+    async def _connect(self) -> _Connection:
+        connection = _Connection(self.host, self.port)
+        await connection.open()
+        self.opened += 1
+        return connection
+
+    async def request(self) -> Tuple[int, int]:
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = await self._connect()
+            try:
+                try:
+                    status, size, reusable = await connection.get(self.target, self.host_header, self.keep_alive)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server closed this idle keep-alive connection; retry once on a new one
+                    connection.close()
+                    connection = await self._connect()
+                    status, size, reusable = await connection.get(self.target, self.host_header, self.keep_alive)
+            except BaseException:
+                connection.close()
+                raise
+            if reusable:
+                self.idle.append(connection)
+            else:
+                connection.close()
+            return status, size
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle.clear()
+
+
+async def _load(url: str, mode: str, rps: float, concurrency: int, duration: float, connections: int,
+                keep_alive: bool, timeout: float, progress: Callable[[str], None]) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    pool = _ConnectionPool(url, connections, keep_alive)
+    histogram = LatencyHistogram()
+    stats = {"sent": 0, "completed": 0, "ok": 0, "bytes": 0, "errors": {}}
+
+    def error(kind: str):
+        stats["errors"][kind] = stats["errors"].get(kind, 0) + 1
+
+    async def one(scheduled: float):
+        stats["sent"] += 1
+        try:
+            status, size = await asyncio.wait_for(pool.request(), timeout)
+        except asyncio.TimeoutError:
+            error("timeout")
+            return
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            error(type(e).__name__)
+            return
+        finally:
+            stats["completed"] += 1
+        histogram.record((loop.time() - scheduled) * 1_000_000)
+        stats["bytes"] += size
+        if status >= 400:
+            error(f"HTTP {status}")
+        else:
+            stats["ok"] += 1
+
+    # An exception from progress() (a cancelled job raises JobCancelled) stops the test
+    stopped: List[BaseException] = []
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            try:
+                progress(f"{loop.time() - start:.0f}s: {stats['completed']} requests, "
+                         f"p99 {histogram.percentile(99) / 1000:.1f} ms, {sum(stats['errors'].values())} errors")
+            except BaseException as e:
+                stopped.append(e)
+                return
+
+    start = loop.time()
+    end = start + duration
+    report_task = asyncio.ensure_future(reporter())
+    try:
+        if mode == "open":
+            interval, in_flight, n = 1 / rps, set(), 0
+            while start + n * interval < end and not stopped:
+                scheduled = start + n * interval
+                if scheduled > loop.time():
+                    await asyncio.sleep(scheduled - loop.time())
+                task = asyncio.ensure_future(one(scheduled))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                n += 1
+            if in_flight:
+                await asyncio.wait(in_flight)
+        else:
+            async def user():
+                while loop.time() < end and not stopped:
+                    await one(loop.time())
+            await asyncio.gather(*(user() for _ in range(concurrency)))
+    finally:
+        report_task.cancel()
+        pool.close()
+    if stopped:
+        raise stopped[0]
+    elapsed = loop.time() - start
+    return {**stats, "elapsed_s": round(elapsed, 2), "connections_opened": pool.opened,
+            "histogram": histogram}
+
+
+def run_load_test(url: str, mode: str = "closed", rps: Optional[float] = None, concurrency: int = 10,
+                  duration: float = 10.0, connections: Optional[int] = None, keep_alive: bool = True,
+                  timeout: float = REQUEST_TIMEOUT,
+                  progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """
+    Runs one load test against `url` and returns its result record: the
+    settings, request and error counts, throughput and latency percentiles (ms),
+    plus the serialized histogram.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode '{mode}' (use {' or '.join(MODES)})")
+    if mode == "open" and not rps:
+        raise ValueError("Open-loop tests need a request rate (rps)")
+    duration = min(max(float(duration), 1.0), MAX_DURATION)
+    rps = min(float(rps), MAX_RPS) if rps else None
+    concurrency = min(max(int(concurrency), 1), MAX_CONNECTIONS)
+    connections = min(max(int(connections or (concurrency if mode == "closed" else math.ceil(rps / 10))), 1),
+                      MAX_CONNECTIONS)
+    progress = progress or (lambda message: None)
+    started_at = time.time()
+    outcome = asyncio.run(_load(url, mode, rps or 0, concurrency, duration, connections, keep_alive,
+                                timeout, progress))
+    histogram: LatencyHistogram = outcome.pop("histogram")
+    errors = sum(outcome["errors"].values())
+    return {
+        "url": url, "mode": mode, "rps": rps, "concurrency": concurrency if mode == "closed" else None,
+        "duration_s": duration, "connections": connections, "keep_alive": keep_alive,
+        "started_at": started_at, **outcome,
+        "error_rate": round(errors / outcome["sent"], 4) if outcome["sent"] else 0.0,
+        "throughput": round(outcome["ok"] / outcome["elapsed_s"], 1) if outcome["elapsed_s"] else 0.0,
+        "latency_ms": histogram.summary_ms(), "histogram": histogram.to_dict(),
+    }
+
+
+# --- Results store ---
+def results_path() -> str:
+    return os.environ.get("LOADTEST_RESULTS") or os.path.join(os.environ.get("BOT_STATE_DIR", "state"),
+                                                               "loadtests.jsonl")
+
+
+def save_result(record: Dict[str, Any], path: Optional[str] = None):
+    path = path or results_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # One write per record: appends from several bot processes don't interleave
+    with open(path, "a") as f:
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def previous_result(record: Dict[str, Any], path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """The latest stored run against the same target in the same mode, before `record`."""
+    try:
+        with open(path or results_path()) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None
+    target = record.get("website") or record["url"]
+    for line in reversed(lines):
+        try:
+            earlier = json.loads(line)
+        except ValueError:
+            continue
+        if ((earlier.get("website") or earlier["url"]) == target and earlier["mode"] == record["mode"]
+                and earlier["started_at"] < record["started_at"]):
+            return earlier
+    return None
+
+
+def _change(now: float, before: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(now - before) / before:+.0%}"
+
+
+def format_result(record: Dict[str, Any], previous: Optional[Dict[str, Any]] = None) -> str:
+    latency = record["latency_ms"]
+    if record["mode"] == "open":
+        load = f"open loop at {record['rps']:g} req/s"
+    else:
+        load = f"closed loop with {record['concurrency']} users"
+    reuse = "keep-alive" if record["keep_alive"] else "new connection per request"
+    errors = ", ".join(f"{count} × {kind}" for kind, count in sorted(record["errors"].items(), key=lambda e: -e[1]))
+    target = record.get("website") or record["url"]
+    deployed = f" (`{record['image']}` in {record['container']})" if record.get("image") else ""
+    lines = [
+        f"*Load test of {target}*{deployed}: {load} for {record['duration_s']:g}s, "
+        f"{record['connections_opened']} connections opened ({reuse})",
+        f"• {record['sent']:,} requests, {record['ok']:,} OK, error rate {record['error_rate']:.2%}"
+        + (f" ({errors})" if errors else ""),
+        f"• Throughput {record['throughput']:,.1f} req/s, {record['bytes'] / 1e6:.1f} MB received",
+        "• Latency " + (" · ".join(f"{name} {latency[name]:.2f} ms"
+                                   for name in ("p50", "p90", "p99", "p99.9", "p99.99", "max"))
+                        if record["histogram"]["total"] else "not measured (no responses)"),
+    ]
+    if previous:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(previous["started_at"]))
+        image = f", `{previous['image']}`" if previous.get("image") else ""
+        lines.append(f"• vs {when}{image}: p50 {_change(latency['p50'], previous['latency_ms']['p50'])}, "
+                     f"p99 {_change(latency['p99'], previous['latency_ms']['p99'])}, "
+                     f"throughput {_change(record['throughput'], previous['throughput'])}, "
+                     f"error rate {previous['error_rate']:.2%} → {record['error_rate']:.2%}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Load test an HTTP endpoint.")
+    parser.add_argument("url")
+    parser.add_argument("--mode", choices=MODES, default="closed")
+    parser.add_argument("--rps", type=float, help="request rate for --mode open")
+    parser.add_argument("--concurrency", type=int, default=10, help="users for --mode closed")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--connections", type=int)
+    parser.add_argument("--no-keep-alive", action="store_true")
+    parser.add_argument("--save", action="store_true", help=f"append the result to {results_path()}")
+    args = parser.parse_args()
+    result = run_load_test(args.url, args.mode, args.rps, args.concurrency, args.duration, args.connections,
+                           keep_alive=not args.no_keep_alive, progress=logger.info)
+    earlier = previous_result(result)
+    if args.save:
+        save_result(result)
+    print(format_result(result, earlier))
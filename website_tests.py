@@ -0,0 +1,268 @@
+# website_tests.py
+"""
+Isolated, concurrent smoke tests for website images.
+
+Each run starts the image under test in its own container, published on an
+ephemeral host port (Docker picks a free one), so any number of runs for
+different builds can execute side by side. A readiness probe with
+exponential backoff waits until the site answers. Then an asyncio crawler
+fetches every same-origin page, stylesheet, script and image reachable from
+the home page, at most WEBSITE_TEST_CONCURRENCY at a time, and records the
+status, size, time to first byte and total time of each URL. The container
+is always removed at the end.
+"""
+import asyncio
+import gzip
+import logging
+import os
+import re
+import statistics
+import time
+import uuid
+from html.parser import HTMLParser
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+import requests
+
+import blue_green
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = int(os.environ.get("WEBSITE_TEST_CONCURRENCY", "8"))
+URL_TIMEOUT = float(os.environ.get("WEBSITE_TEST_TIMEOUT", "10"))
+READY_TIMEOUT = float(os.environ.get("WEBSITE_TEST_READY_TIMEOUT", "30"))
+MAX_URLS = int(os.environ.get("WEBSITE_TEST_MAX_URLS", "500"))
+# Interface the test container's port is published on
+BIND_ADDRESS = os.environ.get("WEBSITE_TEST_BIND", "127.0.0.1")
+
+CSS_URL_RE = re.compile(r"""url\(\s*["']?([^"')]+)["']?\s*\)""")
+
+
+class UrlResult(NamedTuple):
+    url: str
+    referrer: Optional[str]
+    status: Optional[int]
+    size: int              # bytes on the wire (compressed if the server compressed)
+    ttfb_ms: float
+    total_ms: float
+    content_type: str
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status is not None and self.status < 400
+
+
+class _LinkParser(HTMLParser):
+    ATTRIBUTES = {"href", "src", "poster"}
+
+    def __init__(self):
+        super().__init__()
+        self.links: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if not value:
+                continue
+            if name in self.ATTRIBUTES:
+                self.links.append(value)
+            elif name == "srcset":
+                # "a.webp 1x, b.webp 2x"
+                self.links += [candidate.split()[0] for candidate in value.split(",") if candidate.strip()]
+
+
+def _dechunk(body: bytes) -> bytes:
+    data, pos = bytearray(), 0
+    while True:
+        end = body.find(b"\r\n", pos)
+        if end == -1:
+            break
+        size = int(body[pos:end].split(b";")[0] or b"0", 16)
+        if size == 0:
+            break
+        data += body[end + 2:end + 2 + size]
+        pos = end + 2 + size + 2
+    return bytes(data)
+
+
+async def _fetch(url: str, referrer: Optional[str], timeout: float) -> Tuple[UrlResult, bytes]:
+    """GET over plain HTTP/1.1 (the container under test). Returns the result and the decoded body."""
+    parts = urlsplit(url)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    started = time.perf_counter()
+    ttfb = 0.0
+
+    async def exchange():
+        nonlocal ttfb
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        try:
+            writer.write((f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nAccept-Encoding: gzip\r\n"
+                          f"User-Agent: chatops-website-tests\r\nConnection: close\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+            status_line = await reader.readline()
+            ttfb = time.perf_counter() - started
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.read()
+            return int(status_line.split()[1]), headers, body
+        finally:
+            writer.close()
+
+    try:
+        status, headers, body = await asyncio.wait_for(exchange(), timeout)
+    except asyncio.TimeoutError:
+        error, status, headers, body = f"timed out after {timeout:.0f}s", None, {}, b""
+    except (OSError, ValueError, IndexError) as e:
+        error, status, headers, body = str(e) or type(e).__name__, None, {}, b""
+    else:
+        error = None
+    size = len(body)
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = _dechunk(body)
+    if headers.get("content-encoding", "").lower() == "gzip":
+        try:
+            body = gzip.decompress(body)
+        except (OSError, EOFError) as e:
+            error = f"bad gzip body: {e}"
+    result = UrlResult(url, referrer, status, size, round(ttfb * 1000, 1),
+                       round((time.perf_counter() - started) * 1000, 1),
+                       headers.get("content-type", "").split(";")[0], error)
+    return result, body
+
+
+def _links(result: UrlResult, body: bytes) -> List[str]:
+    if result.content_type == "text/html":
+        parser = _LinkParser()
+        parser.feed(body.decode("utf-8", "replace"))
+        return parser.links
+    if result.content_type == "text/css":
+        return CSS_URL_RE.findall(body.decode("utf-8", "replace"))
+    return []
+
+
+async def check_site(base_url: str, concurrency: int = CONCURRENCY, timeout: float = URL_TIMEOUT,
+                     max_urls: int = MAX_URLS,
+                     progress: Optional[Callable[[str], None]] = None) -> Tuple[List[UrlResult], int]:
+    """
+    Crawls `base_url` and checks every same-origin link and asset it reaches.
+    Returns (results in completion order, number of external links skipped).
+    """
+    origin = urlsplit(base_url).netloc
+    semaphore = asyncio.Semaphore(concurrency)
+    seen: Set[str] = {base_url}
+    results: List[UrlResult] = []
+    external = 0
+
+    async def check(url, referrer):
+        async with semaphore:
+            return await _fetch(url, referrer, timeout)
+
+    pending = {asyncio.ensure_future(check(base_url, None))}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            result, body = task.result()
+            results.append(result)
+            if not result.ok:
+                continue
+            for link in _links(result, body):
+                url = urldefrag(urljoin(result.url, link.strip()))[0]
+                parts = urlsplit(url)
+                if parts.scheme not in ("http", "https"):
+                    continue
+                if parts.netloc != origin:
+                    external += 1
+                    continue
+                if url in seen or len(seen) >= max_urls:
+                    continue
+                seen.add(url)
+                pending.add(asyncio.ensure_future(check(url, result.url)))
+        if progress and len(results) % 50 == 0:
+            progress(f"Checked {len(results)} URLs")
+    return results, external
+
+
+def _host_port(container) -> Optional[int]:
+    container.reload()
+    bindings = (container.ports or {}).get("80/tcp") or []
+    return int(bindings[0]["HostPort"]) if bindings else None
+
+
+def wait_ready(container, url_for: Callable[[int], str], timeout: float = READY_TIMEOUT) -> Tuple[Optional[str], float]:
+    """
+    Polls the container's home page with exponential backoff (50ms up to 1s)
+    until it answers below 500. Returns (base URL or None, seconds waited).
+    """
+    started = time.monotonic()
+    delay = 0.05
+    while time.monotonic() - started < timeout:
+        port = _host_port(container)
+        if container.status in ("exited", "dead"):
+            break
+        if port:
+            url = url_for(port)
+            try:
+                if requests.get(url, timeout=2).status_code < 500:
+                    return url, time.monotonic() - started
+            except requests.RequestException:
+                pass
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+    return None, time.monotonic() - started
+
+
+def run_tests(client, image: str, progress: Optional[Callable[[str], None]] = None,
+              concurrency: int = CONCURRENCY) -> Dict[str, Any]:
+    """Starts `image` on an ephemeral port, crawls it and removes it. Returns the report."""
+    progress = progress or (lambda message: None)
+    started = time.monotonic()
+    name = f"{blue_green.app_name(image)}-test-{uuid.uuid4().hex[:8]}"
+    report: Dict[str, Any] = {"image": image, "container": name, "passed": False, "results": [], "external": 0}
+    container = client.containers.run(image, detach=True, name=name, ports={"80/tcp": (BIND_ADDRESS, None)},
+                                      labels={"chatops.role": "website-test"})
+    try:
+        url, report["ready_s"] = wait_ready(container, lambda port: f"http://{blue_green.PROBE_HOST}:{port}/")
+        if url is None:
+            logs = container.logs(tail=20).decode(errors="replace").strip()
+            report["error"] = f"not ready after {report['ready_s']:.1f}s (status {container.status})"
+            if logs:
+                report["error"] += f"; last log lines:\n{logs}"
+            return report
+        report["url"] = url
+        progress(f"{name} ready at {url} after {report['ready_s']:.2f}s; checking links and assets")
+        results, report["external"] = asyncio.run(check_site(url, concurrency=concurrency, progress=progress))
+        report["results"] = results
+        report["passed"] = bool(results) and all(result.ok for result in results)
+        return report
+    finally:
+        container.remove(force=True)
+        report["seconds"] = round(time.monotonic() - started, 2)
+        logger.info(f"Website tests of {image}: {format_test_report(report)}")
+
+
+def format_test_report(report: Dict[str, Any], slowest: int = 3) -> str:
+    if "error" in report:
+        return f"{report['image']}: {report['error']}"
+    results: List[UrlResult] = report["results"]
+    failed = [result for result in results if not result.ok]
+    lines = [f"{'passed' if report['passed'] else 'FAILED'}: {len(results) - len(failed)}/{len(results)} URLs OK "
+             f"in {report.get('seconds', 0):.1f}s (ready after {report['ready_s']:.2f}s, "
+             f"{report['external']} external links not checked)"]
+    if results:
+        times = sorted(result.total_ms for result in results)
+        p95 = times[max(int(len(times) * 0.95) - 1, 0)]
+        lines.append(f"response time p50 {statistics.median(times):.0f}ms, p95 {p95:.0f}ms")
+        for result in sorted(results, key=lambda r: r.total_ms, reverse=True)[:slowest]:
+            lines.append(f"  {result.total_ms:.0f}ms (TTFB {result.ttfb_ms:.0f}ms) {result.size:,} B "
+                         f"{urlsplit(result.url).path}")
+    for result in failed[:10]:
+        reason = result.error or f"HTTP {result.status}"
+        source = f" (linked from {urlsplit(result.referrer).path})" if result.referrer else ""
+        lines.append(f"  ✗ {urlsplit(result.url).path}: {reason}{source}")
+    return "\n".join(lines)